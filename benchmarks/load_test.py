@@ -0,0 +1,316 @@
+"""
+Load tests a running server by sending a mix of requests to every endpoint
+at a fixed concurrency, and reports the throughput, latency, time to first
+byte and bytes/sec of each kind of request.
+
+Requests are read from a JSONL trace, each line is a request template with
+a `name`, `method`, `path`, optional JSON `body` and a `weight`. Paths and
+bodies can include placeholders that are filled in for each request:
+
+    {wb_id}      a random waterbody
+    {wb_ids}     a JSON list of `batch_size` random waterbodies
+    {bbox}       a random `bbox_size` degree bbox within the waterbodies
+    {z}/{x}/{y}  a random tile at `zoom` within the waterbodies
+
+By default (`--mode mix`) templates are chosen at random in proportion to
+their weight, or with `--mode replay` the trace is sent in order (eg; a
+trace converted from access logs). Choices are made from a fixed seed, so
+runs against the same dataset (see `seed.py`) send the same requests and
+their JSON results can be compared across commits.
+
+Usage (from the repo root, with the POSTGRES_* env vars set so random
+waterbodies can be chosen from the database):
+
+    PYTHONPATH=server python benchmarks/load_test.py --requests 5000 --concurrency 32 --output results.json
+    PYTHONPATH=server python benchmarks/load_test.py --compare results.json
+"""
+
+import argparse
+import http.client
+import json
+import math
+import random
+import re
+import subprocess
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import psycopg
+
+from app.db import get_connection_str
+from seed import LAT_RANGE, LON_RANGE
+
+DEFAULT_TRACE = Path(__file__).parent / "traces" / "mix.jsonl"
+
+PLACEHOLDER = re.compile(r"\{(wb_id|wb_ids|bbox|z|x|y)\}")
+
+
+def percentile(values: List[float], pc: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pc / 100))]
+
+
+def sample_waterbodies(count: int, seed: int) -> List[int]:
+    with psycopg.connect(get_connection_str()) as conn:
+        wb_ids = [
+            wb_id
+            for (wb_id,) in conn.execute(
+                "SELECT wb_id FROM waterbodies_historical_extent ORDER BY wb_id"
+            )
+        ]
+    return random.Random(seed).sample(wb_ids, min(count, len(wb_ids)))
+
+
+def tile(lon: float, lat: float, z: int) -> Tuple[int, int]:
+    """Returns the x, y of the web mercator tile at zoom z containing a point"""
+    n = 2**z
+    x = int((lon + 180) / 360 * n)
+    lat_r = math.radians(lat)
+    y = int((1 - math.asinh(math.tan(lat_r)) / math.pi) / 2 * n)
+    return x, y
+
+
+def render(
+    template: Dict[str, Any], wb_ids: List[int], rng: random.Random
+) -> Tuple[str, str, Optional[bytes]]:
+    """Returns the method, path and body of a request from a template"""
+    lon = rng.uniform(*LON_RANGE)
+    lat = rng.uniform(*LAT_RANGE)
+    size = template.get("bbox_size", 1.0)
+    z = template.get("zoom", 8)
+    x, y = tile(lon, lat, z)
+    values = {
+        "wb_id": str(rng.choice(wb_ids)),
+        "wb_ids": json.dumps(
+            rng.sample(wb_ids, min(template.get("batch_size", 100), len(wb_ids)))
+        ),
+        "bbox": f"{lon:.4f},{lat:.4f},{lon + size:.4f},{lat + size:.4f}",
+        "z": str(z),
+        "x": str(x),
+        "y": str(y),
+    }
+
+    def fill(text: str) -> str:
+        return PLACEHOLDER.sub(lambda m: values[m.group(1)], text)
+
+    body = template.get("body")
+    return (
+        template.get("method", "GET"),
+        fill(template["path"]),
+        fill(body).encode() if body is not None else None,
+    )
+
+
+def requests_from_trace(
+    trace: List[Dict[str, Any]],
+    mode: str,
+    count: int,
+    wb_ids: List[int],
+    seed: int,
+) -> Iterator[Tuple[str, str, str, Optional[bytes]]]:
+    rng = random.Random(seed)
+    weights = [template.get("weight", 1) for template in trace]
+    for i in range(count):
+        if mode == "replay":
+            template = trace[i % len(trace)]
+        else:
+            template = rng.choices(trace, weights)[0]
+        yield (template["name"], *render(template, wb_ids, rng))
+
+
+class Worker:
+    """Sends requests on a persistent connection, reconnecting after errors"""
+
+    def __init__(self, url: urllib.parse.SplitResult, headers: Dict[str, str]):
+        self.url = url
+        self.headers = headers
+        self.conn: Optional[http.client.HTTPConnection] = None
+
+    def send(self, method: str, path: str, body: Optional[bytes]) -> Dict[str, Any]:
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(
+                self.url.hostname, self.url.port or 80, timeout=300
+            )
+        headers = dict(self.headers)
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            # time to first byte of the body, or of the headers if it's empty
+            chunk = response.read1(64 * 1024)
+            ttfb = time.perf_counter() - start
+            size = len(chunk)
+            while chunk := response.read1(64 * 1024):
+                size += len(chunk)
+            # lets the connection send the next request
+            response.close()
+        except (OSError, http.client.HTTPException) as e:
+            self.conn.close()
+            self.conn = None
+            return dict(error=str(e), latency=time.perf_counter() - start)
+        return dict(
+            status=response.status,
+            latency=time.perf_counter() - start,
+            ttfb=ttfb,
+            bytes=size,
+        )
+
+
+def summarise(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    ok = [r for r in results if r.get("status", 0) < 400 and "error" not in r]
+    summary: Dict[str, Any] = {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "requests_per_sec": len(results) / elapsed,
+    }
+    if ok:
+        latencies = [r["latency"] for r in ok]
+        ttfbs = [r["ttfb"] for r in ok]
+        total_bytes = sum(r["bytes"] for r in ok)
+        for pc in [50, 95, 99]:
+            summary[f"p{pc}_ms"] = percentile(latencies, pc) * 1000
+        for pc in [50, 95, 99]:
+            summary[f"ttfb_p{pc}_ms"] = percentile(ttfbs, pc) * 1000
+        summary["bytes"] = total_bytes
+        summary["mb_per_sec"] = total_bytes / 1e6 / elapsed
+    return summary
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    trace = [json.loads(line) for line in open(args.trace) if line.strip()]
+    if args.max_wb_id:
+        wb_ids = list(range(1, args.max_wb_id + 1))
+    else:
+        wb_ids = sample_waterbodies(args.waterbodies, args.seed)
+
+    url = urllib.parse.urlsplit(args.url)
+    headers = {"Accept-Encoding": args.accept_encoding or "identity"}
+    requests = requests_from_trace(
+        trace, args.mode, args.warmup + args.requests, wb_ids, args.seed
+    )
+    lock = threading.Lock()
+    results: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    sent = 0
+    measured_start = time.perf_counter()
+
+    def work() -> None:
+        nonlocal sent, measured_start
+        worker = Worker(url, headers)
+        while True:
+            with lock:
+                request = next(requests, None)
+                sent += 1
+                warmup = sent <= args.warmup
+                if sent == args.warmup + 1:
+                    measured_start = time.perf_counter()
+            if request is None:
+                return
+            name, method, path = request[:3]
+            result = worker.send(method, url.path.rstrip("/") + path, request[3])
+            if not warmup:
+                with lock:
+                    results[name].append(result)
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(args.concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - measured_start
+
+    all_results = [r for rs in results.values() for r in rs]
+    return {
+        "commit": subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip(),
+        "args": {k: str(v) for k, v in vars(args).items()},
+        "elapsed_sec": elapsed,
+        "total": summarise(all_results, elapsed),
+        "requests": {
+            name: summarise(rs, elapsed) for name, rs in sorted(results.items())
+        },
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    columns = [
+        "requests",
+        "errors",
+        "requests_per_sec",
+        "p50_ms",
+        "p95_ms",
+        "p99_ms",
+        "ttfb_p50_ms",
+        "ttfb_p99_ms",
+        "mb_per_sec",
+    ]
+    print(f"{'':30}" + "".join(f"{c:>17}" for c in columns))
+    rows = list(report["requests"].items()) + [("total", report["total"])]
+    for name, summary in rows:
+        line = f"{name:30}"
+        for column in columns:
+            value = summary.get(column)
+            cell = "" if value is None else f"{value:.1f}"
+            if baseline is not None and value is not None:
+                base = (
+                    baseline["total"]
+                    if name == "total"
+                    else baseline["requests"].get(name, {})
+                ).get(column)
+                if base:
+                    cell += f" ({(value - base) / base * 100:+.0f}%)"
+            line += f"{cell:>17}"
+        print(line)
+    if baseline is not None:
+        print(f"changes are relative to commit {baseline.get('commit')}")
+
+
+def main(args: argparse.Namespace) -> None:
+    report = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--trace", default=str(DEFAULT_TRACE))
+    parser.add_argument("--mode", choices=["mix", "replay"], default="mix")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--warmup", type=int, default=200, help="requests sent before measuring"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--waterbodies",
+        type=int,
+        default=500,
+        help="number of random waterbodies to spread the requests across",
+    )
+    parser.add_argument(
+        "--max-wb-id",
+        type=int,
+        help="use wb_ids 1 to this (as seeded by seed.py) instead of sampling "
+        "them from the database",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--accept-encoding",
+        help="eg; zstd or gzip, responses aren't compressed by default",
+    )
+    parser.add_argument("--output", help="optional path to write JSON results to")
+    parser.add_argument(
+        "--compare", help="JSON results of an earlier run to show the changes from"
+    )
+    main(parser.parse_args())
@@ -0,0 +1,141 @@
+"""
+Compares the latency of the statements the server prepares (those created
+with `prepared=True`, ie; the single row lookups run on every request) when
+they're parsed and planned for every request (`prepare=False`), against
+letting psycopg prepare them once per pooled connection (`prepare=True`, how
+the server runs them). The parameters are bound server-side in both modes.
+
+Queries are run directly against the database, so the results show the
+parse and plan cost that is saved, without any HTTP overhead.
+
+Usage (from the repo root, with the POSTGRES_* env vars set):
+
+    PYTHONPATH=server python benchmarks/prepared_statements.py --requests 5000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict, List
+
+from psycopg_pool import AsyncConnectionPool
+
+from app.db import get_connection_str
+from app.queries import (
+    OBSERVATIONS_VERSION_QUERY,
+    WATER_QUALITY_VERSION_QUERY,
+    WATERBODY_GEOMETRY_QUERY,
+    WATERBODY_QUERY,
+    Statement,
+)
+
+BENCHMARKED_STATEMENTS = [
+    WATERBODY_QUERY,
+    WATERBODY_GEOMETRY_QUERY,
+    OBSERVATIONS_VERSION_QUERY,
+    WATER_QUALITY_VERSION_QUERY,
+]
+assert all(statement.prepared for statement in BENCHMARKED_STATEMENTS)
+
+# Parameters of the statements that aren't waterbody metadata, the defaults
+# of the /geometry endpoint
+DEFAULT_PARAMS = dict(tolerance=0.0, precision=9)
+
+
+def percentile(values: List[float], pc: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pc / 100))]
+
+
+async def sample_waterbodies(
+    pool: AsyncConnectionPool, count: int
+) -> List[Dict[str, Any]]:
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            "SELECT wb_id, uid, area_m2 FROM waterbodies_historical_extent "
+            "ORDER BY random() LIMIT %s",
+            (count,),
+        )
+        return [
+            dict(wb_id=wb_id, uid=uid, area_m2=area_m2)
+            for wb_id, uid, area_m2 in await cur.fetchall()
+        ]
+
+
+async def run_benchmark(
+    pool: AsyncConnectionPool,
+    statement: Statement,
+    mode: str,
+    waterbodies: List[Dict[str, Any]],
+    requests: int,
+    concurrency: int,
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(waterbodies[i % len(waterbodies)])
+    # Run the same way as the server (see `Statement.execute`)
+    statement = statement._replace(prepared=mode == "prepared")
+
+    async def worker():
+        while not queue.empty():
+            params = dict(queue.get_nowait(), **DEFAULT_PARAMS)
+            start = time.perf_counter()
+            async with pool.connection() as conn, conn.cursor() as cur:
+                await statement.execute(cur, **params)
+                await cur.fetchall()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests_per_sec": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    async with AsyncConnectionPool(
+        conninfo=get_connection_str(),
+        min_size=args.concurrency,
+        max_size=args.concurrency,
+    ) as pool:
+        await pool.wait()
+        waterbodies = await sample_waterbodies(pool, args.waterbodies)
+
+        results = []
+        for statement in BENCHMARKED_STATEMENTS:
+            for mode in ["unprepared", "prepared"]:
+                result = await run_benchmark(
+                    pool, statement, mode, waterbodies, args.requests, args.concurrency
+                )
+                result.update(statement=statement.name, mode=mode)
+                results.append(result)
+                print(
+                    f"{statement.name:35} {mode:10} "
+                    f"{result['requests_per_sec']:9.1f} req/s  "
+                    f"p50 {result['p50_ms']:8.2f} ms  "
+                    f"p99 {result['p99_ms']:8.2f} ms"
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--waterbodies",
+        type=int,
+        default=500,
+        help="number of random waterbodies to spread the requests across",
+    )
+    parser.add_argument("--output", help="optional path to write JSON results to")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,215 @@
+"""
+Seeds a database with a synthetic dataset shaped like the real one, for
+load testing (see `load_test.py`) without a copy of the production data.
+
+The tables the API reads are created by the migrations (see app.migrations)
+and filled with waterbodies scattered across Africa, a scene observation
+roughly every 8 days since 1987 (with some dates split across two scenes,
+as where a waterbody crosses scene boundaries), water quality summaries
+roughly every 16 days since 2000, and a percentile ranking of each
+waterbody. The rows are generated by postgres from a fixed random seed, so
+the same arguments always give the same dataset, and it's fast enough to
+seed millions of rows.
+
+Usage (from the repo root, with the POSTGRES_* env vars pointing at a local
+PostGIS database, eg; the docker compose db-postgres service):
+
+    PYTHONPATH=server python benchmarks/seed.py --waterbodies 5000
+
+Existing tables are only replaced with `--drop`, so this can't overwrite a
+restored copy of the real data by accident.
+"""
+
+import argparse
+import logging
+import time
+from datetime import date
+
+import psycopg
+from psycopg import sql
+
+from app.aggregates import refresh_aggregates
+from app.db import get_connection_str
+from app.queries import (
+    OBSERVATION_AGGREGATES_TABLE,
+    WQ_COLUMNS,
+    WQ_RANKING_COLUMNS,
+)
+from app.schema import TABLES, migrate
+
+logger = logging.getLogger(__name__)
+
+# Bounds (in degrees) of the waterbodies' centres, roughly those of Africa.
+# The load test picks its bbox and tile requests from the same bounds.
+LON_RANGE = (-18.0, 52.0)
+LAT_RANGE = (-35.0, 38.0)
+
+# Waterbodies are circles (as 32 sided polygons) with a log-uniform radius
+# of 20m to 5km, most waterbodies are small farm dams. The uid is the
+# geohash of the centre, as in the real data.
+EXTENT_QUERY = f"""
+INSERT INTO waterbodies_historical_extent (uid, wb_id, area_m2, geometry)
+SELECT
+    ST_GeoHash(centre, 12),
+    wb_id,
+    ST_Area(polygon::geography),
+    polygon
+FROM (
+    SELECT
+        wb_id,
+        centre,
+        ST_Buffer(centre::geography, 20 * 250 ^ random(), 8)::geometry AS polygon
+    FROM (
+        SELECT
+            wb_id,
+            ST_SetSRID(
+                ST_MakePoint(
+                    {LON_RANGE[0]} + random() * {LON_RANGE[1] - LON_RANGE[0]},
+                    {LAT_RANGE[0]} + random() * {LAT_RANGE[1] - LAT_RANGE[0]}
+                ),
+                4326
+            ) AS centre
+        FROM generate_series(1, %(waterbodies)s) AS wb_id
+    ) AS centres
+) AS waterbodies
+"""
+
+# Each observation covers part of the waterbody, with a seasonal wet
+# fraction, and a few observations are mostly invalid (eg; cloud) so are
+# filtered out by the observations queries
+OBSERVATIONS_QUERY = """
+INSERT INTO waterbodies_observations
+    (uid, date, area_wet_m2, area_dry_m2, area_invalid_m2)
+SELECT
+    uid,
+    date,
+    area_m2 * share * (1 - invalid) * wet,
+    area_m2 * share * (1 - invalid) * (1 - wet),
+    area_m2 * share * invalid
+FROM (
+    SELECT
+        wb.uid,
+        wb.area_m2,
+        day.date + interval '10 hours' AS date,
+        scene.share,
+        greatest(
+            0, 0.5 + 0.4 * sin(extract(doy FROM day.date) / 58.1) - random() * 0.3
+        ) AS wet,
+        CASE WHEN random() < 0.1 THEN random() ELSE random() * 0.02 END AS invalid
+    FROM waterbodies_historical_extent AS wb
+    CROSS JOIN LATERAL (
+        SELECT date::date
+        FROM generate_series(
+            %(start)s::date + (wb.wb_id %% 8)::int, %(end)s::date, interval '8 days'
+        ) AS date
+    ) AS day
+    CROSS JOIN LATERAL (
+        SELECT unnest(
+            CASE WHEN wb.wb_id %% 5 = 0 THEN ARRAY[0.6, 0.4] ELSE ARRAY[1.0] END
+        ) AS share
+    ) AS scene
+) AS observations
+"""
+
+# Water quality values are random, each variable's quantiles increase from
+# q0_1 to q0_9
+WATER_QUALITY_QUERY = """
+INSERT INTO waterbodies_water_quality (uid, date, {columns})
+SELECT wb.uid, date, {values}
+FROM waterbodies_historical_extent AS wb
+CROSS JOIN LATERAL (
+    SELECT date + interval '10 hours' AS date, random() AS r
+    FROM generate_series(
+        greatest(%(start)s::date, '2000-01-01'::date) + (wb.wb_id %% 16)::int,
+        %(end)s::date,
+        interval '16 days'
+    ) AS date
+) AS day
+"""
+
+PERCENTILES_QUERY = """
+INSERT INTO waterbodies_water_quality_percentiles (uid, {columns})
+SELECT uid, {values}
+FROM waterbodies_historical_extent
+"""
+
+
+def wq_value(column: str) -> str:
+    """SQL expression for the synthetic value of a water quality column"""
+    if column in ("fai_cover", "ndvi_cover"):
+        return "random()"
+    quantile = int(column[-1])
+    return f"(r * 50 + {quantile} * random() * 5)"
+
+
+def seed(conn: psycopg.Connection, args: argparse.Namespace) -> None:
+    for table in list(TABLES) + [OBSERVATION_AGGREGATES_TABLE]:
+        exists = conn.execute("SELECT to_regclass(%s)", (table,)).fetchone()[0]
+        if exists and not args.drop:
+            raise SystemExit(f"{table} already exists, use --drop to replace it")
+
+    params = dict(waterbodies=args.waterbodies, start=args.start, end=args.end)
+    steps = [
+        ("waterbodies_historical_extent", sql.SQL(EXTENT_QUERY)),
+        ("waterbodies_observations", sql.SQL(OBSERVATIONS_QUERY)),
+        (
+            "waterbodies_water_quality",
+            sql.SQL(
+                WATER_QUALITY_QUERY.format(
+                    columns=", ".join(WQ_COLUMNS),
+                    values=", ".join(wq_value(col) for col in WQ_COLUMNS),
+                )
+            ),
+        ),
+        (
+            "waterbodies_water_quality_percentiles",
+            sql.SQL(
+                PERCENTILES_QUERY.format(
+                    columns=", ".join(WQ_RANKING_COLUMNS),
+                    values=", ".join("random() * 100" for _ in WQ_RANKING_COLUMNS),
+                )
+            ),
+        ),
+    ]
+
+    # The tables (with their partitions and indexes) are created by the
+    # migrations, as they are for a restored dump
+    for table in list(TABLES) + [OBSERVATION_AGGREGATES_TABLE, "schema_migrations"]:
+        conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+    migrate(conn)
+
+    with conn.transaction():
+        # Parallel workers each have their own random() sequence, so the
+        # data is only reproducible if generated by a single process
+        conn.execute("SET LOCAL max_parallel_workers_per_gather = 0")
+        conn.execute("SELECT setseed(%s)", (args.seed,))
+        for name, query in steps:
+            start = time.perf_counter()
+            cur = conn.execute(query, params)
+            logger.info(
+                f"Seeded {name}: {cur.rowcount} rows "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+
+    for table in TABLES:
+        conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    # The aggregates table was created (empty) by the migrations
+    refresh_aggregates(conn, date.min)
+
+
+def main(args: argparse.Namespace) -> None:
+    with psycopg.connect(get_connection_str(), autocommit=True) as conn:
+        seed(conn, args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--waterbodies", type=int, default=5000)
+    parser.add_argument("--start", type=date.fromisoformat, default=date(1987, 1, 1))
+    parser.add_argument("--end", type=date.fromisoformat, default=date(2023, 12, 31))
+    parser.add_argument("--seed", type=float, default=0.5, help="between -1 and 1")
+    parser.add_argument(
+        "--drop", action="store_true", help="replace tables that already exist"
+    )
+    main(parser.parse_args())
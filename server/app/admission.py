@@ -0,0 +1,173 @@
+import asyncio
+import json
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncGenerator, Callable, Deque, Dict, Optional, Union
+
+from fastapi import HTTPException
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.timing import timed
+
+
+class AdmissionLimiter:
+    """
+    Limits the number of requests of an endpoint class that are handled at
+    once. Requests over the limit wait in a queue, and are rejected if the
+    queue already has `max_queue` requests, or a slot doesn't become free
+    within `max_wait` seconds. A `max_concurrency` of 0 disables the limit.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waiting: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    async def acquire(self) -> bool:
+        """Returns whether the request was admitted, if so `release` must be
+        called once it has been handled"""
+        # Requests only skip the queue if it's empty, otherwise a request
+        # could take a slot released for the longest waiting request
+        if self.max_concurrency <= 0 or (
+            self.active < self.max_concurrency and not self._waiting
+        ):
+            self.active += 1
+            self.admitted += 1
+            return True
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            return False
+
+        # Released slots are handed to the queued requests in the order they
+        # arrived (see `release`)
+        slot = asyncio.get_running_loop().create_future()
+        self._waiting.append(slot)
+        try:
+            await asyncio.wait([slot], timeout=self.max_wait)
+        except BaseException:
+            # The request was cancelled (eg; the client disconnected), any
+            # slot it was handed is passed on
+            if slot.done():
+                await self.release()
+            else:
+                self._waiting.remove(slot)
+            raise
+        if not slot.done():
+            self._waiting.remove(slot)
+            self.rejected += 1
+            return False
+        self.admitted += 1
+        return True
+
+    async def release(self) -> None:
+        if self._waiting:
+            # The slot stays active, it's handed straight to the next request
+            self._waiting.popleft().set_result(None)
+        else:
+            self.active -= 1
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware that admits each request through the limiter of its
+    endpoint class, so a burst of requests to one class of endpoint (eg;
+    large exports) can't use all of the database connections needed by
+    another (eg; waterbody metadata). The slot is held until the whole
+    response has been sent, including streamed responses.
+
+    Requests that aren't admitted are sent a 503 response, with a
+    Retry-After header. Endpoints that `classify` returns None for aren't
+    limited, or admit their own requests (see `admitted`).
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        limiters: Dict[str, AdmissionLimiter],
+        classify: Callable[[Scope], Optional[str]],
+        retry_after: int,
+    ):
+        self.app = app
+        self.limiters = limiters
+        self.classify = classify
+        self.retry_after = retry_after
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limiter = self.limiters.get(self.classify(scope))
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        with timed("queue"):
+            admitted = await limiter.acquire()
+        if not admitted:
+            body = json.dumps({"detail": "Server busy, retry later"}).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"retry-after", str(self.retry_after).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await limiter.release()
+
+
+async def admitted(
+    limiter: AdmissionLimiter,
+    chunks: AsyncGenerator[Union[str, bytes], None],
+    retry_after: int,
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """
+    Async generator that yields the chunks of a response once the request
+    is admitted by the limiter, for endpoints that only need a slot when
+    their response isn't served from a cache (see `app.main.cached_response`).
+    The chunks generator isn't started until the request is admitted, and
+    the slot is held until it's finished or closed.
+
+    A 503 HTTPException, with a Retry-After header, is raised if the request
+    isn't admitted.
+    """
+    async with aclosing(chunks):
+        with timed("queue"):
+            is_admitted = await limiter.acquire()
+        if not is_admitted:
+            raise HTTPException(
+                status_code=503,
+                detail="Server busy, retry later",
+                headers={"Retry-After": str(retry_after)},
+            )
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await limiter.release()
@@ -0,0 +1,76 @@
+"""
+Refreshes the table of waterbody observations summed by date
+(OBSERVATION_AGGREGATES_TABLE), which the observations handlers read from
+instead of aggregating the scene observations on every request. The table
+is created and populated by migration 5 (see app.schema).
+
+Usage (from the server folder, with the POSTGRES_* env vars set):
+
+    python -m app.aggregates refresh [--since YYYY-MM-DD]
+
+`refresh` should be run after new scenes are loaded into
+`waterbodies_observations`, it only re-aggregates the dates from
+`--since`, which defaults to the latest date already in the table (as that
+date may have been partially loaded). Observations loaded for earlier
+dates need an explicit `--since`.
+"""
+
+import argparse
+import logging
+from datetime import date
+from typing import Optional
+
+import psycopg
+from psycopg import sql
+
+from app.db import get_connection_str
+from app.queries import OBSERVATION_AGGREGATES_QUERY, OBSERVATION_AGGREGATES_TABLE
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_aggregates(conn: psycopg.Connection, since: Optional[date] = None) -> int:
+    """
+    Replaces the aggregated rows from the `since` date (inclusive) with sums
+    of the current scene observations, in a single transaction so readers
+    never see a partially refreshed table. Returns the number of rows
+    written.
+    """
+    table = sql.Identifier(OBSERVATION_AGGREGATES_TABLE)
+    with conn.transaction():
+        if since is None:
+            cur = conn.execute(sql.SQL("SELECT max(date) FROM {}").format(table))
+            since = cur.fetchone()[0] or date.min
+        logger.info(f"Refreshing {OBSERVATION_AGGREGATES_TABLE} from {since}")
+        conn.execute(
+            sql.SQL("DELETE FROM {} WHERE date >= {}").format(table, sql.Literal(since))
+        )
+        cur = conn.execute(
+            sql.SQL("INSERT INTO {} {}").format(
+                table, OBSERVATION_AGGREGATES_QUERY.sql()
+            ),
+            OBSERVATION_AGGREGATES_QUERY.values(since=since),
+        )
+        rowcount = cur.rowcount
+    # Keep the planner statistics up to date so the range scans are used
+    conn.execute(sql.SQL("ANALYZE {}").format(table))
+    return rowcount
+
+
+def main(args: argparse.Namespace) -> None:
+    with psycopg.connect(get_connection_str(), autocommit=True) as conn:
+        rowcount = refresh_aggregates(conn, args.since)
+        logger.info(f"Wrote {rowcount} rows to {OBSERVATION_AGGREGATES_TABLE}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["refresh"])
+    parser.add_argument(
+        "--since",
+        type=date.fromisoformat,
+        help="re-aggregate observations from this date, defaults to the "
+        "latest date in the table",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,323 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import (
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from fastapi import HTTPException
+
+# Result of an in-flight fetch that is shared with the requests waiting for
+# it. The value, None if the fetch failed (eg; the client disconnected), or
+# the HTTPException it raised (eg; not found).
+InFlightResult = Union[bytes, None, HTTPException]
+
+
+class SharedStream:
+    """
+    The chunks of a response, fetched by a background task and read by
+    every request for the same response that arrived while it was in
+    flight. Each reader is sent every chunk from the start, at its own
+    pace, so a response is only queried once however many requests are
+    waiting for it.
+
+    Chunks are kept until the body is complete, or until it's larger than
+    `max_bytes`. After that no more readers can join, the chunks that every
+    reader has been sent are dropped, and the task waits for the slowest
+    reader before fetching more. The task is cancelled as soon as every
+    reader has gone (eg; their clients disconnected), which closes the
+    chunks generator and so cancels its query.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.joinable = True
+        self._chunks: List[bytes] = []
+        # index (in the whole response) of the first chunk that's kept, and
+        # of the next chunk to send each reader
+        self._first = 0
+        self._readers: Dict[object, int] = {}
+        self._buffered = 0
+        self._complete = False
+        self._error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(
+        self,
+        chunks: AsyncGenerator[Union[str, bytes], None],
+        on_finish: Callable[[Optional[bytes]], None],
+    ) -> None:
+        """
+        Starts fetching the chunks, `on_finish` is called with the whole
+        body once it's complete, or None if it's incomplete or too large
+        """
+        self._task = asyncio.create_task(self._fetch(chunks, on_finish))
+
+    async def read(self) -> AsyncGenerator[bytes, None]:
+        """
+        Async generator that yields every chunk of the response, then
+        raises the exception it failed with, if any (eg; not found)
+        """
+        reader = object()
+        self._readers[reader] = self._first
+        try:
+            while True:
+                index = self._readers[reader]
+                if index < self._first + len(self._chunks):
+                    self._readers[reader] = index + 1
+                    chunk = self._chunks[index - self._first]
+                    if not self.joinable:
+                        self._trim()
+                        self._notify()
+                    yield chunk
+                elif self._error is not None:
+                    raise self._error
+                elif self._complete:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            del self._readers[reader]
+            # Nobody is reading the response any more, so stop its query
+            # rather than waiting for the next chunk to notice
+            if not self._readers and self._task is not None and not self._task.done():
+                self.joinable = False
+                self._task.cancel()
+            self._trim()
+            self._notify()
+
+    async def _fetch(
+        self,
+        chunks: AsyncGenerator[Union[str, bytes], None],
+        on_finish: Callable[[Optional[bytes]], None],
+    ) -> None:
+        try:
+            async with aclosing(chunks):
+                async for chunk in chunks:
+                    # chunks are copied as the data of a memoryview (eg; from
+                    # COPY) is only valid until the next chunk is read
+                    data = chunk.encode() if isinstance(chunk, str) else bytes(chunk)
+                    self._chunks.append(data)
+                    self.size += len(data)
+                    self._buffered += len(data)
+                    if self.size > self.max_bytes:
+                        self.joinable = False
+                        self._trim()
+                    self._notify()
+                    while self._buffered > self.max_bytes:
+                        await self._changed.wait()
+            self._complete = True
+        except Exception as e:
+            self._error = e
+        except BaseException as e:
+            self._error = e
+            raise
+        finally:
+            self.joinable = False
+            self._notify()
+            on_finish(
+                b"".join(self._chunks)
+                if self._complete and self.size <= self.max_bytes
+                else None
+            )
+
+    def _trim(self) -> None:
+        """Drops the chunks every reader has been sent, once the response is
+        too large to be kept whole"""
+        if self.joinable:
+            return
+        first = min(self._readers.values(), default=self._first + len(self._chunks))
+        sent = self._chunks[: first - self._first]
+        if sent:
+            self._buffered -= sum(len(chunk) for chunk in sent)
+            del self._chunks[: len(sent)]
+            self._first = first
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+class ResponseCache:
+    """
+    Bounded in-process cache of response bodies, with single-flight
+    request coalescing. The cache is bounded by the total size of the
+    cached bodies, the least recently used bodies are evicted first, and
+    bodies expire after `ttl` seconds.
+
+    Only one request for a key queries the database at a time. Requests
+    for a key that is being fetched wait for the in-flight request and
+    share its result, or are streamed its chunks (see `stream`), rather
+    than each checking out a pooled connection to run the same query.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.size_bytes = 0
+        self._entries: OrderedDict[Hashable, Tuple[float, bytes]] = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, SharedStream] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.uncacheable = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        if len(value) > self.max_entry_bytes:
+            self.uncacheable += 1
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic(), value)
+        self.size_bytes += len(value)
+        while self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+        self.size_bytes = 0
+        self.invalidations += 1
+
+    async def wait(self, key: Hashable) -> Optional[bytes]:
+        """
+        Waits for the in-flight request for the key (if there is one) and
+        returns its value. Returns None if there isn't a request in flight,
+        or it failed, in which case the caller should make the request
+        itself. The HTTPException of a failed request is
+        raised for all of the requests that waited for it.
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            return None
+        # Shielded so a waiting request that is cancelled doesn't cancel the
+        # result for all of the others
+        result = await asyncio.shield(future)
+        if isinstance(result, HTTPException):
+            raise result
+        if result is not None:
+            self.coalesced += 1
+        return result
+
+    async def fetch(
+        self, key: Hashable, fetch: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        """
+        Returns the cached value for the key, otherwise the value of the
+        in-flight fetch for the key, otherwise fetches and caches the value.
+        """
+        value = self.get(key)
+        if value is None:
+            value = await self.wait(key)
+        if value is not None:
+            return value
+
+        future = self._start(key)
+        try:
+            value = await fetch()
+        except HTTPException as e:
+            self._finish(key, future, e)
+            raise
+        except BaseException:
+            self._finish(key, future, None)
+            raise
+        self.put(key, value)
+        self._finish(key, future, value)
+        return value
+
+    def stream(
+        self, key: Hashable, chunks: AsyncGenerator[Union[str, bytes], None]
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Async generator that yields the chunks of a response as they are
+        fetched, and caches the whole body once it's complete. Requests for
+        the same key that arrive while it's in flight are streamed the same
+        chunks (see `SharedStream`), and their own generators are closed
+        without being started. Bodies larger than `max_entry_bytes` are
+        streamed without being cached.
+        """
+        shared = self._streams.get(key)
+        if shared is not None and shared.joinable:
+            self.coalesced += 1
+            return self._follow(shared, chunks)
+        shared = SharedStream(self.max_entry_bytes)
+        self._streams[key] = shared
+        shared.start(chunks, lambda body: self._finish_stream(key, shared, body))
+        return shared.read()
+
+    async def _follow(
+        self, shared: SharedStream, chunks: AsyncGenerator[Union[str, bytes], None]
+    ) -> AsyncGenerator[bytes, None]:
+        await chunks.aclose()
+        async with aclosing(shared.read()) as reader:
+            async for chunk in reader:
+                yield chunk
+
+    def _finish_stream(
+        self, key: Hashable, shared: SharedStream, body: Optional[bytes]
+    ) -> None:
+        if body is None and shared.size > self.max_entry_bytes:
+            self.uncacheable += 1
+        elif body is not None:
+            self.put(key, body)
+        if self._streams.get(key) is shared:
+            del self._streams[key]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "uncacheable": self.uncacheable,
+            "invalidations": self.invalidations,
+            "in_flight": len(self._in_flight) + len(self._streams),
+        }
+
+    def _start(self, key: Hashable) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        return future
+
+    def _finish(
+        self, key: Hashable, future: asyncio.Future, result: InFlightResult
+    ) -> None:
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.done():
+            future.set_result(result)
+
+    def _remove(self, key: Hashable) -> None:
+        _, value = self._entries.pop(key)
+        self.size_bytes -= len(value)
@@ -0,0 +1,145 @@
+import zlib
+from typing import List, Optional
+
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Media types that are compressed, other types are either small or already
+# compressed (eg; Parquet)
+COMPRESSIBLE_MEDIA_TYPES = [
+    "text/",
+    "application/json",
+    "application/geo+json",
+    "application/x-ndjson",
+    "application/vnd.apache.arrow.stream",
+    "application/vnd.mapbox-vector-tile",
+]
+
+
+class Compressor:
+    """
+    Incremental gzip or zstd compressor. Each call to `compress` returns
+    all of the compressed data for the given data, so it can be decoded by
+    the client as soon as it's received, rather than being held back in
+    the compressor's buffer until more data is written.
+    """
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self._zstd = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes, end: bool = False) -> bytes:
+        if self.encoding == "gzip":
+            mode = zlib.Z_FINISH if end else zlib.Z_SYNC_FLUSH
+            return self._zlib.compress(data) + self._zlib.flush(mode)
+        mode = (
+            zstandard.COMPRESSOBJ_FLUSH_FINISH
+            if end
+            else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+        return self._zstd.compress(data) + self._zstd.flush(mode)
+
+
+def negotiate_encoding(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """
+    Returns the encoding from `encodings` (in order of preference) with the
+    highest quality in the Accept-Encoding header, or None if none of them
+    are acceptable.
+    """
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware that compresses responses with gzip or zstd, based on
+    the request's Accept-Encoding header.
+
+    Streamed responses are compressed a message at a time, and every
+    message is flushed so the client receives each chunk as soon as it's
+    sent (see `app.streaming.buffered`). Responses with a single message
+    smaller than `minimum_size` bytes (eg; waterbody metadata) aren't
+    compressed, as this saves little but adds the compression overhead.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        encodings: List[str],
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        zstd_level: int = 3,
+    ):
+        self.app = app
+        self.encodings = encodings
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": gzip_level, "zstd": zstd_level}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(
+            Headers(scope=scope).get("Accept-Encoding", ""), self.encodings
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        compressor: Optional[Compressor] = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                # Not sent until the first body message, as the headers depend
+                # on whether the response is compressed
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                compressible = "content-encoding" not in headers and any(
+                    headers.get("content-type", "").startswith(media_type)
+                    for media_type in COMPRESSIBLE_MEDIA_TYPES
+                )
+                if compressible:
+                    headers.add_vary_header("Accept-Encoding")
+                if compressible and (more_body or len(body) >= self.minimum_size):
+                    compressor = Compressor(encoding, self.levels[encoding])
+                    headers["Content-Encoding"] = encoding
+                    del headers["Content-Length"]
+                await send(start_message)
+                start_message = None
+
+            if compressor is not None:
+                message["body"] = compressor.compress(body, end=not more_body)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -1,7 +1,31 @@
+import asyncio
+import logging
 import os
+import random
+import time
 from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import psycopg
 from fastapi import FastAPI
-from psycopg_pool import AsyncConnectionPool
+from prometheus_client import REGISTRY
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+from app.cache import ResponseCache
+from app.lookup import GeometryCache, WaterbodyIndex, listen_for_invalidation
+from app.metrics import POOL_CHECKOUT_WAIT, AppCollector
+from app.queries import (
+    OBSERVATION_AGGREGATES_TABLE,
+    OBSERVATIONS_AGGREGATED_VERSION_QUERY,
+    PREPARED_STATEMENTS,
+    WATERBODIES_QUERY,
+)
+from app.schema import missing_indexes
+from app.streaming import fetch_batches
+from app.timing import timed
+
+logger = logging.getLogger(__name__)
 
 
 def get_connection_str() -> str:
@@ -20,8 +44,381 @@ def get_connection_str() -> str:
     )
 
 
+def get_replica_connection_strs() -> List[str]:
+    """
+    Returns the connection strings of the read replicas, from the
+    POSTGRES_REPLICAS env var. This is a `;` separated list of connection
+    strings (either keyword=value lists or postgresql:// URIs).
+    """
+    replicas = os.getenv("POSTGRES_REPLICAS", "")
+    return [replica.strip() for replica in replicas.split(";") if replica.strip()]
+
+
+def get_pool_settings() -> Dict[str, Any]:
+    """
+    Returns the settings of the connection pool from the POOL_* env vars,
+    see https://www.psycopg.org/psycopg3/docs/api/pool.html for details of
+    each. The STATEMENT_TIMEOUT env var (in milliseconds, 0 for no timeout)
+    is set on each of the pool's connections, so a slow query doesn't hold
+    a pooled connection indefinitely.
+    """
+    max_size = os.getenv("POOL_MAX_SIZE")
+    return dict(
+        min_size=int(os.getenv("POOL_MIN_SIZE", "4")),
+        max_size=int(max_size) if max_size else None,
+        timeout=float(os.getenv("POOL_TIMEOUT", "30")),
+        max_waiting=int(os.getenv("POOL_MAX_WAITING", "0")),
+        max_idle=float(os.getenv("POOL_MAX_IDLE", "600")),
+        max_lifetime=float(os.getenv("POOL_MAX_LIFETIME", "3600")),
+        kwargs=dict(
+            options=f"-c statement_timeout={int(os.getenv('STATEMENT_TIMEOUT', '0'))}"
+        ),
+    )
+
+
+class MeteredConnectionPool(AsyncConnectionPool):
+    """Connection pool that records how long each request waits for a
+    connection (POOL_CHECKOUT_WAIT)"""
+
+    async def getconn(self, timeout: Optional[float] = None) -> AsyncConnection:
+        with POOL_CHECKOUT_WAIT.time():
+            return await super().getconn(timeout=timeout)
+
+
+async def check_database_connection(conn: AsyncConnection) -> None:
+    """
+    Runs a very simple select statement to check the database is
+    connected, raises a psycopg.Error if it isn't
+    """
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT 1")
+        await cur.fetchall()
+
+
+class PoolRouter:
+    """
+    Routes requests for connections across a pool for each read replica,
+    choosing the healthy replica with the fewest connections checked out
+    (least outstanding requests), ties are broken randomly. The primary's
+    pool is only used if there are no replicas, or none are healthy.
+
+    Replicas are ejected when a health probe (see `probe`) fails, or a
+    connection can't be checked out of their pool, and are returned to
+    rotation once a probe succeeds.
+    """
+
+    def __init__(
+        self, primary: AsyncConnectionPool, replicas: List[AsyncConnectionPool]
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.pools = {pool.name: pool for pool in [primary] + replicas}
+        self.outstanding = {name: 0 for name in self.pools}
+        self.healthy = {pool.name: True for pool in replicas}
+
+    def select(self) -> AsyncConnectionPool:
+        healthy = [replica for replica in self.replicas if self.healthy[replica.name]]
+        if not healthy:
+            return self.primary
+        return min(
+            healthy, key=lambda pool: (self.outstanding[pool.name], random.random())
+        )
+
+    @asynccontextmanager
+    async def connection(
+        self, timeout: Optional[float] = None
+    ) -> AsyncIterator[AsyncConnection]:
+        """Context manager to obtain a connection from the selected pool, with
+        the same behaviour as `AsyncConnectionPool.connection`"""
+        pool = self.select()
+        with timed("pool"):
+            try:
+                conn = await pool.getconn(timeout=timeout)
+            except (PoolTimeout, psycopg.OperationalError) as e:
+                if pool is self.primary:
+                    raise
+                self.eject(pool, e)
+                pool = self.select()
+                conn = await pool.getconn(timeout=timeout)
+
+        self.outstanding[pool.name] += 1
+        try:
+            async with conn:
+                yield conn
+        finally:
+            self.outstanding[pool.name] -= 1
+            await pool.putconn(conn)
+
+    def eject(self, replica: AsyncConnectionPool, error: Exception) -> None:
+        if self.healthy[replica.name]:
+            logger.warning(f"Ejecting replica {replica.name}: {error}")
+        self.healthy[replica.name] = False
+
+    async def probe(self, interval: float, timeout: float) -> None:
+        """
+        Checks the connection to every replica every `interval` seconds,
+        ejecting replicas that fail or take longer than `timeout` seconds.
+        Runs until cancelled.
+        """
+        while True:
+            for replica in self.replicas:
+                try:
+                    async with asyncio.timeout(timeout):
+                        async with replica.connection() as conn:
+                            await check_database_connection(conn)
+                except (asyncio.TimeoutError, PoolTimeout, psycopg.Error) as e:
+                    self.eject(replica, e)
+                    continue
+                if not self.healthy[replica.name]:
+                    logger.info(f"Replica {replica.name} is healthy")
+                self.healthy[replica.name] = True
+            await asyncio.sleep(interval)
+
+    async def fill(self, timeout: float) -> List[str]:
+        """
+        Waits up to `timeout` seconds for every pool to open its `min_size`
+        connections. Returns the names of the pools that weren't filled in
+        time. Unlike `AsyncConnectionPool.wait` the pools aren't closed if
+        this times out, so they keep trying to connect.
+        """
+        deadline = time.monotonic() + timeout
+        pending = list(self.pools.values())
+        while True:
+            pending = [
+                pool
+                for pool in pending
+                if pool.get_stats()["pool_available"] < pool.min_size
+            ]
+            if not pending or time.monotonic() >= deadline:
+                return [pool.name for pool in pending]
+            await asyncio.sleep(0.05)
+
+    async def close(self) -> None:
+        for pool in self.pools.values():
+            await pool.close()
+
+
+async def has_table(pool: PoolRouter, table: str) -> bool:
+    async with pool.connection() as conn:
+        cur = await conn.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+        (exists,) = await cur.fetchone()
+        return exists
+
+
+async def preload_waterbody_index(pool: PoolRouter, index: WaterbodyIndex) -> int:
+    """Loads the metadata of every waterbody (up to the index's max size)
+    into the waterbody index, returns the number of waterbodies loaded"""
+    loaded = 0
+    async with pool.connection() as conn:
+        async with conn.cursor(name="preload_waterbody_index") as cursor:
+            async for rows in fetch_batches(
+                cursor,
+                WATERBODIES_QUERY.sql(),
+                WATERBODIES_QUERY.values(limit=index.max_size),
+            ):
+                for row in rows:
+                    index.put(row[1], row)
+                loaded += len(rows)
+    return loaded
+
+
+# Parameter values the statements are prepared with, these don't match any
+# rows (the tile is in the far north at the highest zoom level) so preparing
+# a statement costs little more than planning it
+PREPARE_PARAMS = dict(wb_id=0, uid="", tolerance=0.0, precision=9, z=24, x=0, y=0)
+
+
+async def prepare_statements(
+    pool: PoolRouter, timeout: float, skip: Optional[List[str]] = None
+) -> int:
+    """
+    Prepares each of the `PREPARED_STATEMENTS` (apart from those named in
+    `skip`) on every connection in every pool, so the first request on each
+    connection doesn't pay for planning them. The pools' `min_size`
+    connections are all checked out at once so each is a different
+    connection. Returns the number of connections prepared, statements that
+    fail (eg; a missing table) are logged and skipped.
+    """
+    statements = [s for s in PREPARED_STATEMENTS if s.name not in (skip or [])]
+    prepared = 0
+    for name, conn_pool in pool.pools.items():
+        conns = []
+        try:
+            for _ in range(conn_pool.min_size):
+                conns.append(await conn_pool.getconn(timeout=timeout))
+            for conn in conns:
+                for statement in statements:
+                    try:
+                        async with conn.transaction(), conn.cursor() as cur:
+                            await statement.execute(cur, **PREPARE_PARAMS)
+                            await cur.fetchall()
+                    except psycopg.Error as e:
+                        logger.warning(
+                            f"Failed to prepare {statement.name} on {name}: {e}"
+                        )
+                prepared += 1
+        except (PoolTimeout, psycopg.Error) as e:
+            logger.warning(f"Failed to prepare statements on {name}: {e}")
+        finally:
+            for conn in conns:
+                await conn_pool.putconn(conn)
+    return prepared
+
+
+async def prewarm(app: FastAPI, timeout: float, listening: asyncio.Event) -> None:
+    """
+    Warms up the app before it's reported as ready (see `/ready`), so the
+    first requests routed to a new instance don't pay for opening
+    connections, loading waterbody metadata and preparing statements. Each
+    phase is timed and logged, and the timings are kept in
+    `app.startup_timings`. A phase that fails or times out is logged, and
+    the app is still marked as ready so an instance isn't held out of
+    service by, eg; a missing table.
+    """
+    start = time.perf_counter()
+
+    phase_start = time.perf_counter()
+    unfilled = await app.async_pool.fill(timeout)
+    if unfilled:
+        logger.warning(f"Pools not filled after {timeout}s: {', '.join(unfilled)}")
+    app.startup_timings["pools"] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
+    try:
+        # Preloaded entries would be cleared when the invalidation listener
+        # first connects, so it's waited for first
+        await asyncio.wait_for(listening.wait(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Waterbody index listener not connected, preloading anyway")
+    try:
+        loaded = await preload_waterbody_index(app.async_pool, app.waterbody_index)
+        logger.info(f"Preloaded {loaded} waterbodies into the waterbody index")
+    except (PoolTimeout, psycopg.Error) as e:
+        logger.warning(f"Failed to preload the waterbody index: {e}")
+    app.startup_timings["waterbody_index"] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
+    skip = []
+    if not app.observation_aggregates:
+        skip.append(OBSERVATIONS_AGGREGATED_VERSION_QUERY.name)
+    prepared = await prepare_statements(app.async_pool, timeout, skip)
+    logger.info(f"Prepared statements on {prepared} pooled connections")
+    app.startup_timings["statements"] = time.perf_counter() - phase_start
+
+    app.startup_timings["total"] = time.perf_counter() - start
+    logger.info(
+        "Prewarm finished: "
+        + ", ".join(f"{phase} {t:.3f}s" for phase, t in app.startup_timings.items())
+    )
+    app.ready = True
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.async_pool = AsyncConnectionPool(conninfo=get_connection_str())
+    # Reads are routed across the replicas (if any), the primary connection
+    # string is still used for LISTEN and by the management commands
+    app.async_pool = PoolRouter(
+        primary=MeteredConnectionPool(
+            conninfo=get_connection_str(),
+            name="primary",
+            **get_pool_settings(),
+        ),
+        replicas=[
+            MeteredConnectionPool(
+                conninfo=conninfo,
+                name=f"replica-{i}",
+                **get_pool_settings(),
+            )
+            for i, conninfo in enumerate(get_replica_connection_strs())
+        ],
+    )
+    replica_probe = asyncio.create_task(
+        app.async_pool.probe(
+            interval=float(os.getenv("REPLICA_PROBE_INTERVAL", "5")),
+            timeout=float(os.getenv("REPLICA_PROBE_TIMEOUT", "2")),
+        )
+    )
+
+    # Observations are read from the daily aggregates table if it has been
+    # created (see app.schema), unless disabled by OBSERVATION_AGGREGATES.
+    # The server still starts if the database can't be reached, falling back
+    # to summing the scene observations
+    app.observation_aggregates = False
+    if os.getenv("OBSERVATION_AGGREGATES", "true").lower() == "true":
+        try:
+            app.observation_aggregates = await has_table(
+                app.async_pool, OBSERVATION_AGGREGATES_TABLE
+            )
+        except (PoolTimeout, psycopg.Error) as e:
+            logger.error(f"Failed to check for {OBSERVATION_AGGREGATES_TABLE}: {e}")
+    logger.info(f"Observation aggregates enabled: {app.observation_aggregates}")
+
+    # The queries rely on the indexes created by the migrations, without
+    # them they fall back to sequential scans of the observation tables
+    try:
+        async with app.async_pool.connection() as conn:
+            missing = await missing_indexes(conn)
+        if missing:
+            logger.warning(
+                f"Missing indexes: {', '.join(missing)}, "
+                "run `python -m app.migrations upgrade` to create them"
+            )
+    except (PoolTimeout, psycopg.Error) as e:
+        logger.warning(f"Failed to check indexes: {e}")
+
+    # wb_id -> (uid, wb_id, area_m2) lookups shared by all the handlers,
+    # invalidated when a notification is sent on WATERBODY_INDEX_CHANNEL
+    app.waterbody_index = WaterbodyIndex(
+        max_size=int(os.getenv("WATERBODY_INDEX_MAX_SIZE", "1000000")),
+        ttl=float(os.getenv("WATERBODY_INDEX_TTL", "86400")),
+    )
+    # Serialized GeoJSON of waterbody geometries, these change at the same
+    # time as the index so are invalidated with it
+    app.geometry_cache = GeometryCache(
+        max_bytes=int(os.getenv("GEOMETRY_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+    )
+    # Response bodies of hot waterbodies, concurrent requests for the same
+    # response share a single query
+    app.response_cache = ResponseCache(
+        max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "60")),
+        max_entry_bytes=int(
+            os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(16 * 1024 * 1024))
+        ),
+    )
+    listening = asyncio.Event()
+    index_listener = asyncio.create_task(
+        listen_for_invalidation(
+            [app.waterbody_index, app.geometry_cache, app.response_cache],
+            get_connection_str(),
+            os.getenv("WATERBODY_INDEX_CHANNEL", "waterbody_index"),
+            listening,
+        )
+    )
+
+    # The app is ready once prewarmed (if enabled), this runs in the
+    # background so /check-connection is answered while /ready isn't
+    app.ready = False
+    app.startup_timings = {}
+    prewarm_task = None
+    if os.getenv("PREWARM", "false").lower() == "true":
+        prewarm_task = asyncio.create_task(
+            prewarm(app, float(os.getenv("PREWARM_TIMEOUT", "30")), listening)
+        )
+    else:
+        app.ready = True
+
+    # Pool and cache stats are read when /metrics is requested
+    collector = AppCollector(app)
+    REGISTRY.register(collector)
+
     yield
+
+    # Reported as not ready while shutting down
+    app.ready = False
+    if prewarm_task is not None:
+        prewarm_task.cancel()
+    REGISTRY.unregister(collector)
+    index_listener.cancel()
+    replica_probe.cancel()
     await app.async_pool.close()
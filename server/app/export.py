@@ -0,0 +1,408 @@
+"""
+Exports whole datasets (the rows of every waterbody) as NDJSON or Parquet,
+so the dataset can be mirrored without requesting each waterbody in turn.
+
+Usage (from the server folder, with the POSTGRES_* env vars set):
+
+    python -m app.export observations --format parquet --partition year
+    python -m app.export water_quality --updated-since 2024-01-01 --output /data/incremental
+
+Each partition is written to its own file in the `--output` folder, eg;
+`observations/year=2023.parquet`, or `extents/uid_prefix=r.ndjson` when
+partitioned by the first character of the uid (a geohash). Files are
+written to a temporary file that replaces the partition's file once
+complete, so a mirror never reads a partial export.
+
+The rows are read by a single server-side cursor ordered by partition,
+FETCH_SIZE rows at a time, so memory use doesn't depend on the size of the
+dataset. The same exports are streamed (a partition at a time) by the
+`/export/{dataset}/{format}` handler.
+
+The tables don't record when rows were modified, so `--updated-since`
+filters dated datasets by the observation date. The observation
+aggregates are refreshed from the latest date already aggregated (see
+app.aggregates), so incremental exports should start from the last date
+of the previous export. Partition files of an incremental export only
+include the rows since that date, so they should be written to a
+different folder than the full export.
+"""
+
+import argparse
+import itertools
+import logging
+import os
+from datetime import date
+from enum import Enum
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import psycopg
+import pyarrow as pa
+from psycopg import sql
+
+from app.db import get_connection_str
+from app.formats import ColumnarFormat, ColumnarWriter
+from app.queries import (
+    OBSERVATION_AGGREGATES_QUERY,
+    OBSERVATION_AGGREGATES_TABLE,
+    WQ_COLUMNS,
+    WQ_RANKING_COLUMNS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Number of rows fetched from the database at a time, each batch is written
+# as a Parquet row group
+FETCH_SIZE = 10000
+
+# Characters of the geohash uids, in order, the uid partitions are the
+# ranges of uids starting with each character
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+class ExportDataset(str, Enum):
+    observations = "observations"
+    water_quality = "water_quality"
+    water_quality_rankings = "water_quality_rankings"
+    extents = "extents"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    parquet = "parquet"
+
+
+class Partition(str, Enum):
+    year = "year"
+    uid = "uid"
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.parquet: "application/vnd.apache.parquet",
+}
+
+
+class Dataset(NamedTuple):
+    """
+    An exported dataset, the query that selects its rows and the schema of
+    its columns. Dated datasets have a `date` column, so can be filtered
+    and partitioned by date.
+    """
+
+    query: str
+    schema: pa.Schema
+    dated: bool = True
+
+
+EXPORT_DATASETS = {
+    # Daily sums of the scene observations, as read by the observations
+    # handlers
+    ExportDataset.observations: Dataset(
+        query=f"""
+        SELECT uid, date, area_wet_m2, area_dry_m2, area_invalid_m2, area_observed_m2
+        FROM {OBSERVATION_AGGREGATES_TABLE}
+        """,
+        schema=pa.schema(
+            [("uid", pa.string()), ("date", pa.timestamp("us"))]
+            + [
+                (col, pa.float64())
+                for col in [
+                    "area_wet_m2",
+                    "area_dry_m2",
+                    "area_invalid_m2",
+                    "area_observed_m2",
+                ]
+            ]
+        ),
+    ),
+    ExportDataset.water_quality: Dataset(
+        query=f"""
+        SELECT uid, date, {", ".join(WQ_COLUMNS)}
+        FROM waterbodies_water_quality
+        """,
+        schema=pa.schema(
+            [("uid", pa.string()), ("date", pa.timestamp("us"))]
+            + [(col, pa.float64()) for col in WQ_COLUMNS]
+        ),
+    ),
+    ExportDataset.water_quality_rankings: Dataset(
+        query=f"""
+        SELECT uid, {", ".join(WQ_RANKING_COLUMNS)}
+        FROM waterbodies_water_quality_percentiles
+        """,
+        schema=pa.schema(
+            [("uid", pa.string())] + [(col, pa.float64()) for col in WQ_RANKING_COLUMNS]
+        ),
+        dated=False,
+    ),
+    # Geometries are exported as GeoJSON, an object in NDJSON or text in
+    # Parquet
+    ExportDataset.extents: Dataset(
+        query="""
+        SELECT uid, wb_id, area_m2, ST_AsGeoJSON(geometry)::json AS geometry
+        FROM waterbodies_historical_extent
+        """,
+        schema=pa.schema(
+            [
+                ("uid", pa.string()),
+                ("wb_id", pa.int64()),
+                ("area_m2", pa.float64()),
+                ("geometry", pa.string()),
+            ]
+        ),
+        dated=False,
+    ),
+}
+
+# Expressions of the partition key of each row, the rows are ordered by
+# the partition so each partition's rows are read together
+PARTITION_KEYS = {
+    None: "NULL",
+    Partition.year: "extract(year FROM q.date)::integer",
+    Partition.uid: "left(q.uid, 1)",
+}
+
+
+def export_query(
+    dataset: ExportDataset,
+    format: ExportFormat,
+    aggregated: bool,
+    partition: Optional[Partition] = None,
+    year: Optional[int] = None,
+    uid_prefix: Optional[str] = None,
+    updated_since: Optional[date] = None,
+) -> Tuple[sql.Composed, Dict[str, Any]]:
+    """
+    Returns the query that exports a dataset, or one partition of it, and
+    its parameters.
+
+    Parameters
+    ----------
+    dataset : ExportDataset
+        Dataset to export.
+    format : ExportFormat
+        For NDJSON each row is formatted as a JSON object by postgres,
+        otherwise the columns of the dataset's schema are returned.
+    aggregated : bool
+        Whether the observation aggregates table exists, if not the
+        observations are summed from the scene observations.
+    partition : Optional[Partition]
+        Rows are ordered by this partition, and their partition key
+        returned.
+    year : Optional[int]
+        Only export rows dated in this year.
+    uid_prefix : Optional[str]
+        Only export rows of waterbodies with uids starting with this
+        character (of GEOHASH_ALPHABET).
+    updated_since : Optional[date]
+        Only export rows dated on or after this date.
+
+    Returns
+    -------
+    Tuple[sql.Composed, Dict[str, Any]]
+        Query returning the partition key (NULL if not partitioned)
+        followed by the NDJSON line or the columns of each row, and the
+        parameters it's executed with. Raises a
+        ValueError if a dataset without dates is filtered or partitioned
+        by date.
+    """
+    definition = EXPORT_DATASETS[dataset]
+    if not definition.dated and (
+        partition == Partition.year or year is not None or updated_since is not None
+    ):
+        raise ValueError(
+            f"{dataset.value} isn't dated, so can't be filtered or partitioned by date"
+        )
+    params: Dict[str, Any] = {}
+    if dataset == ExportDataset.observations and not aggregated:
+        source = OBSERVATION_AGGREGATES_QUERY.sql()
+        params = OBSERVATION_AGGREGATES_QUERY.values(since=updated_since or date.min)
+    else:
+        source = sql.SQL(definition.query)
+
+    # The date filters are constants, so only the matching partitions of
+    # the tables partitioned by year are scanned (see app.schema)
+    conditions: List[sql.Composable] = []
+    if year is not None:
+        conditions.append(
+            sql.SQL("q.date >= {} AND q.date < {}").format(
+                sql.Literal(date(year, 1, 1)), sql.Literal(date(year + 1, 1, 1))
+            )
+        )
+    if updated_since is not None:
+        conditions.append(sql.SQL("q.date >= {}").format(sql.Literal(updated_since)))
+    if uid_prefix is not None:
+        conditions.append(sql.SQL("q.uid >= {}").format(sql.Literal(uid_prefix)))
+        following = GEOHASH_ALPHABET.index(uid_prefix) + 1
+        if following < len(GEOHASH_ALPHABET):
+            conditions.append(
+                sql.SQL("q.uid < {}").format(sql.Literal(GEOHASH_ALPHABET[following]))
+            )
+
+    if format == ExportFormat.ndjson:
+        columns = sql.SQL("row_to_json(q)::text")
+    else:
+        columns = sql.SQL(", ").join(
+            sql.SQL(
+                f"q.{field.name}::text"
+                if field.type == pa.string()
+                else f"q.{field.name}"
+            )
+            for field in definition.schema
+        )
+    order = ["q.uid", "q.date"] if definition.dated else ["q.uid"]
+    if partition == Partition.year:
+        order = ["q.date", "q.uid"]
+    query = sql.SQL("SELECT {}, {} FROM ({}) AS q {} ORDER BY {}").format(
+        sql.SQL(PARTITION_KEYS[partition]),
+        columns,
+        source,
+        (
+            sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions)
+            if conditions
+            else sql.SQL("")
+        ),
+        sql.SQL(", ".join(order)),
+    )
+    return query, params
+
+
+class ExportWriter:
+    """
+    Writes batches of rows returned by an export query as NDJSON lines, or
+    Parquet row groups. As with ColumnarWriter, each method returns the
+    bytes that have been written since it was last called.
+    """
+
+    def __init__(self, dataset: ExportDataset, format: ExportFormat):
+        self._writer = None
+        if format == ExportFormat.parquet:
+            self._writer = ColumnarWriter(
+                EXPORT_DATASETS[dataset].schema, ColumnarFormat.parquet
+            )
+
+    def start(self) -> bytes:
+        return self._writer.start() if self._writer else b""
+
+    def write(self, rows: List[Tuple]) -> bytes:
+        # the first column of each row is its partition key
+        if self._writer is None:
+            return "".join(row[1] + "\n" for row in rows).encode()
+        return self._writer.write([row[1:] for row in rows])
+
+    def close(self) -> bytes:
+        return self._writer.close() if self._writer else b""
+
+
+def partition_path(
+    dataset: ExportDataset,
+    format: ExportFormat,
+    partition: Optional[Partition],
+    key: Optional[str],
+) -> Path:
+    """Path of a partition's file, relative to the output folder"""
+    if partition is None:
+        return Path(f"{dataset.value}.{format.value}")
+    name = "year" if partition == Partition.year else "uid_prefix"
+    return Path(dataset.value) / f"{name}={key}.{format.value}"
+
+
+class ExportFile:
+    """
+    A partition's file, written to a temporary file that replaces the
+    partition's file when it's closed
+    """
+
+    def __init__(self, path: Path, writer: ExportWriter):
+        self.path = path
+        self.rows = 0
+        self._writer = writer
+        self._temp_path = path.with_name(path.name + ".tmp")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self._temp_path, "wb")
+        self._file.write(writer.start())
+
+    def write(self, rows: List[Tuple]) -> None:
+        self._file.write(self._writer.write(rows))
+        self.rows += len(rows)
+
+    def close(self) -> None:
+        self._file.write(self._writer.close())
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+        logger.info(f"Exported {self.rows} rows to {self.path}")
+
+
+def export(
+    conn: psycopg.Connection,
+    dataset: ExportDataset,
+    format: ExportFormat,
+    output: Path,
+    partition: Optional[Partition] = None,
+    updated_since: Optional[date] = None,
+) -> List[Path]:
+    """
+    Exports a dataset to a file for each partition in the output folder,
+    using a single server-side cursor. Returns the paths of the files
+    written.
+    """
+    aggregated = conn.execute(
+        "SELECT to_regclass(%s) IS NOT NULL", (OBSERVATION_AGGREGATES_TABLE,)
+    ).fetchone()[0]
+    query, params = export_query(
+        dataset, format, aggregated, partition, updated_since=updated_since
+    )
+    paths: List[Path] = []
+    file: Optional[ExportFile] = None
+    with conn.transaction():
+        with conn.cursor(name="export") as cursor:
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(FETCH_SIZE):
+                for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+                    path = output / partition_path(dataset, format, partition, key)
+                    if file is None or file.path != path:
+                        if file is not None:
+                            file.close()
+                        file = ExportFile(path, ExportWriter(dataset, format))
+                        paths.append(path)
+                    file.write(list(group))
+    if file is not None:
+        file.close()
+    return paths
+
+
+def main(args: argparse.Namespace) -> None:
+    with psycopg.connect(get_connection_str(), autocommit=True) as conn:
+        paths = export(
+            conn,
+            ExportDataset(args.dataset),
+            ExportFormat(args.format),
+            Path(args.output),
+            Partition(args.partition) if args.partition else None,
+            args.updated_since,
+        )
+    logger.info(f"Exported {len(paths)} files")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("dataset", choices=[dataset.value for dataset in ExportDataset])
+    parser.add_argument(
+        "--format",
+        choices=[format.value for format in ExportFormat],
+        default=ExportFormat.parquet.value,
+    )
+    parser.add_argument(
+        "--partition",
+        choices=[partition.value for partition in Partition],
+        help="write a file for each year, or each first character of the uid",
+    )
+    parser.add_argument("--updated-since", type=date.fromisoformat)
+    parser.add_argument("--output", default="export", help="folder to write to")
+    args = parser.parse_args()
+    try:
+        main(args)
+    except ValueError as e:
+        parser.error(str(e))
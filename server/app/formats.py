@@ -0,0 +1,76 @@
+import io
+from enum import Enum
+from typing import List, Tuple
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from app.queries import OBSERVATION_COLUMNS
+
+
+class ColumnarFormat(str, Enum):
+    arrow = "arrow"
+    parquet = "parquet"
+
+
+MEDIA_TYPES = {
+    ColumnarFormat.arrow: "application/vnd.apache.arrow.stream",
+    ColumnarFormat.parquet: "application/vnd.apache.parquet",
+}
+
+
+def dated_schema(columns: List[str]) -> pa.Schema:
+    """Schema of a date column followed by float columns"""
+    return pa.schema(
+        [("date", pa.date32())] + [(column, pa.float64()) for column in columns]
+    )
+
+
+OBSERVATION_SCHEMA = dated_schema(OBSERVATION_COLUMNS[1:])
+
+
+class ColumnarWriter:
+    """
+    Writes batches of rows in either the Arrow IPC stream, or Parquet
+    format. Each method returns the bytes that have been written since it
+    was last called, so the output can be streamed as it's written, and only
+    a single batch of rows is held in memory.
+
+    Each batch of rows is written as an Arrow record batch, or a Parquet row
+    group.
+    """
+
+    def __init__(self, schema: pa.Schema, format: ColumnarFormat):
+        self.schema = schema
+        self._sink = io.BytesIO()
+        if format == ColumnarFormat.arrow:
+            self._writer = pa.ipc.new_stream(self._sink, schema)
+        else:
+            self._writer = pq.ParquetWriter(self._sink, schema, compression="zstd")
+
+    def start(self) -> bytes:
+        """Returns the bytes written when the writer was opened"""
+        return self._drain()
+
+    def write(self, rows: List[Tuple]) -> bytes:
+        """Writes a batch of rows, in the order of the schema columns"""
+        # values are converted to the column types after the arrays are
+        # created, as some may be returned as Decimal or all be None
+        arrays = [
+            pa.array(values).cast(field.type)
+            for values, field in zip(zip(*rows), self.schema)
+        ]
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        return self._drain()
+
+    def close(self) -> bytes:
+        """Finishes the stream (or Parquet footer) and returns the last bytes"""
+        self._writer.close()
+        return self._drain()
+
+    def _drain(self) -> bytes:
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
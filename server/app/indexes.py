@@ -0,0 +1,35 @@
+"""
+Creates the indexes that the API queries depend on, but that aren't part
+of the database dumps the tables are loaded from.
+
+Usage (from the server folder, with the POSTGRES_* env vars set):
+
+    python -m app.indexes create
+
+Indexes of plain tables are created concurrently, so this can be run
+against a database that is serving requests, and indexes that already
+exist are skipped. The indexes are also created by the migrations (see
+app.migrations), this recreates any that have been dropped since.
+"""
+
+import argparse
+import logging
+
+import psycopg
+
+from app.db import get_connection_str
+from app.schema import recreate_indexes
+
+logger = logging.getLogger(__name__)
+
+
+def main(args: argparse.Namespace) -> None:
+    with psycopg.connect(get_connection_str(), autocommit=True) as conn:
+        recreate_indexes(conn)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["create"])
+    main(parser.parse_args())
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import psycopg
+from psycopg import sql
+
+logger = logging.getLogger(__name__)
+
+# (uid, wb_id, area_m2) as returned by WATERBODY_QUERY
+WaterbodyRow = Tuple[str, int, float]
+
+
+class WaterbodyIndex:
+    """
+    Bounded in-memory index of wb_id to the (uid, wb_id, area_m2) row of
+    `waterbodies_historical_extent`. This table only changes when a new
+    historical extent product is loaded, so lookups can be answered from
+    memory rather than the database.
+
+    Waterbodies that don't exist are also indexed (as None) so repeated
+    requests for an unknown wb_id are also answered from memory. The least
+    recently used entries are evicted once `max_size` is reached, and
+    entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, Tuple[float, Optional[WaterbodyRow]]] = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, wb_id: int) -> Tuple[bool, Optional[WaterbodyRow]]:
+        """
+        Returns a tuple of whether the wb_id is in the index, and the
+        waterbody row (None if the waterbody doesn't exist)
+        """
+        entry = self._entries.get(wb_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(wb_id)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, wb_id: int, row: Optional[WaterbodyRow]) -> None:
+        self._entries[wb_id] = (time.monotonic(), row)
+        self._entries.move_to_end(wb_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self) -> None:
+        """Removes all entries, they will be reloaded from the database as
+        they are next requested"""
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class GeometryCache:
+    """
+    Bounded in-memory cache of the serialized GeoJSON of waterbody
+    geometries, keyed by the wb_id and the options the GeoJSON was created
+    with. The geometries of the largest waterbodies are many MB, so the
+    cache is bounded by the total size of the cached values rather than the
+    number of entries, and the least recently used entries are evicted
+    first.
+
+    Like the waterbody index, geometries only change when a new historical
+    extent product is loaded, so entries don't expire but are invalidated
+    along with the index.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries: OrderedDict[Hashable, bytes] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size_bytes -= len(self._entries.pop(key))
+        self._entries[key] = value
+        self.size_bytes += len(value)
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+        self.size_bytes = 0
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+async def listen_for_invalidation(
+    caches: List[Any],
+    conninfo: str,
+    channel: str,
+    listening: Optional[asyncio.Event] = None,
+) -> None:
+    """
+    Invalidates the caches (anything with an `invalidate` method) whenever
+    a notification is sent on the given channel, eg; `NOTIFY
+    waterbody_index` after a new historical extent product is loaded. Runs
+    until cancelled, reconnecting if the connection is lost.
+
+    The `listening` event is set once the caches have been invalidated
+    after first listening, so they can be preloaded without the preloaded
+    entries being cleared (or a notification being missed).
+    """
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                conninfo, autocommit=True
+            ) as conn:
+                await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                # Anything could have changed while we weren't listening
+                for cache in caches:
+                    cache.invalidate()
+                if listening is not None:
+                    listening.set()
+                async for _ in conn.notifies():
+                    logger.info(f"Waterbody caches invalidated by {channel} notify")
+                    for cache in caches:
+                        cache.invalidate()
+        except psycopg.OperationalError as e:
+            logger.warning(f"Waterbody index listener disconnected: {e}")
+            await asyncio.sleep(5)
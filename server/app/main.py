@@ -1,25 +1,226 @@
-from datetime import date
-from typing import AsyncGenerator
+import hashlib
+import json
+import os
+import pathlib
+import secrets
+from contextlib import aclosing
+from datetime import date, datetime, time, timezone
+from email.utils import format_datetime
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple, Union
 
-from fastapi import FastAPI, HTTPException, Request, status
+import pyarrow as pa
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    status,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from psycopg import AsyncCursor, sql
 from geojson_pydantic import Feature
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from starlette.routing import Match
+from starlette.types import Scope
 
-from app.db import lifespan
+from app.admission import AdmissionLimiter, AdmissionMiddleware, admitted
+from app.compression import CompressionMiddleware
+from app.db import check_database_connection, lifespan
+from app.export import (
+    EXPORT_MEDIA_TYPES,
+    GEOHASH_ALPHABET,
+    ExportDataset,
+    ExportFormat,
+    ExportWriter,
+    export_query,
+)
+from app.export import FETCH_SIZE as EXPORT_FETCH_SIZE
+from app.formats import (
+    MEDIA_TYPES,
+    OBSERVATION_SCHEMA,
+    ColumnarFormat,
+    ColumnarWriter,
+    dated_schema,
+)
+from app.metrics import MetricsMiddleware
 from app.queries import (
-    waterbody_observations_query,
-    waterbody_water_quality_maps_query,
-    waterbody_water_quality_ranking_query,
-    waterbody_water_quality_summary_query,
+    OBSERVATION_COLUMNS,
+    OBSERVATION_COPY_COLUMNS,
+    OBSERVATIONS_AGGREGATED_VERSION_QUERY,
+    OBSERVATIONS_VERSION_QUERY,
+    WATER_QUALITY_MAPS_QUERY,
+    WATER_QUALITY_RANKING_QUERY,
+    WATER_QUALITY_VERSION_QUERY,
+    WATERBODIES_BBOX_QUERY,
+    WATERBODIES_TILE_QUERY,
+    WATERBODY_GEOMETRY_QUERY,
+    WATERBODY_QUERY,
+    WQ_MAPS_COLUMNS,
+    WQ_MAPS_COPY_COLUMNS,
+    WQ_RANKING_COPY_COLUMNS,
+    Interval,
+    SortOrder,
+    Statement,
+    WQRankingColumn,
+    WQQuantile,
+    WQVariable,
+    copy_csv_query,
+    copy_csv_value,
+    observations_queries,
+    resampled_columns,
+    resampled_query,
+    water_quality_columns,
+    water_quality_leaderboard_query,
+    water_quality_summary_query,
+)
+from app.streaming import (
+    ClosingStreamingResponse,
+    buffered,
+    fetch_batches,
+    stream_copy,
 )
+from app.timing import ServerTimingMiddleware, timed
+
+# "rows" formats each CSV line in python, "copy" streams the CSV formatted
+# by postgres using COPY TO STDOUT
+CSV_STREAM_MODE = os.getenv("CSV_STREAM_MODE", "rows")
+
+# Seconds that vector tiles can be cached by clients and CDNs, tiles only
+# change when a new historical extent product is loaded
+TILE_CACHE_MAX_AGE = int(os.getenv("TILE_CACHE_MAX_AGE", "86400"))
+
+# Seconds that observation and water quality responses can be used by
+# clients without revalidating them (with the ETag), by default they are
+# always revalidated
+DATA_CACHE_MAX_AGE = int(os.getenv("DATA_CACHE_MAX_AGE", "0"))
 
 app = FastAPI(lifespan=lifespan)
 
+# Compress responses with the first of COMPRESSION_ENCODINGS that the client
+# accepts, an empty list disables compression
+app.add_middleware(
+    CompressionMiddleware,
+    encodings=[
+        encoding.strip()
+        for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,gzip").split(",")
+        if encoding.strip()
+    ],
+    minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+    gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+    zstd_level=int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3")),
+)
+
+# Admission control for each class of endpoint, a burst of requests to the
+# slow "export" endpoints waits (or is rejected with a 503) once the export
+# limit is reached, leaving connections for the cheap "metadata" endpoints.
+# Whole dataset exports each hold a connection for minutes, so are limited
+# separately as "bulk". Endpoints not listed (eg; /metrics and /admin)
+# aren't limited.
+ENDPOINT_CLASSES = {
+    "/waterbody/{wb_id}/observations/csv": "export",
+    "/waterbody/{wb_id}/observations/{format}": "export",
+    "/waterbodies/observations/csv": "export",
+    "/waterbodies/bbox": "export",
+    "/waterbody/{wb_id}/water_quality_summaries/csv": "export",
+    "/waterbody/{wb_id}/water_quality_summaries/{format}": "export",
+    "/waterbody/{wb_id}/water_quality_maps/csv": "export",
+    "/waterbody/{wb_id}/water_quality_rankings/csv": "export",
+    "/waterbodies/water_quality_rankings": "metadata",
+    "/export/{dataset}/{format}": "bulk",
+    "/waterbody/{wb_id}": "metadata",
+    "/waterbody/{wb_id}/geometry": "metadata",
+    "/tiles/{z}/{x}/{y}.mvt": "metadata",
+}
+# Endpoints whose responses can be served from the response cache, these
+# are admitted by `cached_response` only when the response is queried, so
+# requests answered from the cache don't wait for (or take) a slot
+CACHED_ENDPOINTS = {
+    "/waterbody/{wb_id}/observations/csv",
+    "/waterbody/{wb_id}/observations/{format}",
+    "/waterbody/{wb_id}/water_quality_summaries/csv",
+    "/waterbody/{wb_id}/water_quality_summaries/{format}",
+    "/waterbody/{wb_id}/water_quality_maps/csv",
+    "/waterbody/{wb_id}/water_quality_rankings/csv",
+    "/waterbodies/water_quality_rankings",
+}
+ADMISSION_DEFAULTS = {
+    "export": ("3", "16", "10"),
+    "metadata": ("32", "64", "5"),
+    "bulk": ("1", "4", "30"),
+}
+app.admission_limiters = {
+    name: AdmissionLimiter(
+        max_concurrency=int(
+            os.getenv(f"ADMISSION_{name.upper()}_CONCURRENCY", concurrency)
+        ),
+        max_queue=int(os.getenv(f"ADMISSION_{name.upper()}_QUEUE", queue)),
+        max_wait=float(os.getenv(f"ADMISSION_{name.upper()}_WAIT", wait)),
+    )
+    for name, (concurrency, queue, wait) in ADMISSION_DEFAULTS.items()
+}
+
+
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+
+def endpoint_path(scope: Scope) -> Optional[str]:
+    """Returns the path of the endpoint the request is routed to"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return None
+
+
+def endpoint_class(scope: Scope) -> Optional[str]:
+    """Returns the class of the endpoint the request is routed to"""
+    return ENDPOINT_CLASSES.get(endpoint_path(scope))
+
+
+def admission_class(scope: Scope) -> Optional[str]:
+    """Returns the class of the endpoint the request is routed to, unless
+    the endpoint admits its own requests (CACHED_ENDPOINTS)"""
+    path = endpoint_path(scope)
+    if path in CACHED_ENDPOINTS:
+        return None
+    return ENDPOINT_CLASSES.get(path)
+
+
+app.add_middleware(
+    AdmissionMiddleware,
+    limiters=app.admission_limiters,
+    classify=admission_class,
+    retry_after=ADMISSION_RETRY_AFTER,
+)
+
+# Time each phase of a request, sent in the Server-Timing header and logged
+# for requests slower than TIMING_LOG_THRESHOLD_MS. Requests are profiled if
+# they're sampled by PROFILE_SAMPLE_RATE, or their X-Profile header matches
+# the ADMIN_TOKEN. This is added after the admission and compression
+# middleware so the admission queue and compression are timed
+app.add_middleware(
+    ServerTimingMiddleware,
+    log_threshold=float(os.getenv("TIMING_LOG_THRESHOLD_MS", "1000")) / 1000,
+    profile_dir=pathlib.Path(os.getenv("PROFILE_DIR", "/tmp/profiles")),
+    profile_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    profile_token=os.getenv("ADMIN_TOKEN"),
+)
+
+# Record the duration and rows of each response, this is added after the
+# compression middleware so it includes the time taken to compress the
+# response
+app.add_middleware(MetricsMiddleware)
+
 # Allow all origins, and all methods
 # Without this CORS may block other systems attempting to
-# access these web services
+# access these web services. This is added last so it's the outermost
+# middleware, and responses sent by the other middleware (eg; the 503 of a
+# request that isn't admitted) have the CORS headers too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -36,114 +237,688 @@ class Waterbody(BaseModel):
     area_m2: float
 
 
+async def fetch_waterbody(
+    request: Request, wb_id: int, cursor: Optional[AsyncCursor] = None
+) -> Waterbody:
+    """
+    Looks up the metadata of a waterbody (including the uid used to query
+    all the other tables). Raises a 404 HTTPException if the waterbody
+    doesn't exist.
+
+    The waterbody index is checked first, and only if the wb_id isn't
+    indexed is the database queried, on the given cursor or on a new
+    pooled connection if no cursor is given.
+    """
+    index = request.app.waterbody_index
+    indexed, waterbody = index.get(wb_id)
+    if not indexed:
+        if cursor is None:
+            async with request.app.async_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    with timed("lookup"):
+                        await WATERBODY_QUERY.execute(cur, wb_id=wb_id)
+                        waterbody = await cur.fetchone()
+        else:
+            with timed("lookup"):
+                await WATERBODY_QUERY.execute(cursor, wb_id=wb_id)
+                waterbody = await cursor.fetchone()
+        index.put(wb_id, waterbody)
+
+    if waterbody is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
+        )
+    uid, wb_id, area_m2 = waterbody
+    return Waterbody(uid=uid, wb_id=wb_id, area_m2=area_m2)
+
+
+async def stream_response(
+    chunks: AsyncGenerator[Union[str, bytes], None],
+    media_type: str = "text/csv",
+    headers: Optional[Dict[str, str]] = None,
+) -> StreamingResponse:
+    """
+    Returns a StreamingResponse for an async generator of response data
+    (eg; CSV lines). The generator is run up to its first chunk (eg; the CSV
+    header) before the response is created, so any HTTPException raised
+    before this (eg; waterbody not found) is returned as an error response
+    before any of the streaming response headers are sent.
+
+    Chunks are buffered so they're sent in a few large chunks, rather than a
+    chunk for every row. The generator is closed once the response ends,
+    including when the client disconnects part way through.
+    """
+    header = await anext(chunks)
+
+    async def all_chunks() -> AsyncGenerator[Union[str, bytes], None]:
+        # The generator is also closed if the response ends while the header
+        # is being sent
+        async with aclosing(chunks):
+            yield header
+            async for chunk in chunks:
+                yield chunk
+
+    return ClosingStreamingResponse(
+        buffered(all_chunks()), media_type=media_type, headers=headers
+    )
+
+
+async def cached_response(
+    request: Request,
+    chunks: AsyncGenerator[Union[str, bytes], None],
+    media_type: str = "text/csv",
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """
+    Returns the cached response body for the request's path and query
+    parameters if there is one. Otherwise the response is streamed from the
+    async generator as with `stream_response` and cached once complete,
+    unless an identical request is in flight, in which case its chunks are
+    streamed instead (without querying the database again). The generator
+    isn't started if a cached or in-flight response is returned.
+
+    Requests are only admitted through the limiter of their endpoint class
+    (see CACHED_ENDPOINTS) once the response is queried, so cached and
+    in-flight responses are returned without waiting for a slot.
+
+    The ETag in `headers` (see `check_data_version`) is part of the cache
+    key. Versions and bodies are cached separately, so otherwise a body
+    cached before new data was loaded could be returned with the new ETag,
+    and then revalidated by clients indefinitely.
+    """
+    cache = request.app.response_cache
+    key = (
+        request.url.path,
+        tuple(sorted(request.query_params.multi_items())),
+        (headers or {}).get("ETag"),
+    )
+    body = cache.get(key)
+    if body is not None:
+        return Response(content=body, media_type=media_type, headers=headers)
+    limiter = request.app.admission_limiters.get(endpoint_class(request.scope))
+    if limiter is not None:
+        chunks = admitted(limiter, chunks, ADMISSION_RETRY_AFTER)
+    return await stream_response(cache.stream(key, chunks), media_type, headers)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header with an ETag"""
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    )
+
+
+async def check_data_version(
+    request: Request, wb_id: int, version_query: Statement
+) -> Dict[str, str]:
+    """
+    Returns the caching headers (ETag, Last-Modified and Cache-Control) of a
+    response with a waterbody's data, using the latest date and number of
+    rows returned by the version query as the version of the data. The
+    waterbody's area is included as the percentages are derived from it.
+
+    If the request's If-None-Match header matches the ETag, a 304
+    HTTPException is raised before the data is queried. A 404 HTTPException
+    is raised if the waterbody doesn't exist.
+
+    Versions are held in the response cache, so concurrent requests for the
+    same waterbody share a single version query.
+    """
+
+    async def fetch_version() -> bytes:
+        async with request.app.async_pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                waterbody = await fetch_waterbody(request, wb_id, cursor)
+                await version_query.execute(cursor, uid=waterbody.uid)
+                latest_date, row_count = await cursor.fetchone()
+        version = ":".join(
+            str(value)
+            for value in (
+                version_query.name,
+                waterbody.uid,
+                waterbody.area_m2,
+                latest_date,
+                row_count,
+            )
+        )
+        return json.dumps(
+            {
+                "etag": hashlib.sha1(version.encode()).hexdigest(),
+                "latest_date": latest_date and latest_date.isoformat(),
+            }
+        ).encode()
+
+    version = json.loads(
+        await request.app.response_cache.fetch(
+            (version_query.name, wb_id), fetch_version
+        )
+    )
+    headers = {
+        "ETag": 'W/"{}"'.format(version["etag"]),
+        "Cache-Control": f"public, max-age={DATA_CACHE_MAX_AGE}",
+    }
+    if version["latest_date"] is not None:
+        latest_date = date.fromisoformat(version["latest_date"][:10])
+        headers["Last-Modified"] = format_datetime(
+            datetime.combine(latest_date, time.min, tzinfo=timezone.utc),
+            usegmt=True,
+        )
+
+    # Only the ETag is used to check if the data has changed, as data can
+    # be loaded for dates before the Last-Modified date
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None and etag_matches(if_none_match, headers["ETag"]):
+        raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return headers
+
+
+async def observations_version(request: Request, wb_id: int) -> Dict[str, str]:
+    """Dependency that checks the version of a waterbody's observations"""
+    if request.app.observation_aggregates:
+        return await check_data_version(
+            request, wb_id, OBSERVATIONS_AGGREGATED_VERSION_QUERY
+        )
+    return await check_data_version(request, wb_id, OBSERVATIONS_VERSION_QUERY)
+
+
+async def water_quality_version(request: Request, wb_id: int) -> Dict[str, str]:
+    """Dependency that checks the version of a waterbody's water quality
+    summaries"""
+    return await check_data_version(request, wb_id, WATER_QUALITY_VERSION_QUERY)
+
+
 @app.get("/waterbody/{wb_id}")
 async def get_waterbody(wb_id: int, request: Request) -> Waterbody:
     """
     Gets the metadata of a specific waterbody based on its id
     """
+    return await fetch_waterbody(request, wb_id)
+
+
+def dated_csv_line(row: Tuple) -> str:
+    """Formats a row of a query that returns a date followed by any other
+    columns (eg; water quality summaries) as a CSV line, without the trailing
+    newline.
+    """
+    row_date, *row_values = row
+    return ",".join(
+        [row_date.strftime("%Y-%m-%d")] + [f"{row_value}" for row_value in row_values]
+    )
+
+
+def observation_csv_line(wb_observation: Tuple) -> str:
+    """Formats a row of the observations query (OBSERVATION_COLUMNS) as a
+    CSV line, without the trailing newline.
+    """
+    # TODO - any changes to the query need to be reflected here
+    (
+        obs_date,
+        obs_area_wet,
+        obs_pc_wet,
+        obs_area_dry,
+        obs_pc_dry,
+        obs_area_invalid,
+        obs_pc_invalid,
+        obs_area,
+        obs_pc,
+    ) = wb_observation
+    return f"{str(obs_date.strftime('%Y-%m-%d'))},{obs_area_wet},{obs_pc_wet:.2f},{obs_area_dry},{obs_pc_dry:.2f},{obs_area_invalid},{obs_pc_invalid:.2f},{obs_area},{obs_pc:.2f}"
+
+
+async def query_waterbody_observations(
+    request: Request, wb_id: int, start_date: date, end_date: date
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """Async generator that yields strings of CSV lines for each batch of
+    rows returned by the SQL query as the query is being run. The waterbody
+    is looked up, and the data read by a server-side cursor, on a single
+    pooled connection. In copy mode, chunks of CSV lines formatted by
+    postgres are yielded instead.
+    """
     async with request.app.async_pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                "SELECT uid, wb_id, area_m2 "
-                "FROM waterbodies_historical_extent "
-                f"WHERE wb_id={wb_id}"
+        async with conn.cursor() as cursor:
+            # Raises a 404 before the header is yielded if the waterbody
+            # doesn't exist
+            waterbody = await fetch_waterbody(request, wb_id, cursor)
+
+            # Before running the query, yield the csv header
+            yield ",".join(OBSERVATION_COLUMNS) + "\n"
+
+            # Perform the query
+            statement, _ = observations_queries(request.app.observation_aggregates)
+            params = dict(
+                wb_id=wb_id,
+                uid=waterbody.uid,
+                area_m2=waterbody.area_m2,
+                start_date=start_date,
+                end_date=end_date,
             )
-            waterbody = await cur.fetchone()
-            if waterbody is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
+            if CSV_STREAM_MODE == "copy":
+                # Have postgres format the rows as CSV
+                copy_query = copy_csv_query(
+                    statement.sql(),
+                    OBSERVATION_COPY_COLUMNS,
                 )
-            uid, wb_id, area_m2 = waterbody
-            return Waterbody(uid=uid, wb_id=wb_id, area_m2=area_m2)
+                # closed as soon as the response ends, which cancels the
+                # COPY if the client disconnected before it finished
+                async with aclosing(
+                    stream_copy(cursor, copy_query, statement.values(**params))
+                ) as copy:
+                    async for chunk in copy:
+                        yield chunk
+                return
 
+            async with conn.cursor(name="waterbody_observations") as server_cursor:
+                async for wb_observations in fetch_batches(
+                    server_cursor, statement.sql(), statement.values(**params)
+                ):
+                    yield "".join(
+                        observation_csv_line(wb_observation) + "\n"
+                        for wb_observation in wb_observations
+                    )
 
-async def query_waterbody_observations(
-    request: Request, wb_id: int, start_date: date, end_date: date
-) -> AsyncGenerator[str, None]:
-    """Async generator that yields a string (formatted as a CSV line) for each
-    row returned by the SQL query as the query is being run.
+
+async def query_columnar(
+    request: Request,
+    wb_id: int,
+    format: ColumnarFormat,
+    schema: pa.Schema,
+    statement: Statement,
+    params: Callable[[Waterbody], Dict[str, Any]],
+) -> AsyncGenerator[bytes, None]:
+    """Async generator that yields the Arrow IPC stream, or Parquet file, of
+    the rows returned by a statement. Each batch of rows fetched from the
+    database is written as a record batch (or row group) and yielded as it
+    is written. The waterbody is looked up, and the data read by a
+    server-side cursor, on a single pooled connection.
     """
-    # Before running the query, yield the csv header
-    yield "date,area_wet_m2,percent_wet,area_dry_m2,percent_dry,area_invalid_m2,percent_invalid,area_observed_m2,percent_observed\n"
+    async with request.app.async_pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            # Raises a 404 before anything is yielded if the waterbody
+            # doesn't exist
+            waterbody = await fetch_waterbody(request, wb_id, cursor)
+
+            writer = ColumnarWriter(schema, format)
+            yield writer.start()
+
+            async with conn.cursor(name="columnar") as server_cursor:
+                async for rows in fetch_batches(
+                    server_cursor,
+                    statement.sql(),
+                    statement.values(**params(waterbody)),
+                ):
+                    yield writer.write(rows)
+                yield writer.close()
 
-    # Perform the query
-    query = waterbody_observations_query(wb_id, start_date, end_date)
 
+async def query_dated_csv(
+    request: Request,
+    wb_id: int,
+    statement: Statement,
+    columns: List[str],
+    params: Callable[[Waterbody], Dict[str, Any]],
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """Async generator that yields strings of CSV lines for each batch of
+    rows returned by a statement that returns a date followed by the given
+    columns (eg; a resampled query). The waterbody is looked up, and the
+    data read by a server-side cursor, on a single pooled connection. In
+    copy mode, chunks of CSV lines formatted by postgres are yielded
+    instead.
+    """
     async with request.app.async_pool.connection() as conn:
         async with conn.cursor() as cursor:
-            async for wb_observation in cursor.stream(query):
-                # TODO - any changes to the query above need to be reflected here
-                (
-                    obs_date,
-                    obs_area_wet,
-                    obs_pc_wet,
-                    obs_area_dry,
-                    obs_pc_dry,
-                    obs_area_invalid,
-                    obs_pc_invalid,
-                    obs_area,
-                    obs_pc,
-                ) = wb_observation
-                csv_line = f"{str(obs_date.strftime('%Y-%m-%d'))},{obs_area_wet},{obs_pc_wet:.2f},{obs_area_dry},{obs_pc_dry:.2f},{obs_area_invalid},{obs_pc_invalid:.2f},{obs_area},{obs_pc:.2f}\n"
-                yield csv_line
+            # Raises a 404 before the header is yielded if the waterbody
+            # doesn't exist
+            waterbody = await fetch_waterbody(request, wb_id, cursor)
+
+            # Before running the query, yield the csv header
+            yield ",".join(["date"] + columns) + "\n"
+
+            # Perform the query
+            statement_params = params(waterbody)
+            if CSV_STREAM_MODE == "copy":
+                # Have postgres format the rows as CSV
+                copy_query = copy_csv_query(
+                    statement.sql(),
+                    ["q.date::date"] + [copy_csv_value(f"q.{col}") for col in columns],
+                )
+                # closed as soon as the response ends, which cancels the
+                # COPY if the client disconnected before it finished
+                async with aclosing(
+                    stream_copy(
+                        cursor, copy_query, statement.values(**statement_params)
+                    )
+                ) as copy:
+                    async for chunk in copy:
+                        yield chunk
+                return
+
+            async with conn.cursor(name="dated_csv") as server_cursor:
+                async for rows in fetch_batches(
+                    server_cursor, statement.sql(), statement.values(**statement_params)
+                ):
+                    yield "".join(dated_csv_line(row) + "\n" for row in rows)
 
 
 @app.get("/waterbody/{wb_id}/observations/csv")
 async def get_waterbody_observations_csv(
-    request: Request, wb_id: int, start_date: date = date.min, end_date: date = date.max
+    request: Request,
+    wb_id: int,
+    start_date: date = date.min,
+    end_date: date = date.max,
+    interval: Optional[Interval] = None,
+    cache_headers: Dict[str, str] = Depends(observations_version),
+) -> Response:
+    """
+    Returns the water body observations over time in a CSV format. If an
+    interval is given, the observations are resampled to the count, mean,
+    min and max of the observations in each day, month, season or year.
+    """
+    if interval is not None:
+        columns = OBSERVATION_COLUMNS[1:]
+        statement, _ = observations_queries(request.app.observation_aggregates)
+        return await cached_response(
+            request,
+            query_dated_csv(
+                request,
+                wb_id,
+                resampled_query(statement, columns, interval),
+                resampled_columns(columns),
+                lambda waterbody: dict(
+                    wb_id=wb_id,
+                    uid=waterbody.uid,
+                    area_m2=waterbody.area_m2,
+                    start_date=start_date,
+                    end_date=end_date,
+                ),
+            ),
+            headers=cache_headers,
+        )
+
+    # The generator first checks if the waterbody exists, and if not a 404
+    # response is sent. If it does exist then the query to get the
+    # water observations is run on the same connection. This allows the
+    # client to determine if the waterbody exists and has no data (in the
+    # query date range), or it doesn't exist at all.
+    #
+    # Stream the reponse data, the rows are read from a server-side cursor a
+    # batch at a time, so only one batch of the water observations is held in
+    # memory, and the response starts as soon as the first batch is read
+    return await cached_response(
+        request,
+        query_waterbody_observations(request, wb_id, start_date, end_date),
+        headers=cache_headers,
+    )
+
+
+@app.get("/waterbody/{wb_id}/observations/{format}")
+async def get_waterbody_observations_columnar(
+    request: Request,
+    wb_id: int,
+    format: ColumnarFormat,
+    start_date: date = date.min,
+    end_date: date = date.max,
+    interval: Optional[Interval] = None,
+    cache_headers: Dict[str, str] = Depends(observations_version),
+) -> Response:
+    """
+    Returns the water body observations over time in the Arrow IPC stream
+    or Parquet format. Values are typed, and percentages aren't rounded as
+    they are in the CSV format. Observations can be resampled to an
+    interval, as with the CSV format.
+    """
+    schema = OBSERVATION_SCHEMA
+    statement, _ = observations_queries(request.app.observation_aggregates)
+    if interval is not None:
+        columns = OBSERVATION_COLUMNS[1:]
+        schema = dated_schema(resampled_columns(columns))
+        statement = resampled_query(statement, columns, interval)
+    return await cached_response(
+        request,
+        query_columnar(
+            request,
+            wb_id,
+            format,
+            schema,
+            statement,
+            lambda waterbody: dict(
+                wb_id=wb_id,
+                uid=waterbody.uid,
+                area_m2=waterbody.area_m2,
+                start_date=start_date,
+                end_date=end_date,
+            ),
+        ),
+        media_type=MEDIA_TYPES[format],
+        headers=cache_headers,
+    )
+
+
+# defines structure of the body sent to the batch observations handler
+class WaterbodiesObservationsRequest(BaseModel):
+    wb_ids: list[int] = Field(min_length=1, max_length=5000)
+    start_date: date = date.min
+    end_date: date = date.max
+
+
+async def query_waterbodies_observations(
+    request: Request, wb_ids: list[int], start_date: date, end_date: date
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """Async generator that yields strings of CSV lines for each batch of
+    rows returned by the batch SQL query as the query is being run. In copy
+    mode, chunks of CSV lines formatted by postgres are yielded instead.
+    """
+    # Before running the query, yield the csv header
+    yield "wb_id," + ",".join(OBSERVATION_COLUMNS) + "\n"
+
+    # Perform the query
+    _, statement = observations_queries(request.app.observation_aggregates)
+    params = dict(wb_ids=wb_ids, start_date=start_date, end_date=end_date)
+
+    async with request.app.async_pool.connection() as conn:
+        if CSV_STREAM_MODE == "copy":
+            async with conn.cursor() as cursor:
+                # Have postgres format the rows as CSV
+                copy_query = copy_csv_query(
+                    statement.sql(),
+                    ["q.wb_id"] + OBSERVATION_COPY_COLUMNS,
+                )
+                # closed as soon as the response ends, which cancels the
+                # COPY if the client disconnected before it finished
+                async with aclosing(
+                    stream_copy(cursor, copy_query, statement.values(**params))
+                ) as copy:
+                    async for chunk in copy:
+                        yield chunk
+            return
+
+        # The observations of many waterbodies can be too large to fetch all
+        # at once, so a server-side cursor is used to fetch FETCH_SIZE rows at
+        # a time. A cursor can't be declared for a prepared statement, so the
+        # query isn't prepared, but its parameters are still bound server-side.
+        async with conn.cursor(name="waterbodies_observations") as cursor:
+            query = statement.sql()
+            async for wb_observations in fetch_batches(
+                cursor, query, statement.values(**params)
+            ):
+                yield "".join(
+                    f"{obs_wb_id},{observation_csv_line(observation)}\n"
+                    for obs_wb_id, *observation in wb_observations
+                )
+
+
+@app.post("/waterbodies/observations/csv")
+async def get_waterbodies_observations_csv(
+    request: Request, body: WaterbodiesObservationsRequest
 ) -> StreamingResponse:
     """
-    Returns the water body observations over time in a CSV format
+    Returns the observations over time of many water bodies in a long
+    format CSV, where each row is keyed by wb_id. Water body ids that
+    do not exist are ignored.
     """
-    # First we do a quick check if the waterbody exists, and if not send
-    # a 404 response. If it does exist then run the query to get the
-    # waterbody observations. This allows the client to determine if the
-    # waterbody exists and has no data (in the query date range), or it
-    # doesn't exist at all.
+    # Unlike the single waterbody handler there's no existence check, a
+    # single set-based query is run for all the requested waterbodies
+    # and the rows for each waterbody are streamed in wb_id, date order
+    return await stream_response(
+        query_waterbodies_observations(
+            request, sorted(set(body.wb_ids)), body.start_date, body.end_date
+        )
+    )
+
+
+@app.get("/waterbody/{wb_id}/geometry", response_model=Feature)
+async def get_waterbody_geometry(
+    wb_id: int,
+    request: Request,
+    simplify: float = Query(default=0, ge=0),
+    precision: int = Query(default=9, ge=0, le=15),
+) -> Response:
+    """
+    Gets the geometry (geojson) of a specific waterbody based on its id. The
+    geometry can be simplified with a tolerance in degrees (`simplify`), and
+    the number of decimal places of each coordinate limited (`precision`).
+    """
+    # The serialized GeoJSON is cached, and sent as is rather than being
+    # parsed and validated against the Feature model, as the geometries of
+    # large waterbodies have hundreds of thousands of coordinates
+    key = (wb_id, simplify, precision)
+    geojson = request.app.geometry_cache.get(key)
+    if geojson is None:
+        async with request.app.async_pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await WATERBODY_GEOMETRY_QUERY.execute(
+                    cur, wb_id=wb_id, tolerance=simplify, precision=precision
+                )
+                waterbody_geom = await cur.fetchone()
+                if waterbody_geom is None:
+                    raise HTTPException(
+                        status_code=status.HTTP_404_NOT_FOUND,
+                        detail="Waterbody not found",
+                    )
+        geojson = waterbody_geom[0].encode()
+        request.app.geometry_cache.put(key, geojson)
+    return Response(content=geojson, media_type="application/geo+json")
+
+
+def parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """
+    Parses a `min_lon,min_lat,max_lon,max_lat` bbox string, raises a 422
+    HTTPException if it isn't valid
+    """
+    try:
+        min_x, min_y, max_x, max_y = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="bbox must be min_lon,min_lat,max_lon,max_lat",
+        )
+    if min_x > max_x or min_y > max_y:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="bbox minimums must not be greater than its maximums",
+        )
+    return min_x, min_y, max_x, max_y
+
+
+async def query_waterbodies_bbox(
+    request: Request, params: Dict[str, Any]
+) -> AsyncGenerator[str, None]:
+    """Async generator that yields a GeoJSON FeatureCollection of the
+    waterbodies returned by the bbox query, a batch of features at a time.
+    The collection ends with a `next` member, the `after` value to request
+    the next page with, or null if this is the last page. A page can hold
+    thousands of geometries, so they're read by a server-side cursor.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+
+    last_wb_id, count = None, 0
     async with request.app.async_pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                f"SELECT wb_id FROM waterbodies_historical_extent WHERE wb_id={wb_id}"
-            )
-            waterbody = await cur.fetchone()
-            if waterbody is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
+        async with conn.cursor(name="waterbodies_bbox") as cursor:
+            async for features in fetch_batches(
+                cursor,
+                WATERBODIES_BBOX_QUERY.sql(),
+                WATERBODIES_BBOX_QUERY.values(**params),
+            ):
+                yield ("," if count else "") + ",".join(
+                    geojson for _, geojson in features
                 )
+                last_wb_id, count = features[-1][0], count + len(features)
+
+    # There are probably more waterbodies if a full page was returned
+    next_wb_id = last_wb_id if count == params["limit"] else None
+    yield f'], "next": {json.dumps(next_wb_id)}}}'
 
-            # Stream the reponse data, this means we don't need to keep a full copy
-            # of the water observations in memeory, and we can start writing the
-            # response as soon as the first row is read from the DB
-            return StreamingResponse(
-                query_waterbody_observations(request, wb_id, start_date, end_date),
-                media_type="text/csv",
-            )
+
+@app.get("/waterbodies/bbox")
+async def get_waterbodies_bbox(
+    request: Request,
+    bbox: str,
+    min_area_m2: float = 0,
+    after: int = -1,
+    limit: int = Query(default=1000, ge=1, le=10000),
+) -> StreamingResponse:
+    """
+    Returns the waterbodies that intersect a bbox (`min_lon,min_lat,max_lon,max_lat`
+    in EPSG:4326) as a GeoJSON FeatureCollection, optionally limited to
+    waterbodies with at least `min_area_m2` area. Waterbodies are returned in
+    pages of up to `limit` features ordered by wb_id, the collection's
+    `next` member is the `after` value to get the next page with (null on the
+    last page).
+    """
+    min_x, min_y, max_x, max_y = parse_bbox(bbox)
+    return await stream_response(
+        query_waterbodies_bbox(
+            request,
+            dict(
+                min_x=min_x,
+                min_y=min_y,
+                max_x=max_x,
+                max_y=max_y,
+                min_area_m2=min_area_m2,
+                after_wb_id=after,
+                limit=limit,
+            ),
+        ),
+        media_type="application/geo+json",
+    )
 
 
-@app.get("/waterbody/{wb_id}/geometry")
-async def get_waterbody_geometry(wb_id: int, request: Request) -> Feature:
+@app.get("/tiles/{z}/{x}/{y}.mvt")
+async def get_waterbodies_tile(
+    request: Request,
+    z: int = Path(ge=0, le=24),
+    x: int = Path(ge=0),
+    y: int = Path(ge=0),
+) -> Response:
     """
-    Gets the geometry (geojson) of a specific waterbody based on its id
+    Returns a Mapbox Vector Tile of the waterbodies in a web mercator z/x/y
+    tile. Each feature of the `waterbodies` layer has the wb_id as its id,
+    along with wb_id, uid and area_m2 attributes. Waterbodies smaller than
+    about a pixel at the tile's zoom level are left out.
     """
+    if x >= 2**z or y >= 2**z:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Tile not found"
+        )
     async with request.app.async_pool.connection() as conn:
         async with conn.cursor() as cur:
-            await cur.execute(
-                "SELECT "
-                "jsonb_build_object( "
-                "    'type', 'Feature', "
-                "    'id', wb_id, "
-                "    'geometry', ST_AsGeoJSON(geometry)::jsonb, "
-                "    'properties', jsonb_build_object('id', wb_id) "
-                ") as geojson "
-                "FROM waterbodies_historical_extent "
-                f"WHERE wb_id={wb_id}"
-            )
-            waterbody_geom = await cur.fetchone()
-            if waterbody_geom is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
-                )
-            return waterbody_geom[0]
+            await WATERBODIES_TILE_QUERY.execute(cur, z=z, x=x, y=y)
+            (tile,) = await cur.fetchone()
+    return Response(
+        content=bytes(tile),
+        media_type="application/vnd.mapbox-vector-tile",
+        headers={"Cache-Control": f"public, max-age={TILE_CACHE_MAX_AGE}"},
+    )
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """
+    Returns the connection pool, cache and per route request metrics in the
+    Prometheus text format
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 class CheckConnectionResult(BaseModel):
@@ -157,265 +932,579 @@ async def check_connection(request: Request) -> CheckConnectionResult:
     check if it is connected
     """
     async with request.app.async_pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT 1")
-            await cur.fetchall()
-            # if we make it here without error, then the application
-            # is connected to the database
-            return CheckConnectionResult(connected=True)
+        await check_database_connection(conn)
+        # if we make it here without error, then the application
+        # is connected to the database
+        return CheckConnectionResult(connected=True)
 
 
-async def query_water_quality_summaries(
-    request: Request, wb_id: int, start_date: date, end_date: date
-) -> AsyncGenerator[str, None]:
-    """Async generator that yields a string (formatted as a CSV line) for each
-    row returned by the SQL query as the query is being run.
+class ReadyResult(BaseModel):
+    ready: bool
+    startup_timings: Dict[str, float]
+
+
+@app.get("/ready")
+async def ready(request: Request) -> ReadyResult:
     """
-    # Before running the query, yield the csv header
-    yield "date,hue_q0_1,hue_q0_2,hue_q0_3,hue_q0_4,hue_q0_5,hue_q0_6,hue_q0_7,hue_q0_8,hue_q0_9,owt_q0_1,owt_q0_2,owt_q0_3,owt_q0_4,owt_q0_5,owt_q0_6,owt_q0_7,owt_q0_8,owt_q0_9,chla_q0_1,chla_q0_2,chla_q0_3,chla_q0_4,chla_q0_5,chla_q0_6,chla_q0_7,chla_q0_8,chla_q0_9,tsi_q0_1,tsi_q0_2,tsi_q0_3,tsi_q0_4,tsi_q0_5,tsi_q0_6,tsi_q0_7,tsi_q0_8,tsi_q0_9,tsm_q0_1,tsm_q0_2,tsm_q0_3,tsm_q0_4,tsm_q0_5,tsm_q0_6,tsm_q0_7,tsm_q0_8,tsm_q0_9,st_max_q0_1,st_max_q0_2,st_max_q0_3,st_max_q0_4,st_max_q0_5,st_max_q0_6,st_max_q0_7,st_max_q0_8,st_max_q0_9,st_median_q0_1,st_median_q0_2,st_median_q0_3,st_median_q0_4,st_median_q0_5,st_median_q0_6,st_median_q0_7,st_median_q0_8,st_median_q0_9,st_min_q0_1,st_min_q0_2,st_min_q0_3,st_min_q0_4,st_min_q0_5,st_min_q0_6,st_min_q0_7,st_min_q0_8,st_min_q0_9,fai_cover,ndvi_cover\n"
+    Readiness check, returns a 503 until the app has been prewarmed (see
+    PREWARM) and while it's shutting down. Unlike /check-connection this
+    doesn't query the database, so a slow database doesn't take every
+    instance out of service at once.
+    """
+    if not request.app.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Not ready"
+        )
+    return ReadyResult(ready=True, startup_timings=request.app.startup_timings)
 
-    # Perform the query
-    query = waterbody_water_quality_summary_query(wb_id, start_date, end_date)
 
+async def query_water_quality_summaries(
+    request: Request,
+    wb_id: int,
+    start_date: date,
+    end_date: date,
+    columns: List[str],
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """Async generator that yields strings of CSV lines for each batch of
+    rows returned by the SQL query as the query is being run. The waterbody
+    is looked up, and the data read by a server-side cursor, on a single
+    pooled connection. In copy mode, chunks of CSV lines formatted by
+    postgres are yielded instead.
+    """
     async with request.app.async_pool.connection() as conn:
         async with conn.cursor() as cursor:
-            async for wq_observation in cursor.stream(query):
-                # TODO - any changes to the query above need to be reflected here
-                (
-                    obs_date,
-                    obs_hue_q0_1,
-                    obs_hue_q0_2,
-                    obs_hue_q0_3,
-                    obs_hue_q0_4,
-                    obs_hue_q0_5,
-                    obs_hue_q0_6,
-                    obs_hue_q0_7,
-                    obs_hue_q0_8,
-                    obs_hue_q0_9,
-                    obs_owt_q0_1,
-                    obs_owt_q0_2,
-                    obs_owt_q0_3,
-                    obs_owt_q0_4,
-                    obs_owt_q0_5,
-                    obs_owt_q0_6,
-                    obs_owt_q0_7,
-                    obs_owt_q0_8,
-                    obs_owt_q0_9,
-                    obs_chla_q0_1,
-                    obs_chla_q0_2,
-                    obs_chla_q0_3,
-                    obs_chla_q0_4,
-                    obs_chla_q0_5,
-                    obs_chla_q0_6,
-                    obs_chla_q0_7,
-                    obs_chla_q0_8,
-                    obs_chla_q0_9,
-                    obs_tsi_q0_1,
-                    obs_tsi_q0_2,
-                    obs_tsi_q0_3,
-                    obs_tsi_q0_4,
-                    obs_tsi_q0_5,
-                    obs_tsi_q0_6,
-                    obs_tsi_q0_7,
-                    obs_tsi_q0_8,
-                    obs_tsi_q0_9,
-                    obs_tsm_q0_1,
-                    obs_tsm_q0_2,
-                    obs_tsm_q0_3,
-                    obs_tsm_q0_4,
-                    obs_tsm_q0_5,
-                    obs_tsm_q0_6,
-                    obs_tsm_q0_7,
-                    obs_tsm_q0_8,
-                    obs_tsm_q0_9,
-                    obs_st_max_q0_1,
-                    obs_st_max_q0_2,
-                    obs_st_max_q0_3,
-                    obs_st_max_q0_4,
-                    obs_st_max_q0_5,
-                    obs_st_max_q0_6,
-                    obs_st_max_q0_7,
-                    obs_st_max_q0_8,
-                    obs_st_max_q0_9,
-                    obs_st_median_q0_1,
-                    obs_st_median_q0_2,
-                    obs_st_median_q0_3,
-                    obs_st_median_q0_4,
-                    obs_st_median_q0_5,
-                    obs_st_median_q0_6,
-                    obs_st_median_q0_7,
-                    obs_st_median_q0_8,
-                    obs_st_median_q0_9,
-                    obs_st_min_q0_1,
-                    obs_st_min_q0_2,
-                    obs_st_min_q0_3,
-                    obs_st_min_q0_4,
-                    obs_st_min_q0_5,
-                    obs_st_min_q0_6,
-                    obs_st_min_q0_7,
-                    obs_st_min_q0_8,
-                    obs_st_min_q0_9,
-                    obs_fai_cover,
-                    obs_ndvi_cover,
-                ) = wq_observation
-                csv_line = f"{str(obs_date.strftime('%Y-%m-%d'))},{obs_hue_q0_1},{obs_hue_q0_2},{obs_hue_q0_3},{obs_hue_q0_4},{obs_hue_q0_5},{obs_hue_q0_6},{obs_hue_q0_7},{obs_hue_q0_8},{obs_hue_q0_9},{obs_owt_q0_1},{obs_owt_q0_2},{obs_owt_q0_3},{obs_owt_q0_4},{obs_owt_q0_5},{obs_owt_q0_6},{obs_owt_q0_7},{obs_owt_q0_8},{obs_owt_q0_9},{obs_chla_q0_1},{obs_chla_q0_2},{obs_chla_q0_3},{obs_chla_q0_4},{obs_chla_q0_5},{obs_chla_q0_6},{obs_chla_q0_7},{obs_chla_q0_8},{obs_chla_q0_9},{obs_tsi_q0_1},{obs_tsi_q0_2},{obs_tsi_q0_3},{obs_tsi_q0_4},{obs_tsi_q0_5},{obs_tsi_q0_6},{obs_tsi_q0_7},{obs_tsi_q0_8},{obs_tsi_q0_9},{obs_tsm_q0_1},{obs_tsm_q0_2},{obs_tsm_q0_3},{obs_tsm_q0_4},{obs_tsm_q0_5},{obs_tsm_q0_6},{obs_tsm_q0_7},{obs_tsm_q0_8},{obs_tsm_q0_9},{obs_st_max_q0_1},{obs_st_max_q0_2},{obs_st_max_q0_3},{obs_st_max_q0_4},{obs_st_max_q0_5},{obs_st_max_q0_6},{obs_st_max_q0_7},{obs_st_max_q0_8},{obs_st_max_q0_9},{obs_st_median_q0_1},{obs_st_median_q0_2},{obs_st_median_q0_3},{obs_st_median_q0_4},{obs_st_median_q0_5},{obs_st_median_q0_6},{obs_st_median_q0_7},{obs_st_median_q0_8},{obs_st_median_q0_9},{obs_st_min_q0_1},{obs_st_min_q0_2},{obs_st_min_q0_3},{obs_st_min_q0_4},{obs_st_min_q0_5},{obs_st_min_q0_6},{obs_st_min_q0_7},{obs_st_min_q0_8},{obs_st_min_q0_9},{obs_fai_cover},{obs_ndvi_cover}\n"
-                yield csv_line
+            # Raises a 404 before the header is yielded if the waterbody
+            # doesn't exist
+            waterbody = await fetch_waterbody(request, wb_id, cursor)
+
+            # Before running the query, yield the csv header
+            yield ",".join(["date"] + columns) + "\n"
+
+            # Perform the query
+            statement = water_quality_summary_query(columns)
+            params = dict(uid=waterbody.uid, start_date=start_date, end_date=end_date)
+            if CSV_STREAM_MODE == "copy":
+                # Have postgres format the rows as CSV
+                copy_query = copy_csv_query(
+                    statement.sql(),
+                    ["q.date::date"] + [copy_csv_value(f"q.{col}") for col in columns],
+                )
+                # closed as soon as the response ends, which cancels the
+                # COPY if the client disconnected before it finished
+                async with aclosing(
+                    stream_copy(cursor, copy_query, statement.values(**params))
+                ) as copy:
+                    async for chunk in copy:
+                        yield chunk
+                return
+
+            async with conn.cursor(name="water_quality_summaries") as server_cursor:
+                async for wq_observations in fetch_batches(
+                    server_cursor, statement.sql(), statement.values(**params)
+                ):
+                    yield "".join(
+                        dated_csv_line(wq_observation) + "\n"
+                        for wq_observation in wq_observations
+                    )
 
 
 @app.get("/waterbody/{wb_id}/water_quality_summaries/csv")
 async def get_waterbody_water_quality_summaries_csv(
-    request: Request, wb_id: int, start_date: date = date.min, end_date: date = date.max
-) -> StreamingResponse:
+    request: Request,
+    wb_id: int,
+    start_date: date = date.min,
+    end_date: date = date.max,
+    variables: List[WQVariable] = Query(default=None),
+    quantiles: List[WQQuantile] = Query(default=None),
+    interval: Optional[Interval] = None,
+    cache_headers: Dict[str, str] = Depends(water_quality_version),
+) -> Response:
     """
-    Returns the water body water quality summaries over time in a CSV format
+    Returns the water body water quality summaries over time in a CSV format.
+    The columns can be limited to the given variables and quantiles (eg;
+    `?variables=chla&variables=tsi&quantiles=0.5`), by default all columns
+    are returned. If an interval is given, the summaries are resampled to
+    the count, mean, min and max of each column in each period.
     """
-    # First we do a quick check if the waterbody exists, and if not send
-    # a 404 response. If it does exist then run the query to get the
-    # waterbody observations. This allows the client to determine if the
-    # waterbody exists and has no data (in the query date range), or it
-    # doesn't exist at all.
-    async with request.app.async_pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                f"SELECT wb_id FROM waterbodies_historical_extent WHERE wb_id={wb_id}"
-            )
-            waterbody = await cur.fetchone()
-            if waterbody is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
-                )
+    columns = water_quality_columns(variables, quantiles)
+    if interval is not None:
+        return await cached_response(
+            request,
+            query_dated_csv(
+                request,
+                wb_id,
+                resampled_query(
+                    water_quality_summary_query(columns), columns, interval
+                ),
+                resampled_columns(columns),
+                lambda waterbody: dict(
+                    uid=waterbody.uid, start_date=start_date, end_date=end_date
+                ),
+            ),
+            headers=cache_headers,
+        )
 
-            # Stream the reponse data, this means we don't need to keep a full copy
-            # of the water quality summaries in memeory, and we can start writing the
-            # response as soon as the first row is read from the DB
-            return StreamingResponse(
-                query_water_quality_summaries(request, wb_id, start_date, end_date),
-                media_type="text/csv",
-            )
+    # The generator first checks if the waterbody exists, and if not a 404
+    # response is sent. If it does exist then the query to get the
+    # water quality summaries is run on the same connection. This allows the
+    # client to determine if the waterbody exists and has no data (in the
+    # query date range), or it doesn't exist at all.
+    #
+    # Stream the reponse data, the rows are read from a server-side cursor a
+    # batch at a time, so only one batch of the water quality summaries is held
+    # in memory, and the response starts as soon as the first batch is read
+    return await cached_response(
+        request,
+        query_water_quality_summaries(
+            request,
+            wb_id,
+            start_date,
+            end_date,
+            columns,
+        ),
+        headers=cache_headers,
+    )
 
 
-async def query_water_quality_summaries_for_maps(
-    request: Request, wb_id: int, start_date: date, end_date: date
-) -> AsyncGenerator[str, None]:
-    """Async generator that yields a string (formatted as a CSV line) for each
-    row returned by the SQL query as the query is being run.
+@app.get("/waterbody/{wb_id}/water_quality_summaries/{format}")
+async def get_waterbody_water_quality_summaries_columnar(
+    request: Request,
+    wb_id: int,
+    format: ColumnarFormat,
+    start_date: date = date.min,
+    end_date: date = date.max,
+    variables: List[WQVariable] = Query(default=None),
+    quantiles: List[WQQuantile] = Query(default=None),
+    interval: Optional[Interval] = None,
+    cache_headers: Dict[str, str] = Depends(water_quality_version),
+) -> Response:
     """
-    # Before running the query, yield the csv header
-    yield "date, Median_TSI, Median_Turbidity, Median_Surface_Temperature, Max_Surface_Temperature, Min_Surface_Temperature, FAI_Cover\n"
+    Returns the water body water quality summaries over time in the Arrow
+    IPC stream or Parquet format. The columns can be limited to the given
+    variables and quantiles, and resampled to an interval, as with the CSV
+    format.
+    """
+    columns = water_quality_columns(variables, quantiles)
+    statement = water_quality_summary_query(columns)
+    if interval is not None:
+        statement = resampled_query(statement, columns, interval)
+        columns = resampled_columns(columns)
+    return await cached_response(
+        request,
+        query_columnar(
+            request,
+            wb_id,
+            format,
+            dated_schema(columns),
+            statement,
+            lambda waterbody: dict(
+                uid=waterbody.uid, start_date=start_date, end_date=end_date
+            ),
+        ),
+        media_type=MEDIA_TYPES[format],
+        headers=cache_headers,
+    )
 
-    # Perform the query
-    query = waterbody_water_quality_maps_query(wb_id, start_date, end_date)
 
+def water_quality_maps_csv_line(wq_observation: Tuple) -> str:
+    """Formats a row of the water quality maps query as a CSV line, without the
+    trailing newline.
+    """
+    # TODO - any changes to the query need to be reflected here
+    (
+        obs_date,
+        obs_tsi_q0_5,
+        obs_tsm_q0_5,
+        obs_st_median_q0_5,
+        obs_st_max_q0_5,
+        obs_st_min_q0_5,
+        obs_fai_cover,
+    ) = wq_observation
+    return f"{str(obs_date.strftime('%Y-%m-%d'))},{obs_tsi_q0_5},{obs_tsm_q0_5},{obs_st_median_q0_5},{obs_st_max_q0_5},{obs_st_min_q0_5},{obs_fai_cover}"
+
+
+async def query_water_quality_summaries_for_maps(
+    request: Request, wb_id: int, start_date: date, end_date: date
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """Async generator that yields strings of CSV lines for each batch of
+    rows returned by the SQL query as the query is being run. The waterbody
+    is looked up, and the data read by a server-side cursor, on a single
+    pooled connection. In copy mode, chunks of CSV lines formatted by
+    postgres are yielded instead.
+    """
     async with request.app.async_pool.connection() as conn:
         async with conn.cursor() as cursor:
-            async for wq_observation in cursor.stream(query):
-                # TODO - any changes to the query above need to be reflected here
-                (
-                    obs_date,
-                    obs_tsi_q0_5,
-                    obs_tsm_q0_5,
-                    obs_st_median_q0_5,
-                    obs_st_max_q0_5,
-                    obs_st_min_q0_5,
-                    obs_fai_cover,
-                ) = wq_observation
-                csv_line = f"{str(obs_date.strftime('%Y-%m-%d'))},{obs_tsi_q0_5},{obs_tsm_q0_5},{obs_st_median_q0_5},{obs_st_max_q0_5},{obs_st_min_q0_5},{obs_fai_cover}\n"
-                yield csv_line
+            # Raises a 404 before the header is yielded if the waterbody
+            # doesn't exist
+            waterbody = await fetch_waterbody(request, wb_id, cursor)
+
+            # Before running the query, yield the csv header
+            yield "date, Median_TSI, Median_Turbidity, Median_Surface_Temperature, Max_Surface_Temperature, Min_Surface_Temperature, FAI_Cover\n"
+
+            # Perform the query
+            params = dict(uid=waterbody.uid, start_date=start_date, end_date=end_date)
+            if CSV_STREAM_MODE == "copy":
+                # Have postgres format the rows as CSV
+                copy_query = copy_csv_query(
+                    WATER_QUALITY_MAPS_QUERY.sql(), WQ_MAPS_COPY_COLUMNS
+                )
+                # closed as soon as the response ends, which cancels the
+                # COPY if the client disconnected before it finished
+                async with aclosing(
+                    stream_copy(
+                        cursor, copy_query, WATER_QUALITY_MAPS_QUERY.values(**params)
+                    )
+                ) as copy:
+                    async for chunk in copy:
+                        yield chunk
+                return
+
+            async with conn.cursor(name="water_quality_maps") as server_cursor:
+                async for wq_observations in fetch_batches(
+                    server_cursor,
+                    WATER_QUALITY_MAPS_QUERY.sql(),
+                    WATER_QUALITY_MAPS_QUERY.values(**params),
+                ):
+                    yield "".join(
+                        water_quality_maps_csv_line(wq_observation) + "\n"
+                        for wq_observation in wq_observations
+                    )
 
 
 @app.get("/waterbody/{wb_id}/water_quality_maps/csv")
 async def get_waterbody_water_quality_maps_csv(
-    request: Request, wb_id: int, start_date: date = date.min, end_date: date = date.max
-) -> StreamingResponse:
+    request: Request,
+    wb_id: int,
+    start_date: date = date.min,
+    end_date: date = date.max,
+    interval: Optional[Interval] = None,
+    cache_headers: Dict[str, str] = Depends(water_quality_version),
+) -> Response:
     """
-    Returns the water body water quality summaries for maps display over time in a CSV format
+    Returns the water body water quality summaries for maps display over time in a CSV format.
+    If an interval is given, the summaries are resampled to the count, mean,
+    min and max of each column in each period.
     """
-    # First we do a quick check if the waterbody exists, and if not send
-    # a 404 response. If it does exist then run the query to get the
-    # waterbody observations. This allows the client to determine if the
-    # waterbody exists and has no data (in the query date range), or it
-    # doesn't exist at all.
-    async with request.app.async_pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                f"SELECT wb_id FROM waterbodies_historical_extent WHERE wb_id={wb_id}"
-            )
-            waterbody = await cur.fetchone()
-            if waterbody is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
-                )
-
-            # Stream the reponse data, this means we don't need to keep a full copy
-            # of the water quality summaries in memeory, and we can start writing the
-            # response as soon as the first row is read from the DB
-            return StreamingResponse(
-                query_water_quality_summaries_for_maps(
-                    request, wb_id, start_date, end_date
+    if interval is not None:
+        return await cached_response(
+            request,
+            query_dated_csv(
+                request,
+                wb_id,
+                resampled_query(WATER_QUALITY_MAPS_QUERY, WQ_MAPS_COLUMNS, interval),
+                resampled_columns(WQ_MAPS_COLUMNS),
+                lambda waterbody: dict(
+                    uid=waterbody.uid, start_date=start_date, end_date=end_date
                 ),
-                media_type="text/csv",
-            )
+            ),
+            headers=cache_headers,
+        )
 
+    # The generator first checks if the waterbody exists, and if not a 404
+    # response is sent. If it does exist then the query to get the
+    # water quality summaries is run on the same connection. This allows the
+    # client to determine if the waterbody exists and has no data (in the
+    # query date range), or it doesn't exist at all.
+    #
+    # Stream the reponse data, the rows are read from a server-side cursor a
+    # batch at a time, so only one batch of the water quality summaries is held
+    # in memory, and the response starts as soon as the first batch is read
+    return await cached_response(
+        request,
+        query_water_quality_summaries_for_maps(request, wb_id, start_date, end_date),
+        headers=cache_headers,
+    )
 
-async def query_water_quality_rankings(
-    request: Request, wb_id: int
-) -> AsyncGenerator[str, None]:
-    """Async generator that yields a string (formatted as a CSV line) for each
-    row returned by the SQL query as the query is being run.
+
+def water_quality_ranking_csv_line(wq_observation: Tuple) -> str:
+    """Formats a row of the water quality ranking query (WQ_RANKING_COLUMNS) as
+    a CSV line, without the trailing newline.
     """
-    # Before running the query, yield the csv header
-    yield "fai_cover_percentile, ndvi_cover_percentile, hue_q0_5_percentile, owt_q0_5_percentile, chla_q0_5_percentile, tsi_q0_5_percentile, tsm_q0_5_percentile, st_max_q0_5_percentile, st_median_q0_5_percentile, st_min_q0_5_percentile\n"
+    # TODO - any changes to the query need to be reflected here
+    (
+        obs_fai_cover_percentile,
+        obs_ndvi_cover_percentile,
+        obs_hue_q0_5_percentile,
+        obs_owt_q0_5_percentile,
+        obs_chla_q0_5_percentile,
+        obs_tsi_q0_5_percentile,
+        obs_tsm_q0_5_percentile,
+        obs_st_max_q0_5_percentile,
+        obs_st_median_q0_5_percentile,
+        obs_st_min_q0_5_percentile,
+    ) = wq_observation
+    return f"{obs_fai_cover_percentile},{obs_ndvi_cover_percentile},{obs_hue_q0_5_percentile},{obs_owt_q0_5_percentile},{obs_chla_q0_5_percentile},{obs_tsi_q0_5_percentile},{obs_tsm_q0_5_percentile},{obs_st_max_q0_5_percentile},{obs_st_median_q0_5_percentile},{obs_st_min_q0_5_percentile}"
 
-    # Perform the query
-    query = waterbody_water_quality_ranking_query(wb_id)
 
+async def query_water_quality_rankings(
+    request: Request, wb_id: int
+) -> AsyncGenerator[Union[str, bytes], None]:
+    """Async generator that yields strings of CSV lines for each batch of
+    rows returned by the SQL query as the query is being run. The waterbody
+    is looked up, and the data read by a server-side cursor, on a single
+    pooled connection. In copy mode, chunks of CSV lines formatted by
+    postgres are yielded instead.
+    """
     async with request.app.async_pool.connection() as conn:
         async with conn.cursor() as cursor:
-            async for wq_observation in cursor.stream(query):
-                # TODO - any changes to the query above need to be reflected here
-                (
-                    obs_fai_cover_percentile,
-                    obs_ndvi_cover_percentile,
-                    obs_hue_q0_5_percentile,
-                    obs_owt_q0_5_percentile,
-                    obs_chla_q0_5_percentile,
-                    obs_tsi_q0_5_percentile,
-                    obs_tsm_q0_5_percentile,
-                    obs_st_max_q0_5_percentile,
-                    obs_st_median_q0_5_percentile,
-                    obs_st_min_q0_5_percentile,
-                ) = wq_observation
-                csv_line = f"{obs_fai_cover_percentile},{obs_ndvi_cover_percentile},{obs_hue_q0_5_percentile},{obs_owt_q0_5_percentile},{obs_chla_q0_5_percentile},{obs_tsi_q0_5_percentile},{obs_tsm_q0_5_percentile},{obs_st_max_q0_5_percentile},{obs_st_median_q0_5_percentile},{obs_st_min_q0_5_percentile}\n"
-                yield csv_line
+            # Raises a 404 before the header is yielded if the waterbody
+            # doesn't exist
+            waterbody = await fetch_waterbody(request, wb_id, cursor)
+
+            # Before running the query, yield the csv header
+            yield "fai_cover_percentile, ndvi_cover_percentile, hue_q0_5_percentile, owt_q0_5_percentile, chla_q0_5_percentile, tsi_q0_5_percentile, tsm_q0_5_percentile, st_max_q0_5_percentile, st_median_q0_5_percentile, st_min_q0_5_percentile\n"
+
+            # Perform the query
+            params = dict(uid=waterbody.uid)
+            if CSV_STREAM_MODE == "copy":
+                # Have postgres format the rows as CSV
+                copy_query = copy_csv_query(
+                    WATER_QUALITY_RANKING_QUERY.sql(), WQ_RANKING_COPY_COLUMNS
+                )
+                # closed as soon as the response ends, which cancels the
+                # COPY if the client disconnected before it finished
+                async with aclosing(
+                    stream_copy(
+                        cursor, copy_query, WATER_QUALITY_RANKING_QUERY.values(**params)
+                    )
+                ) as copy:
+                    async for chunk in copy:
+                        yield chunk
+                return
+
+            async with conn.cursor(name="water_quality_rankings") as server_cursor:
+                async for wq_observations in fetch_batches(
+                    server_cursor,
+                    WATER_QUALITY_RANKING_QUERY.sql(),
+                    WATER_QUALITY_RANKING_QUERY.values(**params),
+                ):
+                    yield "".join(
+                        water_quality_ranking_csv_line(wq_observation) + "\n"
+                        for wq_observation in wq_observations
+                    )
 
 
 @app.get("/waterbody/{wb_id}/water_quality_rankings/csv")
 async def get_waterbody_water_quality_rankings_csv(
     request: Request, wb_id: int
-) -> StreamingResponse:
+) -> Response:
     """
     Returns the water body water quality rankings in a CSV format
     """
-    # First we do a quick check if the waterbody exists, and if not send
-    # a 404 response. If it does exist then run the query to get the
-    # waterbody observations. This allows the client to determine if the
-    # waterbody exists and has no data (in the query date range), or it
+    # The generator first checks if the waterbody exists, and if not a 404
+    # response is sent. If it does exist then the query to get the
+    # water quality rankings is run on the same connection. This allows the
+    # client to determine if the waterbody exists and has no data, or it
     # doesn't exist at all.
+    #
+    # Stream the reponse data, the rows are read from a server-side cursor a
+    # batch at a time, so only one batch of the water quality rankings is held
+    # in memory, and the response starts as soon as the first batch is read
+    return await cached_response(request, query_water_quality_rankings(request, wb_id))
+
+
+async def query_water_quality_leaderboard(
+    request: Request, statement: Statement, params: Dict[str, Any]
+) -> AsyncGenerator[str, None]:
+    """Async generator that yields a JSON object with the waterbodies returned
+    by the leaderboard query, a batch of waterbodies at a time. The object
+    ends with a `next` member, the `after_value` and `after_uid` to request
+    the next page with, or null if this is the last page.
+    """
+    column = params["column"]
+    yield f'{{"column": {json.dumps(column)}, "waterbodies": ['
+
+    last, count = None, 0
     async with request.app.async_pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                f"SELECT wb_id FROM waterbodies_historical_extent WHERE wb_id={wb_id}"
-            )
-            waterbody = await cur.fetchone()
-            if waterbody is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail="Waterbody not found"
+        async with conn.cursor() as cursor:
+            async for rows in fetch_batches(
+                cursor, statement.sql(), statement.values(**params)
+            ):
+                yield ("," if count else "") + ",".join(
+                    json.dumps(dict(uid=uid, wb_id=wb_id, area_m2=area_m2, value=value))
+                    for uid, wb_id, area_m2, value in rows
                 )
+                last, count = rows[-1], count + len(rows)
 
-            # Stream the reponse data, this means we don't need to keep a full copy
-            # of the water quality summaries in memeory, and we can start writing the
-            # response as soon as the first row is read from the DB
-            return StreamingResponse(
-                query_water_quality_rankings(request, wb_id),
-                media_type="text/csv",
-            )
+    # There are probably more waterbodies if a full page was returned
+    next_page = None
+    if count == params["limit"]:
+        next_page = dict(after_value=last[3], after_uid=last[0])
+    yield f'], "next": {json.dumps(next_page)}}}'
+
+
+@app.get("/waterbodies/water_quality_rankings")
+async def get_waterbodies_water_quality_rankings(
+    request: Request,
+    column: WQRankingColumn,
+    order: SortOrder = SortOrder.desc,
+    bbox: Optional[str] = None,
+    wb_ids: Optional[List[int]] = Query(default=None, min_length=1, max_length=1000),
+    after_value: Optional[float] = None,
+    after_uid: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=1000),
+) -> Response:
+    """
+    Returns the waterbodies ranked by one of their water quality ranking
+    columns (eg; the highest `chla_q0_5_percentile` first), as a JSON object
+    with the uid, wb_id, area_m2 and value of each waterbody. Waterbodies
+    without a value are skipped. The ranking can be limited to waterbodies
+    that intersect a bbox (`min_lon,min_lat,max_lon,max_lat` in EPSG:4326),
+    and/or to a list of `wb_ids`.
+
+    Waterbodies are returned in pages of up to `limit`, the object's `next`
+    member is the `after_value` and `after_uid` to get the next page with
+    (null on the last page).
+    """
+    if (after_value is None) != (after_uid is None):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="after_value and after_uid must be given together",
+        )
+    params: Dict[str, Any] = dict(column=column.value, limit=limit)
+    if bbox is not None:
+        params.update(zip(("min_x", "min_y", "max_x", "max_y"), parse_bbox(bbox)))
+    if wb_ids is not None:
+        params["wb_ids"] = sorted(set(wb_ids))
+    if after_uid is not None:
+        params.update(after_value=after_value, after_uid=after_uid)
+    statement = water_quality_leaderboard_query(
+        column.value,
+        order,
+        bbox=bbox is not None,
+        wb_ids=wb_ids is not None,
+        after=after_uid is not None,
+    )
+    # The rankings only change when a new product is loaded, so popular
+    # rankings are served from the response cache
+    return await cached_response(
+        request,
+        query_water_quality_leaderboard(request, statement, params),
+        media_type="application/json",
+    )
+
+
+async def query_export(
+    request: Request,
+    dataset: ExportDataset,
+    format: ExportFormat,
+    query: sql.Composed,
+    params: Dict[str, Any],
+) -> AsyncGenerator[bytes, None]:
+    """Async generator that yields the NDJSON lines, or Parquet file, of an
+    export query. The rows are read by a server-side cursor a batch at a
+    time, and each batch is yielded as it's written, so only a single batch
+    is held in memory however large the dataset is.
+    """
+    async with request.app.async_pool.connection() as conn:
+        async with conn.cursor(name="export") as cursor:
+            writer = ExportWriter(dataset, format)
+            yield writer.start()
+            async for rows in fetch_batches(cursor, query, params, EXPORT_FETCH_SIZE):
+                yield writer.write(rows)
+            yield writer.close()
+
+
+@app.get("/export/{dataset}/{format}")
+async def get_export(
+    request: Request,
+    dataset: ExportDataset,
+    format: ExportFormat,
+    year: Optional[int] = Query(default=None, ge=1, le=9998),
+    uid_prefix: Optional[str] = Query(default=None, pattern=f"^[{GEOHASH_ALPHABET}]$"),
+    updated_since: Optional[date] = None,
+) -> StreamingResponse:
+    """
+    Returns every row of a dataset (the observations summed by date, water
+    quality summaries, water quality rankings or historical extents) as
+    NDJSON or a Parquet file, for mirroring the dataset. Large datasets
+    should be requested a partition at a time, either a `year` of the
+    dated datasets or the waterbodies whose uid starts with a `uid_prefix`
+    character. Rows of the dated datasets can be limited to those dated on
+    or after `updated_since`, for incremental updates. Also see the
+    `app.export` command, which writes a file for each partition.
+    """
+    try:
+        query, params = export_query(
+            dataset,
+            format,
+            request.app.observation_aggregates,
+            year=year,
+            uid_prefix=uid_prefix,
+            updated_since=updated_since,
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+    filename = "_".join(
+        str(part) for part in [dataset.value, year, uid_prefix] if part is not None
+    )
+    return await stream_response(
+        query_export(request, dataset, format, query, params),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": (f'attachment; filename="{filename}.{format.value}"')
+        },
+    )
+
+
+async def require_admin_token(x_admin_token: str = Header(default="")) -> None:
+    """
+    Dependency for admin handlers that change the state of the server. The
+    X-Admin-Token request header must match the ADMIN_TOKEN env var, admin
+    handlers are disabled if no ADMIN_TOKEN is set.
+    """
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+
+@app.get("/admin/waterbody-index")
+async def get_waterbody_index_stats(request: Request) -> Dict[str, float]:
+    """
+    Returns the size and hit/miss counters of the in-memory waterbody index
+    """
+    return request.app.waterbody_index.stats()
+
+
+@app.post("/admin/waterbody-index/reload", dependencies=[Depends(require_admin_token)])
+async def reload_waterbody_index(request: Request) -> Dict[str, float]:
+    """
+    Clears the in-memory waterbody index (and the geometry and response
+    caches) so waterbodies are reloaded from the database. This should be
+    called after a new historical extent product is loaded, unless a
+    notification is sent on the WATERBODY_INDEX_CHANNEL.
+    """
+    request.app.waterbody_index.invalidate()
+    request.app.geometry_cache.invalidate()
+    request.app.response_cache.invalidate()
+    return request.app.waterbody_index.stats()
+
+
+@app.get("/admin/geometry-cache")
+async def get_geometry_cache_stats(request: Request) -> Dict[str, float]:
+    """
+    Returns the size and hit/miss counters of the in-memory geometry cache
+    """
+    return request.app.geometry_cache.stats()
+
+
+@app.get("/admin/response-cache")
+async def get_response_cache_stats(request: Request) -> Dict[str, float]:
+    """
+    Returns the size and hit/miss/coalesced counters of the in-memory
+    response cache
+    """
+    return request.app.response_cache.stats()
+
+
+@app.post("/admin/response-cache/clear", dependencies=[Depends(require_admin_token)])
+async def clear_response_cache(request: Request) -> Dict[str, float]:
+    """
+    Clears the in-memory response cache, eg; after new observations or water
+    quality summaries are loaded so they are returned before the cached
+    responses expire.
+    """
+    request.app.response_cache.invalidate()
+    return request.app.response_cache.stats()
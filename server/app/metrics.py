@@ -0,0 +1,181 @@
+import time
+from contextvars import ContextVar
+from typing import Any, Iterator, List, Optional
+
+from prometheus_client import Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+POOL_CHECKOUT_WAIT = Histogram(
+    "waterbodies_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+REQUEST_DURATION = Histogram(
+    "waterbodies_request_duration_seconds",
+    "Time taken to send the whole response, including streamed responses",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+RESPONSE_ROWS = Histogram(
+    "waterbodies_response_rows",
+    "Number of database rows sent in each response",
+    ["route"],
+    buckets=(0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000),
+)
+
+# gauges (current values) of the psycopg_pool stats, the other stats are
+# counters since the pool was opened
+POOL_GAUGES = [
+    "pool_min",
+    "pool_max",
+    "pool_size",
+    "pool_available",
+    "requests_waiting",
+]
+POOL_COUNTERS = [
+    "requests_num",
+    "requests_queued",
+    "requests_wait_ms",
+    "requests_errors",
+    "returns_bad",
+    "connections_num",
+    "connections_ms",
+    "connections_errors",
+    "connections_lost",
+    "usage_ms",
+]
+
+
+class RowCount:
+    def __init__(self):
+        self.rows = 0
+
+
+# Rows sent by the current request, this is set for each request by the
+# middleware. The RowCount object is shared with the tasks the response is
+# streamed from, so rows counted in these tasks are seen by the middleware.
+_row_count: ContextVar[Optional[RowCount]] = ContextVar("row_count", default=None)
+
+
+def count_rows(rows: int) -> None:
+    """Adds to the number of rows sent by the current request"""
+    row_count = _row_count.get()
+    if row_count is not None:
+        row_count.rows += rows
+
+
+class AppCollector(Collector):
+    """
+    Collects the stats of the connection pools (labelled by pool name), the
+    in-memory caches and the admission limiters of the app when metrics are
+    scraped
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    def collect(self) -> Iterator[Any]:
+        router = self.app.async_pool
+        gauges = {
+            name: GaugeMetricFamily(
+                f"waterbodies_{name}", f"pool {name}", labels=["pool"]
+            )
+            for name in POOL_GAUGES
+        }
+        counters = {
+            name: CounterMetricFamily(
+                f"waterbodies_{name}", f"pool {name}", labels=["pool"]
+            )
+            for name in POOL_COUNTERS
+        }
+        outstanding = GaugeMetricFamily(
+            "waterbodies_pool_outstanding",
+            "Connections checked out of the pool by the router",
+            labels=["pool"],
+        )
+        healthy = GaugeMetricFamily(
+            "waterbodies_pool_healthy",
+            "Whether the pool's database passed its last health probe",
+            labels=["pool"],
+        )
+        for pool_name, pool in router.pools.items():
+            stats = pool.get_stats()
+            for name, gauge in gauges.items():
+                gauge.add_metric([pool_name], stats.get(name, 0))
+            for name, counter in counters.items():
+                counter.add_metric([pool_name], stats.get(name, 0))
+            outstanding.add_metric([pool_name], router.outstanding[pool_name])
+            healthy.add_metric([pool_name], router.healthy.get(pool_name, True))
+        yield from gauges.values()
+        yield from counters.values()
+        yield outstanding
+        yield healthy
+
+        caches = {
+            "waterbody_index": self.app.waterbody_index,
+            "geometry": self.app.geometry_cache,
+            "response": self.app.response_cache,
+        }
+        families = {}
+        for cache_name, cache in caches.items():
+            for stat, value in cache.stats().items():
+                if stat not in families:
+                    families[stat] = GaugeMetricFamily(
+                        f"waterbodies_cache_{stat}", f"cache {stat}", labels=["cache"]
+                    )
+                families[stat].add_metric([cache_name], value)
+        yield from families.values()
+
+        families = {}
+        for class_name, limiter in self.app.admission_limiters.items():
+            for stat, value in limiter.stats().items():
+                if stat not in families:
+                    families[stat] = GaugeMetricFamily(
+                        f"waterbodies_admission_{stat}",
+                        f"admission {stat}",
+                        labels=["endpoint_class"],
+                    )
+                families[stat].add_metric([class_name], value)
+        yield from families.values()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the duration and number of database rows
+    of every response, labelled with the route's path template (eg;
+    `/waterbody/{wb_id}/observations/csv`) so the number of labels is
+    bounded.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status: List[int] = [500]
+
+        async def send_with_status(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        row_count = RowCount()
+        token = _row_count.set(row_count)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _row_count.reset(token)
+            # the route is added to the scope by the router once matched
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_DURATION.labels(scope["method"], route, status[0]).observe(
+                time.perf_counter() - start
+            )
+            RESPONSE_ROWS.labels(route).observe(row_count.rows)
@@ -0,0 +1,43 @@
+"""
+Applies the versioned migrations that define the tables the API reads, and
+the indexes its queries depend on (see app.schema).
+
+Usage (from the server folder, with the POSTGRES_* env vars set):
+
+    python -m app.migrations status
+    python -m app.migrations upgrade
+
+`upgrade` applies the migrations that haven't been applied to the
+database, which are recorded in the `schema_migrations` table. Tables that
+already exist (eg; restored from a database dump) are kept, and the
+observation tables are converted to tables partitioned by year.
+"""
+
+import argparse
+import logging
+
+import psycopg
+
+from app.db import get_connection_str
+from app.schema import MIGRATIONS, applied_migrations, migrate
+
+logger = logging.getLogger(__name__)
+
+
+def main(args: argparse.Namespace) -> None:
+    with psycopg.connect(get_connection_str(), autocommit=True) as conn:
+        if args.command == "status":
+            applied = applied_migrations(conn)
+            for migration in MIGRATIONS:
+                state = "applied" if migration.version in applied else "pending"
+                print(f"{migration.version:4} {state:8} {migration.name}")
+        else:
+            applied = migrate(conn)
+            logger.info(f"Applied {len(applied)} migrations")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["status", "upgrade"])
+    main(parser.parse_args())
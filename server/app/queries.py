@@ -1,57 +1,410 @@
-from datetime import date
+from enum import Enum
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
+from psycopg import AsyncCursor, sql
+from psycopg.types.numeric import Float8, Int4, Int8
 
-def waterbody_observations_query(wb_id: int, start_date: date, end_date: date) -> str:
+
+class Statement(NamedTuple):
+    """
+    A fixed, parameterized SQL statement. Parameters are written in the
+    query as `{name}` placeholders, and declared (in order) along with their
+    postgres type in `params`. Parameter values are sent separately from the
+    query (server-side binding), so the query text never changes between
+    requests.
+
+    Statements created with `prepared=True` are prepared by psycopg the
+    first time they're run (with `execute`) on each pooled connection, and
+    the plan reused by every later request on that connection. These are the
+    single row lookups run on a client-side cursor. Statements that stream
+    their rows through a server-side cursor or COPY can't be prepared, as
+    neither DECLARE nor COPY accept a prepared statement, so these are parsed
+    and planned for each request. psycopg keeps a prepared statement for
+    each combination of the query and its parameter types, so `execute`
+    sends the values with their declared type (eg; a small `bigint` isn't
+    sent as an int2), and the statements prepared by `app.db.prewarm` are
+    the ones reused by requests.
     """
-    _summary_
+
+    name: str
+    params: Tuple[Tuple[str, str], ...]
+    query: str
+    prepared: bool = False
+
+    def sql(self) -> sql.Composed:
+        """Returns the query with a `%(name)s` placeholder, cast to the
+        declared type, for each parameter"""
+        return sql.SQL(self.query).format(
+            **{
+                name: sql.SQL("{}::{}").format(sql.Placeholder(name), sql.SQL(pg_type))
+                for name, pg_type in self.params
+            }
+        )
+
+    def values(self, **params: Any) -> Dict[str, Any]:
+        """Returns the values of the statement's parameters, other keyword
+        arguments are ignored"""
+        return {name: params[name] for name, _ in self.params}
+
+    async def execute(self, cursor: AsyncCursor, **params: Any) -> AsyncCursor:
+        """Runs the statement on a client-side cursor with the given
+        parameter values, preparing it if it's a prepared statement"""
+        values = {name: _typed(params[name], pg_type) for name, pg_type in self.params}
+        return await cursor.execute(self.sql(), values, prepare=self.prepared)
+
+
+# Wrappers that send a python value as the given postgres type
+_PARAM_TYPES = {"bigint": Int8, "integer": Int4, "float8": Float8}
+
+
+def _typed(value: Any, pg_type: str) -> Any:
+    wrapper = _PARAM_TYPES.get(pg_type)
+    return value if wrapper is None or value is None else wrapper(value)
+
+
+def copy_csv_query(query: sql.Composable, columns: List[str]) -> sql.Composed:
+    """
+    Wraps a query in `COPY ... TO STDOUT` so that postgres formats the rows
+    as CSV. COPY doesn't accept parameters, so the query's parameters are
+    merged into the COPY by psycopg (see `app.streaming.stream_copy`).
 
     Parameters
     ----------
-    wb_id : int
-        Waterbody ID to get observations for.
-    start_date : date
-        Start date for observations. Must be in YYYY-MM-DD format.
-    end_date : date
-        End date for observations. Must be in YYYY-MM-DD format.
+    query : sql.Composable
+        Query to get the rows from.
+    columns : List[str]
+        SQL expressions for each CSV column, these can refer to the output
+        of the query as `q`. Used to format values the same way as the
+        python CSV generators (see `copy_csv_value` and `copy_csv_percent`).
+        Any `%` is escaped, so it isn't taken for a parameter placeholder.
 
     Returns
     -------
-    str
-        Query to be passed to SQL connection. The query returns
-        obs_date, obs_area_wet, obs_pc_wet, obs_area_dry,
-        obs_pc_dry, obs_area_invalid, obs_pc_invalid, obs_area, obs_pc
+    sql.Composed
+        COPY statement, NULL values are written as `None`. The rows are
+        written in the order they are returned by the query.
     """
+    return sql.SQL(
+        "COPY (SELECT {} FROM ({}) AS q) TO STDOUT WITH (FORMAT csv, NULL 'None')"
+    ).format(
+        sql.SQL(", ").join(sql.SQL(column.replace("%", "%%")) for column in columns),
+        query,
+    )
 
-    query = f"""
-        WITH uids_from_wb_id AS (
-            SELECT
-                uid
-            FROM
-                waterbodies_historical_extent
-            WHERE
-                wb_id = {wb_id}
-        ),
-        wb AS (
+
+OBSERVATION_COLUMNS = [
+    "date",
+    "area_wet_m2",
+    "percent_wet",
+    "area_dry_m2",
+    "percent_dry",
+    "area_invalid_m2",
+    "percent_invalid",
+    "area_observed_m2",
+    "percent_observed",
+]
+
+
+def copy_csv_value(column: str) -> str:
+    """
+    Returns the SQL expression for a COPY column (see `copy_csv_query`) that
+    writes a value the same way as the python CSV generators, which write
+    `str` of the value loaded by psycopg. Postgres writes floats with the
+    same shortest round trip digits as python (with the default
+    `extra_float_digits`), but python adds `.0` to whole numbers, only uses
+    an exponent from 1e16 and spells NaN and infinity differently. Values of
+    other types are written as postgres formats them.
+    """
+    text = f"{column}::text"
+    return f"""CASE
+        WHEN pg_typeof({column}) <> 'double precision'::regtype THEN {text}
+        WHEN {text} = 'NaN' THEN 'nan'
+        WHEN {text} = 'Infinity' THEN 'inf'
+        WHEN {text} = '-Infinity' THEN '-inf'
+        ELSE regexp_replace(
+            CASE WHEN {text} LIKE '%e+15' THEN {text}::numeric::text ELSE {text} END,
+            '^(-?[0-9]+)$',
+            '\\1.0'
+        )
+    END"""
+
+
+def copy_csv_percent(column: str) -> str:
+    """
+    Returns the SQL expression for a COPY column that writes a double
+    precision value the same way as python's `f"{value:.2f}"`, which rounds
+    the exact binary value of the float half to even. Rounding the shortest
+    decimal written by postgres can give a different result (eg; 2.675 is
+    2.67499999... as a float), so the exact value is computed as a numeric
+    by scaling the float by a power of 2 to a whole number.
+    """
+    text = f"{column}::text"
+    return f"""CASE
+        WHEN {text} = 'NaN' THEN 'nan'
+        WHEN {text} = 'Infinity' THEN 'inf'
+        WHEN {text} = '-Infinity' THEN '-inf'
+        ELSE CASE WHEN {text} LIKE '-%' THEN '-' ELSE '' END || (
+            SELECT round(
+                CASE
+                    WHEN exact * 100 % 1 = 0.5
+                    THEN trunc(exact, 2) + trunc(exact, 2) * 100 % 2 * 0.01
+                    ELSE round(exact, 2)
+                END,
+                2
+            )::text
+            FROM (
+                SELECT CASE
+                    WHEN value < 0.001 THEN 0
+                    WHEN scale > 0
+                    THEN round((value * 2::float8 ^ scale)::bigint::numeric, scale)
+                        / 2::numeric ^ scale
+                    ELSE (value * 2::float8 ^ scale)::bigint::numeric * 2::numeric ^ -scale
+                END AS exact
+                FROM (
+                    SELECT
+                        abs({column}) AS value,
+                        53 - floor(ln(greatest(abs({column}), 0.001)) / ln(2))::integer
+                            AS scale
+                ) AS f
+            ) AS e
+        )
+    END"""
+
+
+# COPY columns matching the formatting of OBSERVATION_COLUMNS in the CSV
+# generators, where percentages are rounded to 2 decimal places
+OBSERVATION_COPY_COLUMNS = ["q.date::date"] + [
+    (
+        copy_csv_percent(f"q.{col}")
+        if col.startswith("percent")
+        else copy_csv_value(f"q.{col}")
+    )
+    for col in OBSERVATION_COLUMNS[1:]
+]
+
+
+WATERBODY_QUERY = Statement(
+    name="waterbody",
+    params=(("wb_id", "bigint"),),
+    query="""
+    SELECT uid, wb_id, area_m2
+    FROM waterbodies_historical_extent
+    WHERE wb_id = {wb_id}
+    """,
+    prepared=True,
+)
+
+
+# Returns the metadata of up to `{limit}` waterbodies, used to preload the
+# waterbody index at startup
+WATERBODIES_QUERY = Statement(
+    name="waterbodies",
+    params=(("limit", "bigint"),),
+    query="""
+    SELECT uid, wb_id, area_m2
+    FROM waterbodies_historical_extent
+    LIMIT {limit}
+    """,
+)
+
+
+# Returns the GeoJSON feature of a waterbody as text, so it can be sent
+# without being parsed. The geometry is simplified with the given
+# `{tolerance}` (in degrees, 0 to not simplify), and coordinates are written
+# with at most `{precision}` decimal places (9 is the ST_AsGeoJSON default).
+WATERBODY_GEOMETRY_QUERY = Statement(
+    name="waterbody_geometry",
+    params=(("wb_id", "bigint"), ("tolerance", "float8"), ("precision", "integer")),
+    query="""
+    SELECT
+    jsonb_build_object(
+        'type', 'Feature',
+        'id', wb_id,
+        'geometry', ST_AsGeoJSON(
+            CASE
+                WHEN {tolerance} > 0
+                THEN ST_SimplifyPreserveTopology(geometry, {tolerance})
+                ELSE geometry
+            END,
+            {precision}
+        )::jsonb,
+        'properties', jsonb_build_object('id', wb_id)
+    )::text as geojson
+    FROM waterbodies_historical_extent
+    WHERE wb_id = {wb_id}
+    """,
+    prepared=True,
+)
+
+
+# Returns a GeoJSON feature (as text) for each waterbody whose geometry
+# intersects the bbox, with at least `{min_area_m2}` area, and a wb_id after
+# `{after_wb_id}`. Results are paged by wb_id (keyset pagination), so each
+# page is a GiST index scan of the bbox rather than a scan of all the
+# waterbodies before an OFFSET. Geometries are stored as EPSG:4326.
+WATERBODIES_BBOX_QUERY = Statement(
+    name="waterbodies_bbox",
+    params=(
+        ("min_x", "float8"),
+        ("min_y", "float8"),
+        ("max_x", "float8"),
+        ("max_y", "float8"),
+        ("min_area_m2", "float8"),
+        ("after_wb_id", "bigint"),
+        ("limit", "integer"),
+    ),
+    query="""
+    SELECT
+    wb_id,
+    jsonb_build_object(
+        'type', 'Feature',
+        'id', wb_id,
+        'geometry', ST_AsGeoJSON(geometry)::jsonb,
+        'properties', jsonb_build_object('id', wb_id, 'uid', uid, 'area_m2', area_m2)
+    )::text as geojson
+    FROM waterbodies_historical_extent
+    WHERE ST_Intersects(
+        geometry, ST_MakeEnvelope({min_x}, {min_y}, {max_x}, {max_y}, 4326)
+    )
+    AND area_m2 >= {min_area_m2}
+    AND wb_id > {after_wb_id}
+    ORDER BY wb_id
+    LIMIT {limit}
+    """,
+)
+
+
+# Extent (size in tile coordinates) of the vector tiles, and the buffer of
+# each tile in the same units so polygons crossing tile edges are rendered
+# without gaps
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+# Waterbodies with a smaller area (in square tile coordinates) than this
+# aren't included in a tile, about a pixel when a tile is drawn at 512px.
+# Otherwise the tiles of low zoom levels would include every waterbody in a
+# large part of the continent, most of which would be too small to see.
+TILE_MIN_AREA = (TILE_EXTENT / 512) ** 2
+
+# Returns a Mapbox Vector Tile of the waterbodies in a web mercator
+# (EPSG:3857) z/x/y tile, with a `waterbodies` layer that includes the wb_id,
+# uid and area_m2 of each waterbody. The wb_id is also the feature id, it's
+# selected twice as the feature id column isn't kept in the properties.
+# Geometries are simplified to the size of a tile coordinate at the zoom
+# level, anything smaller than this isn't visible once the geometry is
+# snapped to the tile grid. Waterbodies smaller than TILE_MIN_AREA are
+# skipped, the size of a tile coordinate in metres shrinks with the cosine
+# of the latitude (of the tile's centre) in web mercator.
+WATERBODIES_TILE_QUERY = Statement(
+    name="waterbodies_tile",
+    params=(("z", "integer"), ("x", "integer"), ("y", "integer")),
+    query=f"""
+    WITH bounds AS (
+        SELECT
+            ST_TileEnvelope({{z}}, {{x}}, {{y}}) AS geom,
+            ST_Transform(
+                ST_TileEnvelope(
+                    {{z}}, {{x}}, {{y}}, margin => {TILE_BUFFER / TILE_EXTENT}
+                ),
+                4326
+            ) AS geom_4326,
+            (ST_XMax(ST_TileEnvelope(0, 0, 0)) - ST_XMin(ST_TileEnvelope(0, 0, 0)))
+                / ({TILE_EXTENT} * 2 ^ {{z}}) AS tolerance
+    ),
+    mvtgeom AS (
+        SELECT
+            wb.wb_id AS feature_id,
+            wb.wb_id,
+            wb.uid,
+            wb.area_m2,
+            ST_AsMVTGeom(
+                ST_Simplify(ST_Transform(wb.geometry, 3857), bounds.tolerance),
+                bounds.geom,
+                {TILE_EXTENT},
+                {TILE_BUFFER},
+                true
+            ) AS geom
+        FROM waterbodies_historical_extent AS wb, bounds
+        WHERE wb.geometry && bounds.geom_4326
+        AND wb.area_m2 >= {TILE_MIN_AREA} * (
+            bounds.tolerance * cos(radians(ST_Y(ST_Centroid(bounds.geom_4326))))
+        ) ^ 2
+    )
+    SELECT ST_AsMVT(mvtgeom, 'waterbodies', {TILE_EXTENT}, 'geom', 'feature_id')
+    FROM mvtgeom
+    WHERE geom IS NOT NULL
+    """,
+    prepared=True,
+)
+
+
+# Table of the observed areas of each waterbody summed by date, this is
+# what the `waterbody_stats` CTE below computes from the scene observations
+# on every request. It's created by migration 5 (see `app.schema`) and
+# refreshed by `app.aggregates`.
+OBSERVATION_AGGREGATES_TABLE = "waterbodies_observations_daily"
+
+# Sums of the scene observations of every waterbody by date, excluding the
+# percentages as they depend on the area of the waterbody's historical
+# extent. Used to (re)build OBSERVATION_AGGREGATES_TABLE from `{since}`.
+OBSERVATION_AGGREGATES_QUERY = Statement(
+    name="observation_aggregates",
+    params=(("since", "date"),),
+    query="""
+    SELECT 
+        uid, 
+        date, 
+        SUM(area_wet_m2) AS area_wet_m2, 
+        SUM(area_dry_m2) AS area_dry_m2, 
+        SUM(area_invalid_m2) AS area_invalid_m2, 
+        SUM(area_wet_m2 + area_dry_m2 + area_invalid_m2) AS area_observed_m2 
+    FROM 
+        waterbodies_observations 
+    WHERE 
+        date >= {since}
+    GROUP BY 
+        uid, date
+    """,
+)
+
+
+def _waterbody_stats_cte(aggregated: bool) -> str:
+    if aggregated:
+        # The sums by date are read from an index range scan of the
+        # aggregates table, rather than computed from the scene observations
+        return f"""
+        waterbody_stats AS (
             SELECT 
-                uid, 
-                area_m2 AS actual_area_m2 
+                wb.wb_id, 
+                woa.date, 
+                woa.area_wet_m2, 
+                woa.area_dry_m2, 
+                woa.area_invalid_m2, 
+                woa.area_observed_m2, 
+                wb.actual_area_m2 
             FROM 
-                waterbodies_historical_extent
-            WHERE uid = (SELECT uid FROM uids_from_wb_id LIMIT 1)
-        ),
+                {OBSERVATION_AGGREGATES_TABLE} AS woa 
+            INNER JOIN 
+                wb ON woa.uid = wb.uid 
+            WHERE 
+                woa.date BETWEEN {{start_date}} AND {{end_date}}
+        ), """
+    return """
         wbo AS (
             SELECT 
                 wo.*, 
+                wb.wb_id, 
                 wb.actual_area_m2 
             FROM 
                 waterbodies_observations AS wo 
             INNER JOIN 
                 wb ON wo.uid = wb.uid 
             WHERE 
-                wo.date BETWEEN '{start_date}' AND '{end_date}'
+                wo.date BETWEEN {start_date} AND {end_date}
         ),
         waterbody_stats AS (
             SELECT 
+                wb_id, 
                 date, 
                 SUM(area_wet_m2) AS area_wet_m2, 
                 SUM(area_dry_m2) AS area_dry_m2, 
@@ -61,10 +414,41 @@ def waterbody_observations_query(wb_id: int, start_date: date, end_date: date) -
             FROM 
                 wbo 
             GROUP BY 
-                date, actual_area_m2
-        ), 
+                wb_id, date, actual_area_m2
+        ), """
+
+
+def _waterbody_observations_ctes(wb: str, aggregated: bool = False) -> str:
+    """
+    Builds the chain of CTEs that aggregate and filter the observations
+    of one or more waterbodies. Both the single and the batch observation
+    queries select from the final `filtered_stats` CTE so the numbers they
+    return are always the same.
+
+    Parameters
+    ----------
+    wb : str
+        Body of a CTE that returns the `wb_id`, `uid` and `actual_area_m2`
+        columns for each of the waterbodies to get observations for.
+    aggregated : bool
+        Read the sums of the observations by date from
+        OBSERVATION_AGGREGATES_TABLE, instead of the scene observations.
+
+    Returns
+    -------
+    str
+        WITH clause ending in the `filtered_stats` CTE, which includes the
+        wb_id column followed by OBSERVATION_COLUMNS. Observations are
+        limited to the `{start_date}` and `{end_date}` parameters.
+    """
+
+    return f"""
+        WITH wb AS (
+            {wb}
+        ),{_waterbody_stats_cte(aggregated)}
         waterbody_stats_pc AS (
             SELECT 
+                wb_id, 
                 date, 
                 area_wet_m2, 
                 (area_wet_m2/actual_area_m2) * 100 AS percent_wet, 
@@ -85,9 +469,130 @@ def waterbody_observations_query(wb_id: int, start_date: date, end_date: date) -
             WHERE 
                 percent_observed > 85 AND percent_invalid < 5
         )
-        SELECT * from filtered_stats ORDER BY date
     """
-    return query
+
+
+def _waterbody_observations_query(name: str, aggregated: bool) -> Statement:
+    return Statement(
+        name=name,
+        params=(
+            ("wb_id", "bigint"),
+            ("uid", "text"),
+            ("area_m2", "float8"),
+            ("start_date", "date"),
+            ("end_date", "date"),
+        ),
+        query=_waterbody_observations_ctes(
+            """
+            SELECT
+                {wb_id} AS wb_id, {uid} AS uid, {area_m2} AS actual_area_m2
+        """,
+            aggregated,
+        )
+        + f"""
+        SELECT {", ".join(OBSERVATION_COLUMNS)} from filtered_stats ORDER BY date
+    """,
+    )
+
+
+def _waterbodies_observations_query(name: str, aggregated: bool) -> Statement:
+    return Statement(
+        name=name,
+        params=(("wb_ids", "bigint[]"), ("start_date", "date"), ("end_date", "date")),
+        query=_waterbody_observations_ctes(
+            """
+            SELECT DISTINCT ON (wb_id)
+                wb_id, uid, area_m2 AS actual_area_m2
+            FROM
+                waterbodies_historical_extent
+            WHERE
+                wb_id = ANY({wb_ids})
+            ORDER BY
+                wb_id
+        """,
+            aggregated,
+        )
+        + f"""
+        SELECT wb_id, {", ".join(OBSERVATION_COLUMNS)} from filtered_stats ORDER BY wb_id, date
+    """,
+    )
+
+
+# Returns obs_date, obs_area_wet, obs_pc_wet, obs_area_dry, obs_pc_dry,
+# obs_area_invalid, obs_pc_invalid, obs_area, obs_pc for a single waterbody.
+# The uid and area_m2 of the waterbody have already been looked up by the
+# caller (using WATERBODY_QUERY), so they are passed in as parameters.
+WATERBODY_OBSERVATIONS_QUERY = _waterbody_observations_query(
+    "waterbody_observations", aggregated=False
+)
+
+# Returns wb_id followed by the same columns as WATERBODY_OBSERVATIONS_QUERY
+# for many waterbodies, ordered by wb_id and date. IDs that do not match a
+# waterbody are ignored.
+WATERBODIES_OBSERVATIONS_QUERY = _waterbodies_observations_query(
+    "waterbodies_observations", aggregated=False
+)
+
+# The same queries reading from OBSERVATION_AGGREGATES_TABLE, these return
+# the same rows as long as the table has been refreshed since the latest
+# observations were loaded
+WATERBODY_OBSERVATIONS_AGGREGATED_QUERY = _waterbody_observations_query(
+    "waterbody_observations_aggregated", aggregated=True
+)
+WATERBODIES_OBSERVATIONS_AGGREGATED_QUERY = _waterbodies_observations_query(
+    "waterbodies_observations_aggregated", aggregated=True
+)
+
+
+def observations_queries(aggregated: bool) -> Tuple[Statement, Statement]:
+    """
+    Returns the single and batch waterbody observations statements, reading
+    from OBSERVATION_AGGREGATES_TABLE if `aggregated` is set (ie; the table
+    is available).
+    """
+    if aggregated:
+        return (
+            WATERBODY_OBSERVATIONS_AGGREGATED_QUERY,
+            WATERBODIES_OBSERVATIONS_AGGREGATED_QUERY,
+        )
+    return WATERBODY_OBSERVATIONS_QUERY, WATERBODIES_OBSERVATIONS_QUERY
+
+
+def _data_version_query(name: str, table: str) -> Statement:
+    return Statement(
+        name=name,
+        params=(("uid", "text"),),
+        query=f"""
+    SELECT max(date), count(*)
+    FROM {table}
+    WHERE uid = {{uid}}
+    """,
+        prepared=True,
+    )
+
+
+# Return the latest date and number of rows of a waterbody's observations,
+# or water quality summaries. These only change when new data is loaded, so
+# are used as a cheap version of the data for conditional (ETag) requests.
+OBSERVATIONS_VERSION_QUERY = _data_version_query(
+    "observations_version", "waterbodies_observations"
+)
+OBSERVATIONS_AGGREGATED_VERSION_QUERY = _data_version_query(
+    "observations_aggregated_version", OBSERVATION_AGGREGATES_TABLE
+)
+WATER_QUALITY_VERSION_QUERY = _data_version_query(
+    "water_quality_version", "waterbodies_water_quality"
+)
+
+# Statements prepared on every pooled connection when the app is prewarmed
+PREPARED_STATEMENTS = [
+    WATERBODY_QUERY,
+    WATERBODY_GEOMETRY_QUERY,
+    WATERBODIES_TILE_QUERY,
+    OBSERVATIONS_VERSION_QUERY,
+    OBSERVATIONS_AGGREGATED_VERSION_QUERY,
+    WATER_QUALITY_VERSION_QUERY,
+]
 
 
 WQ_COLUMNS = [
@@ -168,34 +673,89 @@ WQ_COLUMNS = [
 ]
 
 
-def waterbody_water_quality_summary_query(wb_id: int, start_date: date, end_date: date):
+class WQVariable(str, Enum):
+    hue = "hue"
+    owt = "owt"
+    chla = "chla"
+    tsi = "tsi"
+    tsm = "tsm"
+    st_max = "st_max"
+    st_median = "st_median"
+    st_min = "st_min"
+    fai_cover = "fai_cover"
+    ndvi_cover = "ndvi_cover"
 
-    columns = ", ".join(f"wq.{col}" for col in WQ_COLUMNS)
 
-    query = f"""
-    SELECT wq.date, {columns}                       
+class WQQuantile(str, Enum):
+    q0_1 = "0.1"
+    q0_2 = "0.2"
+    q0_3 = "0.3"
+    q0_4 = "0.4"
+    q0_5 = "0.5"
+    q0_6 = "0.6"
+    q0_7 = "0.7"
+    q0_8 = "0.8"
+    q0_9 = "0.9"
+
+
+def water_quality_columns(
+    variables: Optional[List[WQVariable]] = None,
+    quantiles: Optional[List[WQQuantile]] = None,
+) -> List[str]:
+    """
+    Selects the water quality summary columns for a subset of the variables
+    and quantiles. As the columns are taken from WQ_COLUMNS (in the same
+    order) only known column names can be included in a query.
+
+    Parameters
+    ----------
+    variables : Optional[List[WQVariable]]
+        Variables to include, all variables if None.
+    quantiles : Optional[List[WQQuantile]]
+        Quantiles of each variable to include, all quantiles if None. This
+        doesn't apply to the fai_cover and ndvi_cover variables.
+
+    Returns
+    -------
+    List[str]
+        Subset of WQ_COLUMNS
+    """
+    included = set()
+    for variable in variables or list(WQVariable):
+        if variable.value in WQ_COLUMNS:
+            included.add(variable.value)
+        for quantile in quantiles or list(WQQuantile):
+            included.add(f"{variable.value}_{quantile.name}")
+    return [col for col in WQ_COLUMNS if col in included]
+
+
+def water_quality_summary_query(columns: List[str]) -> Statement:
+    """
+    Returns the water quality summary statement for the given columns,
+    which must be a subset of WQ_COLUMNS (see `water_quality_columns`).
+    """
+    assert set(columns) <= set(WQ_COLUMNS)
+    return Statement(
+        name="waterbody_water_quality_summary",
+        params=(("uid", "text"), ("start_date", "date"), ("end_date", "date")),
+        query=f"""
+    SELECT wq.date, {", ".join(f"wq.{col}" for col in columns)}
     FROM waterbodies_water_quality AS wq 
-    WHERE wq.uid = (
-        SELECT uid
-        FROM waterbodies_historical_extent
-        WHERE wb_id = {wb_id}
-        LIMIT 1
-    )
-    AND wq.date BETWEEN '{start_date}' AND '{end_date}' 
+    WHERE wq.uid = {{uid}}
+    AND wq.date BETWEEN {{start_date}} AND {{end_date}} 
     ORDER BY wq.date
-    """
-    return query
+    """,
+    )
 
 
-def waterbody_water_quality_maps_query(wb_id: int, start_date: date, end_date: date):
-    query = f"""
-    WITH wb AS (
-        SELECT uid, area_m2 AS actual_area_m2
-        FROM waterbodies_historical_extent
-        WHERE wb_id = {wb_id}
-        LIMIT 1
-    ),
-    wq_stats AS (
+WATER_QUALITY_SUMMARY_QUERY = water_quality_summary_query(WQ_COLUMNS)
+
+
+WATER_QUALITY_MAPS_QUERY = Statement(
+    name="waterbody_water_quality_maps",
+    params=(("uid", "text"), ("start_date", "date"), ("end_date", "date")),
+    query="""
+    WITH wq_stats AS (
         SELECT 
             wq.date, 
             wq.tsi_q0_5 AS median_tsi, 
@@ -205,40 +765,211 @@ def waterbody_water_quality_maps_query(wb_id: int, start_date: date, end_date: d
             wq.st_min_q0_5 AS min_surface_temperature,
             wq.fai_cover
         FROM waterbodies_water_quality AS wq 
-        INNER JOIN wb ON wq.uid = wb.uid
-        WHERE wq.date BETWEEN '{start_date}' AND '{end_date}'
+        WHERE wq.uid = {uid}
+        AND wq.date BETWEEN {start_date} AND {end_date}
     )
     SELECT 
         wq.*
     FROM wq_stats AS wq
-    ORDER BY wq.date;
-    """
-    return query
-
-
-def waterbody_water_quality_ranking_query(wb_id: int):
-    required_columns = [
-        "fai_cover_percentile",
-        "ndvi_cover_percentile",
-        "hue_q0_5_percentile",
-        "owt_q0_5_percentile",
-        "chla_q0_5_percentile",
-        "tsi_q0_5_percentile",
-        "tsm_q0_5_percentile",
-        "st_max_q0_5_percentile",
-        "st_median_q0_5_percentile",
-        "st_min_q0_5_percentile",
-    ]
-    columns = ", ".join(f"wqp.{col}" for col in required_columns)
+    ORDER BY wq.date
+    """,
+)
 
-    query = f"""
-    SELECT {columns}                       
+WQ_MAPS_COLUMNS = [
+    "median_tsi",
+    "median_tsm",
+    "median_surface_temperature",
+    "max_surface_temperature",
+    "min_surface_temperature",
+    "fai_cover",
+]
+
+WQ_MAPS_COPY_COLUMNS = ["q.date::date"] + [
+    copy_csv_value(f"q.{col}") for col in WQ_MAPS_COLUMNS
+]
+
+
+WQ_RANKING_COLUMNS = [
+    "fai_cover_percentile",
+    "ndvi_cover_percentile",
+    "hue_q0_5_percentile",
+    "owt_q0_5_percentile",
+    "chla_q0_5_percentile",
+    "tsi_q0_5_percentile",
+    "tsm_q0_5_percentile",
+    "st_max_q0_5_percentile",
+    "st_median_q0_5_percentile",
+    "st_min_q0_5_percentile",
+]
+
+WQ_RANKING_COPY_COLUMNS = [copy_csv_value(f"q.{col}") for col in WQ_RANKING_COLUMNS]
+
+
+WATER_QUALITY_RANKING_QUERY = Statement(
+    name="waterbody_water_quality_ranking",
+    params=(("uid", "text"),),
+    query=f"""
+    SELECT {", ".join(f"wqp.{col}" for col in WQ_RANKING_COLUMNS)}
     FROM waterbodies_water_quality_percentiles AS wqp 
-    WHERE wqp.uid = (
-        SELECT uid
-        FROM waterbodies_historical_extent
-        WHERE wb_id = {wb_id}
-        LIMIT 1
+    WHERE wqp.uid = {{uid}}
+    """,
+)
+
+
+# Water quality ranking columns that waterbodies can be sorted by
+WQRankingColumn = Enum(
+    "WQRankingColumn", {col: col for col in WQ_RANKING_COLUMNS}, type=str
+)
+
+
+class SortOrder(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+
+def water_quality_leaderboard_query(
+    column: str,
+    order: SortOrder,
+    bbox: bool = False,
+    wb_ids: bool = False,
+    after: bool = False,
+) -> Statement:
+    """
+    Returns the statement that ranks waterbodies by one of their water
+    quality ranking columns, skipping waterbodies without a value. Each
+    column has an index of (column, uid) (see app.schema), so a page of the
+    ranking is read in order from the index rather than sorting every
+    waterbody.
+
+    Parameters
+    ----------
+    column : str
+        Column to sort by, one of WQ_RANKING_COLUMNS.
+    order : SortOrder
+        Sort order of the column, ties are ordered by uid in the same order.
+    bbox : bool
+        Only include waterbodies that intersect the `{min_x}`, `{min_y}`,
+        `{max_x}`, `{max_y}` bbox (in EPSG:4326).
+    wb_ids : bool
+        Only include the waterbodies in the `{wb_ids}` array.
+    after : bool
+        Only include waterbodies after the `{after_value}`, `{after_uid}`
+        (the last row of the previous page) in the ranking (keyset
+        pagination).
+
+    Returns
+    -------
+    Statement
+        Statement returning the uid, wb_id, area_m2 and column value of up to
+        `{limit}` waterbodies.
+    """
+    assert column in WQ_RANKING_COLUMNS
+    direction = "DESC" if order == SortOrder.desc else "ASC"
+    params: List[Tuple[str, str]] = []
+    conditions = [f"wqp.{column} IS NOT NULL"]
+    if bbox:
+        params += [(name, "float8") for name in ("min_x", "min_y", "max_x", "max_y")]
+        conditions.append(
+            "ST_Intersects("
+            "e.geometry, ST_MakeEnvelope({min_x}, {min_y}, {max_x}, {max_y}, 4326))"
+        )
+    if wb_ids:
+        params.append(("wb_ids", "bigint[]"))
+        conditions.append("e.wb_id = ANY({wb_ids})")
+    if after:
+        params += [("after_value", "float8"), ("after_uid", "text")]
+        comparison = "<" if order == SortOrder.desc else ">"
+        conditions.append(
+            f"(wqp.{column}, wqp.uid) {comparison} ({{after_value}}, {{after_uid}})"
+        )
+    params.append(("limit", "integer"))
+    return Statement(
+        name="waterbodies_water_quality_leaderboard",
+        params=tuple(params),
+        query=f"""
+    SELECT wqp.uid, e.wb_id, e.area_m2, wqp.{column}
+    FROM waterbodies_water_quality_percentiles AS wqp
+    JOIN waterbodies_historical_extent AS e ON e.uid = wqp.uid
+    WHERE {" AND ".join(conditions)}
+    ORDER BY wqp.{column} {direction}, wqp.uid {direction}
+    LIMIT {{limit}}
+    """,
     )
+
+
+class Interval(str, Enum):
+    day = "day"
+    month = "month"
+    season = "season"
+    year = "year"
+
+
+# Expressions for the start date of the period each row's date falls in.
+# Seasons are the meteorological seasons (DJF, MAM, JJA, SON), so the
+# December of one year is in the same season as the following Jan and Feb.
+INTERVAL_PERIODS = {
+    Interval.day: "q.date::date",
+    Interval.month: "date_trunc('month', q.date)::date",
+    Interval.season: (
+        "(date_trunc('quarter', q.date + interval '1 month') - interval '1 month')::date"
+    ),
+    Interval.year: "date_trunc('year', q.date)::date",
+}
+
+RESAMPLE_STATISTICS = ["mean", "min", "max"]
+
+
+def resampled_columns(columns: List[str]) -> List[str]:
+    """
+    Returns the columns of a resampled query (after the date column), the
+    number of rows in each period followed by the statistics of each of the
+    given columns.
+    """
+    return ["count"] + [
+        f"{col}_{statistic}" for col in columns for statistic in RESAMPLE_STATISTICS
+    ]
+
+
+def resampled_query(
+    statement: Statement, columns: List[str], interval: Interval
+) -> Statement:
     """
-    return query
+    Resamples the rows of a statement to a time interval, by aggregating all
+    the rows within each period in the database.
+
+    Parameters
+    ----------
+    statement : Statement
+        Statement that returns a date column, along with the columns to be
+        aggregated.
+    columns : List[str]
+        Columns of the statement to aggregate.
+    interval : Interval
+        Length of each period.
+
+    Returns
+    -------
+    Statement
+        Statement with the same parameters, returning the start date of
+        each period followed by `resampled_columns(columns)`, ordered by
+        date. This is prepared if the original statement is.
+    """
+    aggregates = ", ".join(
+        f"avg(q.{col}) AS {col}_mean, min(q.{col}) AS {col}_min, max(q.{col}) AS {col}_max"
+        for col in columns
+    )
+    query = f"""
+    SELECT
+        {INTERVAL_PERIODS[interval]} AS date,
+        count(*) AS count,
+        {aggregates}
+    FROM ({statement.query}) AS q
+    GROUP BY 1
+    ORDER BY 1
+    """
+    return Statement(
+        name=f"{statement.name}_{interval.value}",
+        params=statement.params,
+        query=query,
+        prepared=statement.prepared,
+    )
@@ -0,0 +1,345 @@
+import logging
+from contextlib import nullcontext
+from datetime import date
+from typing import Callable, Dict, List, NamedTuple, Sequence
+
+import psycopg
+from psycopg import AsyncConnection, sql
+
+from app.queries import (
+    OBSERVATION_AGGREGATES_QUERY,
+    OBSERVATION_AGGREGATES_TABLE,
+    WQ_COLUMNS,
+    WQ_RANKING_COLUMNS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Observation tables are partitioned by the year of their date, so queries
+# for a date range only scan the partitions in the range (partition
+# pruning). Rows outside of these years go to a default partition.
+PARTITIONED_TABLES = ["waterbodies_observations", "waterbodies_water_quality"]
+PARTITION_YEARS = range(1986, 2041)
+
+# table name -> column definitions (and partitioning) of the tables the API
+# reads, as loaded from the database dumps
+TABLES: Dict[str, str] = {
+    "waterbodies_historical_extent": """(
+        uid text NOT NULL,
+        wb_id bigint NOT NULL,
+        area_m2 double precision NOT NULL,
+        geometry geometry(Polygon, 4326) NOT NULL
+    )""",
+    "waterbodies_observations": """(
+        uid text NOT NULL,
+        date timestamp NOT NULL,
+        area_wet_m2 double precision,
+        area_dry_m2 double precision,
+        area_invalid_m2 double precision
+    ) PARTITION BY RANGE (date)""",
+    "waterbodies_water_quality": f"""(
+        uid text NOT NULL,
+        date timestamp NOT NULL,
+        {", ".join(f"{col} double precision" for col in WQ_COLUMNS)}
+    ) PARTITION BY RANGE (date)""",
+    "waterbodies_water_quality_percentiles": f"""(
+        uid text NOT NULL,
+        {", ".join(f"{col} double precision" for col in WQ_RANKING_COLUMNS)}
+    )""",
+}
+
+# index name -> table and definition, of the indexes the queries in
+# app.queries depend on, as created by migration 3 (see MIGRATIONS). Each
+# migration creates its own fixed set of indexes, so indexes added later
+# are created by a new migration rather than changing what an applied
+# migration does.
+QUERY_INDEXES: Dict[str, str] = {
+    # bbox queries (WATERBODIES_BBOX_QUERY) and tiles
+    "waterbodies_historical_extent_geometry_idx": (
+        "waterbodies_historical_extent USING gist (geometry)"
+    ),
+    # wb_id lookups (WATERBODY_QUERY) are answered from the index alone, and
+    # keyset pagination of the bbox queries
+    "waterbodies_historical_extent_wb_id_uid_idx": (
+        "waterbodies_historical_extent (wb_id) INCLUDE (uid, area_m2)"
+    ),
+    "waterbodies_historical_extent_uid_idx": "waterbodies_historical_extent (uid)",
+    # each waterbody's observations in a date range, including the summed
+    # columns so the observations queries are index only scans
+    "waterbodies_observations_uid_date_idx": (
+        "waterbodies_observations (uid, date) "
+        "INCLUDE (area_wet_m2, area_dry_m2, area_invalid_m2)"
+    ),
+    # each waterbody's water quality in a date range, including the columns
+    # of the maps query (WATER_QUALITY_MAPS_QUERY), so the version and maps
+    # queries are index only scans
+    "waterbodies_water_quality_uid_date_idx": (
+        "waterbodies_water_quality (uid, date) INCLUDE "
+        "(tsi_q0_5, tsm_q0_5, st_median_q0_5, st_max_q0_5, st_min_q0_5, fai_cover)"
+    ),
+    "waterbodies_water_quality_percentiles_uid_idx": (
+        "waterbodies_water_quality_percentiles (uid)"
+    ),
+}
+
+# Indexes replaced by QUERY_INDEXES, that are dropped once their replacement
+# exists
+REPLACED_INDEXES = ["waterbodies_historical_extent_wb_id_idx"]
+
+# Indexes of the rankings of waterbodies by each of the WQ_RANKING_COLUMNS
+# (see water_quality_leaderboard_query), read in either direction. Created
+# by migration 4.
+WQ_RANKING_INDEXES: Dict[str, str] = {
+    "waterbodies_wq_rank_fai_cover_percentile_idx": (
+        "waterbodies_water_quality_percentiles (fai_cover_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_ndvi_cover_percentile_idx": (
+        "waterbodies_water_quality_percentiles (ndvi_cover_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_hue_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (hue_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_owt_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (owt_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_chla_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (chla_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_tsi_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (tsi_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_tsm_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (tsm_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_st_max_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (st_max_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_st_median_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (st_median_q0_5_percentile, uid)"
+    ),
+    "waterbodies_wq_rank_st_min_q0_5_percentile_idx": (
+        "waterbodies_water_quality_percentiles (st_min_q0_5_percentile, uid)"
+    ),
+}
+
+# Every index created by the migrations, which the server checks for at
+# startup
+INDEXES: Dict[str, str] = {**QUERY_INDEXES, **WQ_RANKING_INDEXES}
+
+
+def create_tables(conn: psycopg.Connection) -> None:
+    """Creates each of the TABLES that doesn't exist, partitioned tables
+    are created with a partition for each of PARTITION_YEARS"""
+    for table, columns in TABLES.items():
+        conn.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} {}").format(
+                sql.Identifier(table), sql.SQL(columns)
+            )
+        )
+        if table in PARTITIONED_TABLES:
+            create_partitions(conn, table)
+
+
+def create_partitions(conn: psycopg.Connection, table: str) -> None:
+    """Creates a partition of a table for each of PARTITION_YEARS (named eg;
+    `waterbodies_observations_y1987`), and a default partition"""
+    for year in PARTITION_YEARS:
+        conn.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                "FOR VALUES FROM ({}) TO ({})"
+            ).format(
+                sql.Identifier(f"{table}_y{year}"),
+                sql.Identifier(table),
+                sql.Literal(f"{year}-01-01"),
+                sql.Literal(f"{year + 1}-01-01"),
+            )
+        )
+    conn.execute(
+        sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+            sql.Identifier(f"{table}_default"), sql.Identifier(table)
+        )
+    )
+
+
+def partition_tables(conn: psycopg.Connection) -> None:
+    """
+    Converts the PARTITIONED_TABLES that were restored from a dump as plain
+    tables into tables partitioned by year. The rows are copied into the
+    new partitioned table, which replaces the original table.
+    """
+    for table in PARTITIONED_TABLES:
+        relkind = conn.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,)
+        ).fetchone()
+        if relkind is None or relkind[0] == "p":
+            continue
+        logger.info(f"Partitioning {table} by year")
+        original = sql.Identifier(table)
+        unpartitioned = sql.Identifier(f"{table}_unpartitioned")
+        conn.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(original, unpartitioned)
+        )
+        conn.execute(
+            sql.SQL(
+                "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                "PARTITION BY RANGE (date)"
+            ).format(original, unpartitioned)
+        )
+        create_partitions(conn, table)
+        cur = conn.execute(
+            sql.SQL("INSERT INTO {} SELECT * FROM {}").format(original, unpartitioned)
+        )
+        logger.info(f"Copied {cur.rowcount} rows into {table}")
+        conn.execute(sql.SQL("DROP TABLE {}").format(unpartitioned))
+
+
+def create_indexes(
+    conn: psycopg.Connection, indexes: Dict[str, str], replaced: Sequence[str] = ()
+) -> None:
+    """
+    Creates each of the indexes that doesn't exist, and drops the
+    `replaced` indexes. Indexes of plain tables are created concurrently, so
+    this can be run against a database that is serving requests, indexes of
+    partitioned tables can't be so block writes (but not reads) while
+    they're created. `conn` must be in autocommit mode as indexes can't be
+    created concurrently in a transaction.
+    """
+    tables = []
+    for name, definition in indexes.items():
+        table = definition.split()[0]
+        row = conn.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,)
+        ).fetchone()
+        if row is None:
+            logger.warning(f"Not creating index {name}, {table} doesn't exist")
+            continue
+        logger.info(f"Creating index {name}")
+        conn.execute(
+            sql.SQL("CREATE INDEX {} IF NOT EXISTS {} ON {}").format(
+                sql.SQL("CONCURRENTLY" if row[0] != "p" else ""),
+                sql.Identifier(name),
+                sql.SQL(definition),
+            )
+        )
+        if table not in tables:
+            tables.append(table)
+    for name in replaced:
+        conn.execute(
+            sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name))
+        )
+    # Keep the planner statistics up to date so the new indexes are used
+    for table in tables:
+        conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+
+
+def create_query_indexes(conn: psycopg.Connection) -> None:
+    """Migration 3, creates the QUERY_INDEXES and drops the REPLACED_INDEXES"""
+    create_indexes(conn, QUERY_INDEXES, REPLACED_INDEXES)
+
+
+def create_ranking_indexes(conn: psycopg.Connection) -> None:
+    """Migration 4, creates the WQ_RANKING_INDEXES"""
+    create_indexes(conn, WQ_RANKING_INDEXES)
+
+
+def create_observation_aggregates(conn: psycopg.Connection) -> None:
+    """
+    Migration 5, creates and populates the OBSERVATION_AGGREGATES_TABLE
+    (refreshed by app.aggregates) with the same column types as the scene
+    observations they are summed from, and a primary key on (uid, date) so
+    each waterbody's observations are read with an index range scan. A table
+    that already exists is kept.
+    """
+    exists = conn.execute(
+        "SELECT to_regclass(%s)", (OBSERVATION_AGGREGATES_TABLE,)
+    ).fetchone()[0]
+    if exists:
+        return
+    table = sql.Identifier(OBSERVATION_AGGREGATES_TABLE)
+    logger.info(f"Aggregating observations into {OBSERVATION_AGGREGATES_TABLE}")
+    # CREATE TABLE AS can't take server-side parameters, so they're merged
+    # into the query by a client-side binding cursor
+    cur = psycopg.ClientCursor(conn)
+    cur.execute(
+        sql.SQL("CREATE TABLE {} AS {}").format(
+            table, OBSERVATION_AGGREGATES_QUERY.sql()
+        ),
+        OBSERVATION_AGGREGATES_QUERY.values(since=date.min),
+    )
+    logger.info(f"Wrote {cur.rowcount} rows to {OBSERVATION_AGGREGATES_TABLE}")
+    conn.execute(sql.SQL("ALTER TABLE {} ADD PRIMARY KEY (uid, date)").format(table))
+    # Keep the planner statistics up to date so the range scans are used
+    conn.execute(sql.SQL("ANALYZE {}").format(table))
+
+
+def recreate_indexes(conn: psycopg.Connection) -> None:
+    """Creates any of the INDEXES that don't exist, eg; that have been
+    dropped since the migrations were applied"""
+    create_indexes(conn, INDEXES, REPLACED_INDEXES)
+
+
+async def missing_indexes(conn: AsyncConnection) -> List[str]:
+    """Returns the names of the INDEXES that don't exist in the database"""
+    cur = await conn.execute(
+        "SELECT indexname FROM pg_indexes WHERE indexname = ANY(%s)",
+        (list(INDEXES),),
+    )
+    existing = {name for (name,) in await cur.fetchall()}
+    return [name for name in INDEXES if name not in existing]
+
+
+class Migration(NamedTuple):
+    """
+    A versioned change to the database schema. Migrations are applied in
+    order of their version, each in a transaction unless `transaction` is
+    False (eg; to create indexes concurrently).
+    """
+
+    version: int
+    name: str
+    apply: Callable[[psycopg.Connection], None]
+    transaction: bool = True
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "create tables", create_tables),
+    Migration(2, "partition observations by year", partition_tables),
+    Migration(3, "create indexes", create_query_indexes, transaction=False),
+    Migration(
+        4,
+        "create water quality ranking indexes",
+        create_ranking_indexes,
+        transaction=False,
+    ),
+    Migration(5, "create observation aggregates", create_observation_aggregates),
+]
+
+
+def applied_migrations(conn: psycopg.Connection) -> Dict[int, str]:
+    """Returns the versions and names of the migrations that have been
+    applied to the database"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        )
+        """)
+    return dict(conn.execute("SELECT version, name FROM schema_migrations"))
+
+
+def migrate(conn: psycopg.Connection) -> List[Migration]:
+    """Applies the MIGRATIONS that haven't been applied, `conn` must be in
+    autocommit mode. Returns the migrations that were applied."""
+    applied = applied_migrations(conn)
+    pending = [m for m in MIGRATIONS if m.version not in applied]
+    for migration in pending:
+        logger.info(f"Applying migration {migration.version}: {migration.name}")
+        with conn.transaction() if migration.transaction else nullcontext():
+            migration.apply(conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (migration.version, migration.name),
+            )
+    return pending
@@ -0,0 +1,162 @@
+import asyncio
+import time
+from contextlib import aclosing
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import anyio
+from fastapi.responses import StreamingResponse
+from psycopg import AsyncCursor, sql
+from starlette.types import Receive, Scope, Send
+
+from app.metrics import count_rows
+from app.timing import record_timing
+
+# Buffered response data is sent once it reaches FLUSH_SIZE bytes, or once
+# FLUSH_INTERVAL seconds have passed since data was last sent
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.05
+
+# Number of rows fetched from the database at a time
+FETCH_SIZE = 2000
+
+
+async def buffered(
+    chunks: AsyncIterator[Union[str, bytes]],
+    flush_size: int = FLUSH_SIZE,
+    flush_interval: float = FLUSH_INTERVAL,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Async generator that collects the encoded chunks of a response into a
+    buffer, and yields the buffer once it reaches `flush_size` bytes or
+    `flush_interval` seconds have passed since it was last yielded. Every
+    yield is sent to the client as a separate ASGI message, so this cuts the
+    number of sends for large responses by orders of magnitude.
+
+    The first chunk (eg; a CSV header) is always yielded straight away. The
+    next chunk is awaited in a task, with a timeout of when the buffer is
+    due to be flushed, so buffered data is sent on time even when the next
+    chunk is slow to arrive (eg; a slow FETCH). The chunks generator is
+    closed when this generator is closed.
+    """
+    buffer = bytearray()
+    last_flush = float("-inf")
+    next_chunk: Optional[asyncio.Future] = None
+    async with aclosing(chunks):
+        try:
+            while True:
+                if next_chunk is None:
+                    next_chunk = asyncio.ensure_future(anext(chunks, None))
+                timeout = None
+                if buffer:
+                    timeout = max(last_flush + flush_interval - time.monotonic(), 0)
+                done, _ = await asyncio.wait([next_chunk], timeout=timeout)
+                if done:
+                    chunk = next_chunk.result()
+                    next_chunk = None
+                    if chunk is None:
+                        break
+                    buffer += chunk.encode() if isinstance(chunk, str) else chunk
+                now = time.monotonic()
+                if buffer and (
+                    len(buffer) >= flush_size or now - last_flush >= flush_interval
+                ):
+                    yield bytes(buffer)
+                    buffer.clear()
+                    last_flush = now
+        finally:
+            # The chunks generator can't be closed while the task is running
+            # it. Shielded, as this runs while the response is cancelled.
+            if next_chunk is not None:
+                next_chunk.cancel()
+                with anyio.CancelScope(shield=True):
+                    await asyncio.wait([next_chunk])
+    if buffer:
+        yield bytes(buffer)
+
+
+async def fetch_batches(
+    cursor: AsyncCursor,
+    query: sql.Composable,
+    params: Optional[Dict[str, Any]] = None,
+    size: int = FETCH_SIZE,
+) -> AsyncGenerator[List[Tuple], None]:
+    """
+    Async generator that runs the query with the given parameters and
+    yields lists of up to `size` rows. For a server-side (named) cursor
+    each batch is a separate FETCH, so only `size` rows are held in memory
+    at a time.
+    """
+    start = time.perf_counter()
+    await cursor.execute(query, params)
+    first_row = True
+    while True:
+        rows = await cursor.fetchmany(size)
+        now = time.perf_counter()
+        record_timing("db", now - start)
+        if first_row:
+            record_timing("first_row", now - start)
+            first_row = False
+        if not rows:
+            return
+        count_rows(len(rows))
+        yield rows
+        start = time.perf_counter()
+
+
+async def stream_copy(
+    cursor: AsyncCursor,
+    copy_query: sql.Composable,
+    params: Optional[Dict[str, Any]] = None,
+) -> AsyncGenerator[memoryview, None]:
+    """
+    Async generator that runs a `COPY ... TO STDOUT` query and yields the
+    data formatted by postgres. Postgres sends each row as a separate
+    message, so this should be passed through `buffered` before being sent.
+    The yielded data is only valid until the next row is read. COPY doesn't
+    accept parameters, so psycopg merges the parameters into the query.
+
+    If the generator is closed (eg; with `contextlib.aclosing`) or cancelled
+    before the COPY finishes, psycopg cancels the query on the server and
+    drains the connection, so it can be returned to the pool straight away.
+    """
+    start = time.perf_counter()
+    first_row = True
+    async with cursor.copy(copy_query, params) as copy:
+        async for data in copy:
+            now = time.perf_counter()
+            record_timing("db", now - start)
+            if first_row:
+                record_timing("first_row", now - start)
+                first_row = False
+            # each row is sent as a separate message
+            count_rows(1)
+            yield data
+            start = time.perf_counter()
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that closes its body generator once the response
+    ends. When the client disconnects, starlette cancels the stream but
+    leaves the generator suspended until it's garbage collected, holding its
+    pooled connection (and any running query) until then. Closing it runs
+    the generator's cleanup straight away, which cancels the query (see
+    `stream_copy`) and returns the connection to the pool.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # shielded, as this runs while the response task is cancelled
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
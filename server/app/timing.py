@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from pyinstrument import Profiler
+from pyinstrument.renderers import SpeedscopeRenderer
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Phases recorded while handling a request, with their Server-Timing
+# descriptions. "first_row" is the part of "db" until the first row of each
+# query was received.
+PHASES = {
+    "queue": "Admission queue",
+    "pool": "Pool checkout",
+    "lookup": "Waterbody lookup",
+    "db": "Database",
+    "first_row": "Time to first row",
+    "send": "Sending to client",
+    "total": "Until response start",
+}
+
+
+class RequestTimings:
+    """Seconds spent in each phase of handling a request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+# Timings of the current request, set for each request by the middleware.
+# Like the row count (see `app.metrics`) the object is shared with the tasks
+# the response is streamed from.
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("timings", default=None)
+
+
+def record_timing(phase: str, seconds: float) -> None:
+    """Adds to the time spent in a phase by the current request"""
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Context manager that adds the time spent in its block to a phase of
+    the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(phase, time.perf_counter() - start)
+
+
+def server_timing(phases: Dict[str, float]) -> str:
+    """Returns the Server-Timing header value for phases in seconds"""
+    return ", ".join(
+        f'{phase};desc="{PHASES.get(phase, phase)}";dur={seconds * 1000:.1f}'
+        for phase, seconds in phases.items()
+    )
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware that records how long each phase of a request took (see
+    `PHASES`), and sends the phases that completed before the response
+    started in a Server-Timing header. Phases of streamed responses continue
+    after the headers are sent, so the full breakdown is logged (as JSON)
+    once the response ends for requests slower than `log_threshold`
+    seconds. This includes the time spent waiting for the client to receive
+    the response ("send"), and the rest of the time ("python") spent
+    formatting, serializing and compressing the response.
+
+    Requests can be profiled with a sampling profiler, either a random
+    `profile_rate` fraction of requests, or requests with an X-Profile
+    header matching `profile_token`. The profile is written to
+    `profile_dir` in speedscope format (https://www.speedscope.app), which
+    shows it as a flame graph. Only one request is profiled at a time.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        log_threshold: float,
+        profile_dir: Path,
+        profile_rate: float = 0.0,
+        profile_token: Optional[str] = None,
+    ):
+        self.app = app
+        self.log_threshold = log_threshold
+        self.profile_dir = profile_dir
+        self.profile_rate = profile_rate
+        self.profile_token = profile_token
+        self._profiling = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        status: List[int] = [500]
+
+        async def send_with_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                phases = dict(timings.phases)
+                phases["total"] = time.perf_counter() - timings.start
+                headers = MutableHeaders(raw=message["headers"])
+                headers["Server-Timing"] = server_timing(phases)
+            start = time.perf_counter()
+            await send(message)
+            timings.add("send", time.perf_counter() - start)
+
+        profiler = None
+        if self._should_profile(scope):
+            self._profiling = True
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+        token = _timings.set(timings)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
+            total = time.perf_counter() - timings.start
+            if profiler is not None:
+                profiler.stop()
+                await self._write_profile(profiler, scope)
+                self._profiling = False
+            if total >= self.log_threshold:
+                self._log(scope, status[0], total, timings.phases)
+
+    def _should_profile(self, scope: Scope) -> bool:
+        if self._profiling:
+            return False
+        if self.profile_token:
+            header = Headers(scope=scope).get("X-Profile", "")
+            if secrets.compare_digest(header, self.profile_token):
+                return True
+        return random.random() < self.profile_rate
+
+    async def _write_profile(self, profiler: Profiler, scope: Scope) -> None:
+        route = getattr(scope.get("route"), "path", scope["path"])
+        name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_")
+        path = self.profile_dir / (
+            f"{datetime.now():%Y%m%dT%H%M%S.%f}-{scope['method']}-{name}"
+            ".speedscope.json"
+        )
+
+        def write() -> None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            path.write_text(profiler.output(SpeedscopeRenderer()))
+
+        try:
+            await asyncio.to_thread(write)
+            logger.info(f"Wrote profile of {scope['path']} to {path}")
+        except OSError as e:
+            logger.warning(f"Failed to write profile of {scope['path']}: {e}")
+
+    def _log(
+        self, scope: Scope, status: int, total: float, phases: Dict[str, float]
+    ) -> None:
+        accounted = sum(
+            seconds for phase, seconds in phases.items() if phase != "first_row"
+        )
+        record = {
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope["query_string"].decode("latin-1"),
+            "route": getattr(scope.get("route"), "path", None),
+            "status": status,
+            "total_ms": round(total * 1000, 1),
+            **{f"{phase}_ms": round(s * 1000, 1) for phase, s in phases.items()},
+            "python_ms": round(max(total - accounted, 0) * 1000, 1),
+        }
+        logger.info(json.dumps(record))
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.admission import AdmissionLimiter, admitted
+
+
+def test_admits_up_to_max_concurrency():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=2, max_queue=0, max_wait=1)
+        results = [await limiter.acquire() for _ in range(3)]
+        return results, limiter.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [True, True, False]
+    assert stats["active"] == 2
+    assert stats["admitted"] == 2
+    assert stats["rejected"] == 1
+
+
+def test_unlimited():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=0, max_queue=0, max_wait=1)
+        return [await limiter.acquire() for _ in range(10)]
+
+    assert asyncio.run(run()) == [True] * 10
+
+
+def test_queued_requests_are_admitted_in_order():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=1, max_queue=3, max_wait=1)
+        admitted = []
+
+        async def request(name):
+            assert await limiter.acquire()
+            admitted.append(name)
+            await asyncio.sleep(0.001)
+            await limiter.release()
+
+        await limiter.acquire()
+        queued = [asyncio.create_task(request(name)) for name in "abc"]
+        await asyncio.sleep(0)
+        assert limiter.queued == 3
+        await limiter.release()
+        # A request arriving as the slot is released doesn't skip the queue
+        late = asyncio.create_task(request("d"))
+        await asyncio.gather(*queued, late)
+        return admitted, limiter.stats()
+
+    admitted, stats = asyncio.run(run())
+    assert admitted == ["a", "b", "c", "d"]
+    assert stats["active"] == 0
+    assert stats["queued"] == 0
+
+
+def test_rejects_when_the_queue_is_full():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=1, max_queue=1, max_wait=1)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        rejected = await limiter.acquire()
+        await limiter.release()
+        return rejected, await waiting
+
+    assert asyncio.run(run()) == (False, True)
+
+
+def test_rejects_after_max_wait():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=1, max_queue=1, max_wait=0.01)
+        await limiter.acquire()
+        return await limiter.acquire(), limiter.stats()
+
+    admitted, stats = asyncio.run(run())
+    assert not admitted
+    assert stats["queued"] == 0
+    assert stats["rejected"] == 1
+
+
+def test_cancelled_request_passes_on_its_slot():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=1, max_queue=2, max_wait=1)
+        await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire())
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # the slot is handed to the first request, which is then cancelled
+        await limiter.release()
+        cancelled.cancel()
+        admitted = await waiting
+        return admitted, limiter.stats()
+
+    admitted, stats = asyncio.run(run())
+    assert admitted
+    assert stats["active"] == 1
+    assert stats["queued"] == 0
+
+
+def test_admitted_holds_a_slot_while_streaming():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=1, max_queue=0, max_wait=1)
+        active = []
+
+        async def chunks():
+            active.append(limiter.active)
+            yield "a"
+            yield "b"
+
+        body = [chunk async for chunk in admitted(limiter, chunks(), 5)]
+        return body, active, limiter.active
+
+    assert asyncio.run(run()) == (["a", "b"], [1], 0)
+
+
+def test_admitted_rejects_without_starting_the_chunks():
+    async def run():
+        limiter = AdmissionLimiter(max_concurrency=1, max_queue=0, max_wait=1)
+        await limiter.acquire()
+        started = []
+
+        async def chunks():
+            started.append(True)
+            yield "a"
+
+        with pytest.raises(HTTPException) as e:
+            await anext(admitted(limiter, chunks(), 5))
+        return e.value, started, limiter.active
+
+    error, started, active = asyncio.run(run())
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": "5"}
+    assert started == []
+    assert active == 1
@@ -0,0 +1,229 @@
+import asyncio
+from contextlib import aclosing
+
+import pytest
+from fastapi import HTTPException
+
+from app import cache as cache_module
+from app.cache import ResponseCache
+
+
+class FakeQuery:
+    """Async generator factory that counts how many times it's run"""
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.runs = 0
+        self.closed = 0
+
+    async def __call__(self):
+        self.runs += 1
+        try:
+            if self.error is not None:
+                raise self.error
+            for chunk in self.chunks:
+                await asyncio.sleep(0.001)
+                yield chunk
+        finally:
+            self.closed += 1
+
+
+async def read(chunks, limit=None, delay=0.0):
+    body = []
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            body.append(chunk)
+            await asyncio.sleep(delay)
+            if limit is not None and len(body) == limit:
+                break
+    return b"".join(body)
+
+
+def test_get_put():
+    cache = ResponseCache(max_bytes=100, ttl=60, max_entry_bytes=100)
+    assert cache.get("a") is None
+    cache.put("a", b"body")
+    assert cache.get("a") == b"body"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.size_bytes == 4
+
+
+def test_evicts_least_recently_used():
+    cache = ResponseCache(max_bytes=10, ttl=60, max_entry_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    cache.get("a")
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+    assert cache.stats()["evictions"] == 1
+    assert cache.size_bytes == 8
+
+
+def test_does_not_cache_large_bodies():
+    cache = ResponseCache(max_bytes=100, ttl=60, max_entry_bytes=4)
+    cache.put("a", b"too large")
+    assert cache.get("a") is None
+    assert cache.stats()["uncacheable"] == 1
+
+
+def test_expires_bodies(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now)
+    cache = ResponseCache(max_bytes=100, ttl=60, max_entry_bytes=100)
+    cache.put("a", b"body")
+    now += 61
+    assert cache.get("a") is None
+    assert cache.size_bytes == 0
+
+
+def test_invalidate():
+    cache = ResponseCache(max_bytes=100, ttl=60, max_entry_bytes=100)
+    cache.put("a", b"body")
+    cache.invalidate()
+    assert cache.get("a") is None
+    assert cache.size_bytes == 0
+
+
+def test_fetch_is_single_flight():
+    cache = ResponseCache(max_bytes=100, ttl=60, max_entry_bytes=100)
+    fetches = 0
+
+    async def fetch():
+        nonlocal fetches
+        fetches += 1
+        await asyncio.sleep(0.01)
+        return b"version"
+
+    async def run():
+        return await asyncio.gather(*(cache.fetch("a", fetch) for _ in range(5)))
+
+    assert asyncio.run(run()) == [b"version"] * 5
+    assert fetches == 1
+    assert cache.stats()["coalesced"] == 4
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_fetch_raises_for_every_waiting_request():
+    cache = ResponseCache(max_bytes=100, ttl=60, max_entry_bytes=100)
+    fetches = 0
+
+    async def fetch():
+        nonlocal fetches
+        fetches += 1
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=404)
+
+    async def run():
+        return await asyncio.gather(
+            *(cache.fetch("a", fetch) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, HTTPException) for result in results)
+    assert fetches == 1
+
+
+@pytest.mark.parametrize("max_entry_bytes", [1000, 10])
+def test_stream_is_single_flight(max_entry_bytes):
+    # Bodies too large to cache are still only queried once
+    cache = ResponseCache(max_bytes=1000, ttl=60, max_entry_bytes=max_entry_bytes)
+    query = FakeQuery([b"header\n", b"row 1\n", b"row 2\n", b"row 3\n"])
+
+    async def run():
+        streams = [cache.stream("a", query()) for _ in range(4)]
+        # readers are sent the chunks at their own pace
+        return await asyncio.gather(
+            *(read(stream, delay=0.002 * i) for i, stream in enumerate(streams))
+        )
+
+    assert asyncio.run(run()) == [b"header\nrow 1\nrow 2\nrow 3\n"] * 4
+    assert query.runs == 1
+    assert cache.stats()["coalesced"] == 3
+    assert cache.stats()["in_flight"] == 0
+    if max_entry_bytes == 1000:
+        assert cache.get("a") == b"header\nrow 1\nrow 2\nrow 3\n"
+    else:
+        assert cache.get("a") is None
+        assert cache.stats()["uncacheable"] == 1
+
+
+def test_stream_raises_for_every_reader():
+    cache = ResponseCache(max_bytes=1000, ttl=60, max_entry_bytes=1000)
+    query = FakeQuery([], error=HTTPException(status_code=404))
+
+    async def run():
+        streams = [cache.stream("a", query()) for _ in range(3)]
+        return await asyncio.gather(
+            *(read(stream) for stream in streams), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, HTTPException) for result in results)
+    assert query.runs == 1
+    assert cache.get("a") is None
+
+
+def test_stream_continues_after_the_first_reader_disconnects():
+    cache = ResponseCache(max_bytes=1000, ttl=60, max_entry_bytes=10)
+    query = FakeQuery([b"header\n", b"row 1\n", b"row 2\n"])
+
+    async def run():
+        first, second = cache.stream("a", query()), cache.stream("a", query())
+        return await asyncio.gather(read(first, limit=1), read(second))
+
+    assert asyncio.run(run()) == [b"header\n", b"header\nrow 1\nrow 2\n"]
+    assert query.runs == 1
+
+
+def test_stream_stops_once_every_reader_disconnects():
+    cache = ResponseCache(max_bytes=1000, ttl=60, max_entry_bytes=1000)
+    query = FakeQuery([b"row\n"] * 100)
+
+    async def run():
+        streams = [cache.stream("a", query()) for _ in range(2)]
+        await asyncio.gather(*(read(stream, limit=2) for stream in streams))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert query.closed == 1
+    assert cache.get("a") is None
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_stream_is_cancelled_while_waiting_for_a_chunk():
+    cache = ResponseCache(max_bytes=1000, ttl=60, max_entry_bytes=1000)
+    closed = []
+
+    async def slow_query():
+        try:
+            yield b"header\n"
+            await asyncio.sleep(60)
+            yield b"row\n"
+        finally:
+            closed.append(True)
+
+    async def run():
+        await read(cache.stream("a", slow_query()), limit=1)
+        await asyncio.sleep(0.01)
+        # checked before asyncio.run cancels any tasks that are left
+        return list(closed), cache.stats()["in_flight"]
+
+    assert asyncio.run(run()) == ([True], 0)
+
+
+def test_stream_is_not_joined_once_too_large_to_cache():
+    cache = ResponseCache(max_bytes=1000, ttl=60, max_entry_bytes=10)
+    query = FakeQuery([b"header\n", b"row 1\n", b"row 2\n"])
+
+    async def run():
+        first = asyncio.create_task(read(cache.stream("a", query())))
+        await asyncio.sleep(0.005)
+        second = await read(cache.stream("a", query()))
+        return await first, second
+
+    assert asyncio.run(run()) == (b"header\nrow 1\nrow 2\n",) * 2
+    assert query.runs == 2
@@ -0,0 +1,64 @@
+import gzip
+import zlib
+
+import pytest
+import zstandard
+
+from app.compression import Compressor, negotiate_encoding
+
+ENCODINGS = ["zstd", "gzip"]
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("gzip, deflate, br, zstd", "zstd"),
+        ("gzip, deflate", "gzip"),
+        ("GZIP", "gzip"),
+        ("zstd;q=0.5, gzip", "gzip"),
+        ("zstd;q=0, gzip;q=0", None),
+        ("zstd;q=abc, gzip;q=0.1", "gzip"),
+        ("*", "zstd"),
+        ("*;q=0.5, gzip", "gzip"),
+        ("br, deflate", None),
+        ("", None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding, ENCODINGS) == expected
+
+
+def test_negotiate_encoding_prefers_the_first_of_equal_quality():
+    assert negotiate_encoding("gzip, zstd", ["gzip", "zstd"]) == "gzip"
+
+
+def test_negotiate_encoding_disabled():
+    assert negotiate_encoding("gzip, zstd", []) is None
+
+
+def test_gzip_chunks_decode_as_received():
+    compressor = Compressor("gzip", 6)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = [b"date,area\n", b"2020-01-01,1\n" * 100, b"2020-01-02,2\n"]
+    data = b""
+    for i, chunk in enumerate(chunks):
+        compressed = compressor.compress(chunk, end=i == len(chunks) - 1)
+        # everything written so far is decoded from the data sent so far
+        assert decompressor.decompress(compressed) == chunk
+        data += compressed
+    assert decompressor.eof
+    assert gzip.decompress(data) == b"".join(chunks)
+
+
+def test_zstd_chunks_decode_as_received():
+    compressor = Compressor("zstd", 3)
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    chunks = [b"date,area\n", b"2020-01-01,1\n" * 100, b"2020-01-02,2\n"]
+    data = b""
+    for i, chunk in enumerate(chunks):
+        compressed = compressor.compress(chunk, end=i == len(chunks) - 1)
+        assert decompressor.decompress(compressed) == chunk
+        data += compressed
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(data) == b"".join(
+        chunks
+    )
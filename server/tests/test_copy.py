@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+import pytest
+from psycopg import AsyncConnection, sql
+
+from app.db import get_connection_str
+from app.main import dated_csv_line, observation_csv_line
+from app.queries import (
+    OBSERVATION_COLUMNS,
+    OBSERVATION_COPY_COLUMNS,
+    copy_csv_query,
+    copy_csv_value,
+)
+from app.streaming import stream_copy
+
+# The COPY columns are compared against the CSV generators by running both
+# on the same rows, which needs a database
+pytestmark = pytest.mark.skipif(
+    not os.getenv("POSTGRES_HOST"), reason="needs a database (POSTGRES_* env vars)"
+)
+
+# Floats that postgres and python write differently, and percentages that
+# round differently from their shortest decimal
+FLOATS = [
+    0.0,
+    -0.0,
+    1200.0,
+    -1200.0,
+    1234.5678,
+    0.1,
+    1 / 3,
+    2.675,
+    1.005,
+    0.125,
+    0.375,
+    2.625,
+    99.995,
+    -0.001,
+    1e-05,
+    1e15,
+    1.2345678901234567e15,
+    1e16,
+    1.5e22,
+    float("nan"),
+    float("inf"),
+    float("-inf"),
+]
+
+
+async def csv_both_ways(query: sql.Composable, columns, line, params):
+    """Returns the CSV written by the python generator, and by COPY"""
+    async with await AsyncConnection.connect(get_connection_str()) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(query, params)
+            python_csv = "".join(line(row) + "\n" for row in await cursor.fetchall())
+            copy_csv = b"".join(
+                [
+                    bytes(data)
+                    async for data in stream_copy(
+                        cursor, copy_csv_query(query, columns), params
+                    )
+                ]
+            ).decode()
+    return python_csv, copy_csv
+
+
+def test_observation_copy_columns_match_the_csv_generator():
+    query = sql.SQL(
+        "SELECT '2020-01-01'::timestamp AS date, {} FROM unnest(%(values)s::float8[]) AS v"
+    ).format(
+        sql.SQL(", ").join(
+            sql.SQL("v AS {}").format(sql.Identifier(col))
+            for col in OBSERVATION_COLUMNS[1:]
+        )
+    )
+    python_csv, copy_csv = asyncio.run(
+        csv_both_ways(
+            query, OBSERVATION_COPY_COLUMNS, observation_csv_line, dict(values=FLOATS)
+        )
+    )
+    assert copy_csv == python_csv
+
+
+def test_dated_copy_columns_match_the_csv_generator():
+    # eg; a resampled query, with a count along with the float columns
+    query = sql.SQL(
+        "SELECT '2020-01-01'::timestamp AS date, 3::bigint AS count, v AS value "
+        "FROM unnest(%(values)s::float8[]) AS v"
+    )
+    columns = ["q.date::date"] + [
+        copy_csv_value(f"q.{col}") for col in ("count", "value")
+    ]
+    python_csv, copy_csv = asyncio.run(
+        csv_both_ways(query, columns, dated_csv_line, dict(values=FLOATS))
+    )
+    assert copy_csv == python_csv
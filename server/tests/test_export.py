@@ -0,0 +1,90 @@
+from datetime import date
+
+import pytest
+
+from app.export import (
+    EXPORT_DATASETS,
+    ExportDataset,
+    ExportFormat,
+    Partition,
+    export_query,
+)
+from app.queries import OBSERVATION_AGGREGATES_TABLE
+
+
+def test_ndjson_rows_are_formatted_by_postgres():
+    query, params = export_query(ExportDataset.extents, ExportFormat.ndjson, True)
+    query = query.as_string(None)
+    assert query.startswith("SELECT NULL, row_to_json(q)::text FROM")
+    assert query.endswith("ORDER BY q.uid")
+    assert "WHERE" not in query
+    assert params == {}
+
+
+def test_parquet_columns_match_the_schema():
+    query, _ = export_query(ExportDataset.water_quality, ExportFormat.parquet, True)
+    query = query.as_string(None)
+    schema = EXPORT_DATASETS[ExportDataset.water_quality].schema
+    columns = ", ".join(
+        f"q.{field.name}::text" if field.name == "uid" else f"q.{field.name}"
+        for field in schema
+    )
+    assert f"SELECT NULL, {columns} FROM" in query
+    assert query.endswith("ORDER BY q.uid, q.date")
+
+
+def test_partitioned_by_year():
+    query, _ = export_query(
+        ExportDataset.observations, ExportFormat.ndjson, True, Partition.year
+    )
+    query = query.as_string(None)
+    assert query.startswith("SELECT extract(year FROM q.date)::integer,")
+    assert OBSERVATION_AGGREGATES_TABLE in query
+    assert query.endswith("ORDER BY q.date, q.uid")
+
+
+def test_filters():
+    query, _ = export_query(
+        ExportDataset.water_quality,
+        ExportFormat.ndjson,
+        True,
+        year=2020,
+        uid_prefix="z",
+        updated_since=date(2020, 6, 1),
+    )
+    query = query.as_string(None)
+    assert (
+        "WHERE q.date >= '2020-01-01'::date AND q.date < '2021-01-01'::date"
+        " AND q.date >= '2020-06-01'::date AND q.uid >= 'z' ORDER BY" in query
+    )
+
+
+def test_uid_prefix_range():
+    query, _ = export_query(
+        ExportDataset.extents, ExportFormat.ndjson, True, uid_prefix="b"
+    )
+    assert "q.uid >= 'b' AND q.uid < 'c'" in query.as_string(None)
+
+
+def test_observations_without_aggregates_table():
+    query, params = export_query(
+        ExportDataset.observations,
+        ExportFormat.ndjson,
+        False,
+        updated_since=date(2020, 6, 1),
+    )
+    query = query.as_string(None)
+    assert OBSERVATION_AGGREGATES_TABLE not in query
+    assert "%(since)s::date" in query
+    assert params == {"since": date(2020, 6, 1)}
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [dict(partition=Partition.year), dict(year=2020), dict(updated_since=date.min)],
+)
+def test_undated_datasets_cant_be_filtered_by_date(filters):
+    with pytest.raises(ValueError):
+        export_query(
+            ExportDataset.water_quality_rankings, ExportFormat.ndjson, True, **filters
+        )
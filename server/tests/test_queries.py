@@ -0,0 +1,123 @@
+import asyncio
+from datetime import date
+
+import pytest
+from psycopg.types.numeric import Float8, Int4, Int8
+
+from app.queries import (
+    WATER_QUALITY_SUMMARY_QUERY,
+    WATERBODY_GEOMETRY_QUERY,
+    WATERBODY_OBSERVATIONS_QUERY,
+    WQ_COLUMNS,
+    Interval,
+    WQQuantile,
+    WQVariable,
+    resampled_columns,
+    resampled_query,
+    water_quality_columns,
+    water_quality_summary_query,
+)
+
+
+def test_water_quality_columns_all():
+    assert water_quality_columns() == WQ_COLUMNS
+
+
+def test_water_quality_columns_subset():
+    assert water_quality_columns(
+        [WQVariable.tsi, WQVariable.hue], [WQQuantile.q0_9, WQQuantile.q0_5]
+    ) == ["hue_q0_5", "hue_q0_9", "tsi_q0_5", "tsi_q0_9"]
+
+
+def test_water_quality_columns_without_quantiles():
+    # fai_cover and ndvi_cover aren't summarised by quantile
+    assert water_quality_columns(
+        [WQVariable.ndvi_cover, WQVariable.fai_cover], [WQQuantile.q0_1]
+    ) == ["fai_cover", "ndvi_cover"]
+    assert water_quality_columns([WQVariable.chla]) == [
+        f"chla_{quantile.name}" for quantile in WQQuantile
+    ]
+
+
+def test_water_quality_summary_query():
+    # The summaries are streamed from a server-side cursor, so aren't prepared
+    assert not WATER_QUALITY_SUMMARY_QUERY.prepared
+    statement = water_quality_summary_query(["tsi_q0_5"])
+    assert not statement.prepared
+    assert statement.params == WATER_QUALITY_SUMMARY_QUERY.params
+    assert "SELECT wq.date, wq.tsi_q0_5\n" in statement.query
+
+
+def test_statement_sql_and_values():
+    statement = WATERBODY_OBSERVATIONS_QUERY
+    query = statement.sql().as_string(None)
+    for name, pg_type in statement.params:
+        assert f"%({name})s::{pg_type}" in query
+    assert "{" not in query
+    params = dict(
+        wb_id=1,
+        uid="abc",
+        area_m2=10.0,
+        start_date=date(2020, 1, 1),
+        end_date=date(2021, 1, 1),
+    )
+    values = statement.values(**params, unused=True)
+    assert values == {name: params[name] for name, _ in statement.params}
+
+
+class RecordingCursor:
+    async def execute(self, query, params, prepare=None):
+        self.params = params
+        self.prepare = prepare
+        return self
+
+
+def test_statement_execute_sends_the_declared_types():
+    # psycopg prepares a statement for each set of parameter types, so the
+    # types mustn't depend on the values (eg; a small wb_id sent as an int2)
+    cursor = asyncio.run(
+        WATERBODY_GEOMETRY_QUERY.execute(
+            RecordingCursor(), wb_id=1, tolerance=0, precision=9, unused=True
+        )
+    )
+    assert cursor.prepare
+    assert cursor.params == dict(wb_id=1, tolerance=0.0, precision=9)
+    assert [type(value) for value in cursor.params.values()] == [Int8, Float8, Int4]
+
+
+def test_resampled_columns():
+    assert resampled_columns(["area_wet_m2"]) == [
+        "count",
+        "area_wet_m2_mean",
+        "area_wet_m2_min",
+        "area_wet_m2_max",
+    ]
+
+
+@pytest.mark.parametrize("interval", list(Interval))
+def test_resampled_query(interval):
+    columns = ["tsi_q0_5", "fai_cover"]
+    statement = resampled_query(WATER_QUALITY_SUMMARY_QUERY, columns, interval)
+    assert statement.name == f"{WATER_QUALITY_SUMMARY_QUERY.name}_{interval.value}"
+    assert statement.params == WATER_QUALITY_SUMMARY_QUERY.params
+    assert statement.prepared == WATER_QUALITY_SUMMARY_QUERY.prepared
+    query = statement.sql().as_string(None)
+    assert f"FROM ({WATER_QUALITY_SUMMARY_QUERY.sql().as_string(None)}) AS q" in query
+    for column in columns:
+        assert f"avg(q.{column}) AS {column}_mean" in query
+        assert f"min(q.{column}) AS {column}_min" in query
+        assert f"max(q.{column}) AS {column}_max" in query
+    assert "GROUP BY 1" in query
+
+
+def test_resampled_query_is_prepared_if_the_statement_is():
+    statement = resampled_query(
+        water_quality_summary_query(["tsi_q0_5"]), ["tsi_q0_5"], Interval.month
+    )
+    assert not statement.prepared
+    statement = resampled_query(
+        WATERBODY_OBSERVATIONS_QUERY._replace(prepared=True),
+        ["area_wet_m2"],
+        Interval.month,
+    )
+    assert statement.prepared
@@ -0,0 +1,85 @@
+from psycopg import sql
+
+from app.queries import OBSERVATION_AGGREGATES_TABLE
+from app.schema import (
+    INDEXES,
+    MIGRATIONS,
+    QUERY_INDEXES,
+    REPLACED_INDEXES,
+    WQ_RANKING_INDEXES,
+)
+
+
+class FakeResult:
+    def __init__(self, row):
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    """Records the statements run by a migration, every table exists and
+    isn't partitioned"""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        return FakeResult(("r",))
+
+    def ran(self, statement, name):
+        """Whether a statement (eg; `CREATE INDEX`) was run for a name"""
+        return any(
+            isinstance(query, sql.Composed)
+            and list(query)[0].as_string(None).startswith(statement)
+            and sql.Identifier(name) in list(query)
+            for query in self.statements
+        )
+
+    def created_indexes(self):
+        return [name for name in INDEXES if self.ran("CREATE INDEX", name)]
+
+
+def migration(version):
+    return next(m for m in MIGRATIONS if m.version == version)
+
+
+def test_migration_versions_are_unique_and_ordered():
+    versions = [m.version for m in MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+
+def test_index_migrations_arent_run_in_a_transaction():
+    # indexes are created concurrently
+    assert not migration(3).transaction
+    assert not migration(4).transaction
+
+
+def test_query_indexes_migration():
+    conn = FakeConnection()
+    migration(3).apply(conn)
+    assert conn.created_indexes() == list(QUERY_INDEXES)
+    for name in REPLACED_INDEXES:
+        assert conn.ran("DROP INDEX CONCURRENTLY", name)
+
+
+def test_ranking_indexes_migration():
+    conn = FakeConnection()
+    migration(4).apply(conn)
+    assert conn.created_indexes() == list(WQ_RANKING_INDEXES)
+    assert not any(conn.ran("DROP INDEX", name) for name in REPLACED_INDEXES)
+    assert conn.ran("ANALYZE", "waterbodies_water_quality_percentiles")
+    assert not conn.ran("ANALYZE", "waterbodies_observations")
+
+
+def test_indexes_are_the_union_of_the_migrations():
+    assert INDEXES == {**QUERY_INDEXES, **WQ_RANKING_INDEXES}
+
+
+def test_aggregates_migration_keeps_an_existing_table():
+    conn = FakeConnection()
+    migration(5).apply(conn)
+    assert migration(5).transaction
+    assert not conn.ran("CREATE TABLE", OBSERVATION_AGGREGATES_TABLE)
@@ -0,0 +1,48 @@
+import asyncio
+
+from app.streaming import buffered
+
+
+async def slow_chunks(closed: list):
+    try:
+        yield "header\n"
+        yield "a\n"
+        await asyncio.sleep(0.3)
+        yield "b\n"
+        await asyncio.sleep(60)
+        yield "c\n"
+    finally:
+        closed.append(True)
+
+
+def test_buffered_flushes_while_waiting_for_the_next_chunk():
+    async def run():
+        closed = []
+        sent = []
+        stream = buffered(slow_chunks(closed), flush_interval=0.05)
+        # The first chunk is sent straight away, the next once the flush
+        # interval has passed rather than when the slow chunk arrives
+        sent.append(await anext(stream))
+        sent.append(await asyncio.wait_for(anext(stream), 0.2))
+        sent.append(await anext(stream))
+        # Closing while the next chunk is awaited closes the chunks
+        await asyncio.wait_for(stream.aclose(), 1)
+        return sent, closed
+
+    sent, closed = asyncio.run(run())
+    assert sent == [b"header\n", b"a\n", b"b\n"]
+    assert closed == [True]
+
+
+def test_buffered_joins_chunks_until_flush_size():
+    async def chunks():
+        for i in range(10):
+            yield f"{i}" * 10
+
+    async def run():
+        return [chunk async for chunk in buffered(chunks(), flush_size=25)]
+
+    sent = asyncio.run(run())
+    assert b"".join(sent) == b"".join(f"{i}".encode() * 10 for i in range(10))
+    assert len(sent[0]) == 10
+    assert all(len(chunk) >= 25 for chunk in sent[1:-1])
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+import time
+
+import pytest
+
+from app.timing import ServerTimingMiddleware, record_timing, server_timing, timed
+
+
+def test_server_timing():
+    assert server_timing({"db": 0.01234, "custom": 0.5}) == (
+        'db;desc="Database";dur=12.3, custom;desc="custom";dur=500.0'
+    )
+    assert server_timing({}) == ""
+
+
+async def app(scope, receive, send):
+    """ASGI app that spends time in the db before the response starts, and
+    in the lookup while the body is being sent"""
+    with timed("db"):
+        await asyncio.sleep(0.02)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    with timed("lookup"):
+        time.sleep(0.02)
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def request(middleware):
+    """Sends a GET request to an ASGI app, returns the messages it sent"""
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/waterbody/1",
+        "query_string": b"format=csv",
+        "headers": [],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    return messages
+
+
+def server_timing_phases(message):
+    headers = dict(message["headers"])
+    return {
+        entry.split(";")[0]: float(entry.split("dur=")[1])
+        for entry in headers[b"server-timing"].decode().split(", ")
+    }
+
+
+def test_server_timing_header_has_the_phases_before_the_response_start(tmp_path):
+    messages = request(ServerTimingMiddleware(app, 60, tmp_path))
+    phases = server_timing_phases(messages[0])
+    assert list(phases) == ["db", "total"]
+    assert phases["db"] >= 20
+    assert phases["total"] >= phases["db"]
+    assert messages[1]["body"] == b"ok"
+
+
+def test_timings_arent_recorded_outside_a_request():
+    with timed("db"):
+        pass
+    record_timing("db", 1.0)
+
+
+def test_slow_requests_are_logged(tmp_path, caplog):
+    with caplog.at_level(logging.INFO, logger="app.timing"):
+        request(ServerTimingMiddleware(app, 0.01, tmp_path))
+    (record,) = [json.loads(r.message) for r in caplog.records]
+    assert record["method"] == "GET"
+    assert record["path"] == "/waterbody/1"
+    assert record["query"] == "format=csv"
+    assert record["status"] == 200
+    # The lookup phase continued after the response started
+    assert record["db_ms"] >= 20
+    assert record["lookup_ms"] >= 20
+    assert "send_ms" in record
+    accounted = record["db_ms"] + record["lookup_ms"] + record["send_ms"]
+    assert record["python_ms"] == pytest.approx(record["total_ms"] - accounted, abs=0.5)
+
+
+def test_fast_requests_arent_logged(tmp_path, caplog):
+    with caplog.at_level(logging.INFO, logger="app.timing"):
+        request(ServerTimingMiddleware(app, 60, tmp_path))
+    assert not caplog.records